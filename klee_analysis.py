@@ -0,0 +1,834 @@
+# klee_analysis.py
+# 画像解析（Hue.txt / Value.txt 生成）まわりの処理をまとめたモジュール
+import functools
+import hashlib
+import json
+import os
+import tempfile
+from colorsys import rgb_to_hsv
+
+import numpy as np
+import pygame
+
+# ============================================================
+# 1) SURFACE -> ARRAY / HSV
+# ============================================================
+# 一度に HSV 変換する列数（巨大画像でも float64 の作業領域を抑えるため）
+ANALYSIS_CHUNK_COLS = 512
+
+
+def surface_to_rgb_array(surf, step=1):
+    """
+    Surface を (w, h, 3) の uint8 配列として取り出す（step 間引きあり）
+    - pixels3d のビューを間引いてコピーするので、元 Surface のロックはすぐ外れる
+    """
+    view = pygame.surfarray.pixels3d(surf)
+    try:
+        arr = np.array(view[::step, ::step, :3], dtype=np.uint8, copy=True)
+    finally:
+        del view
+    return arr
+
+
+def rgb_array_to_hsv(rgb):
+    """
+    colorsys.rgb_to_hsv と同じ計算順序で配列をまとめて HSV(0..1) に変換する
+    - 浮動小数の演算順を揃えているので、int(h*360) などの量子化結果は完全に一致する
+    """
+    r = rgb[..., 0] / 255.0
+    g = rgb[..., 1] / 255.0
+    b = rgb[..., 2] / 255.0
+
+    maxc = np.maximum(np.maximum(r, g), b)
+    minc = np.minimum(np.minimum(r, g), b)
+    rangec = maxc - minc
+    v = maxc
+
+    gray = rangec == 0.0
+    safe_range = np.where(gray, 1.0, rangec)
+    safe_max = np.where(maxc == 0.0, 1.0, maxc)
+
+    s = np.where(gray, 0.0, rangec / safe_max)
+    rc = (maxc - r) / safe_range
+    gc = (maxc - g) / safe_range
+    bc = (maxc - b) / safe_range
+
+    h = np.where(
+        r == maxc,
+        bc - gc,
+        np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc)
+    )
+    h = np.mod(h / 6.0, 1.0)
+    h = np.where(gray, 0.0, h)
+    return h, s, v
+
+
+# ============================================================
+# 2) HISTOGRAMS (1 pass)
+# ============================================================
+def build_histograms_from_rgb(rgb, hue_min_s=0.12, hue_min_v=0.10, value_min_v=0.02,
+                              chunk_cols=ANALYSIS_CHUNK_COLS):
+    """
+    RGB 配列 (w, h, 3) から Hue(0..359) と Value(0..100) のヒストグラムを1パスで作る
+    """
+    hue_hist = np.zeros(360, dtype=np.int64)
+    val_hist = np.zeros(101, dtype=np.int64)
+
+    w = rgb.shape[0]
+    for x0 in range(0, w, max(1, chunk_cols)):
+        hh, ss, vv = rgb_array_to_hsv(rgb[x0:x0 + chunk_cols])
+
+        hue_ok = (ss >= hue_min_s) & (vv >= hue_min_v)
+        hi = (hh[hue_ok] * 360).astype(np.int64) % 360
+        hue_hist += np.bincount(hi, minlength=360)
+
+        vi = (vv[vv >= value_min_v] * 100).astype(np.int64)
+        vi = np.clip(vi, 0, 100)
+        val_hist += np.bincount(vi, minlength=101)
+
+    return hue_hist.tolist(), val_hist.tolist()
+
+
+def build_histograms_from_surface(surf, step=2, hue_min_s=0.12, hue_min_v=0.10, value_min_v=0.02):
+    """
+    Surface を1回だけ配列化して、Hue / Value のヒストグラムを同時に作る
+    """
+    rgb = surface_to_rgb_array(surf, step=step)
+    return build_histograms_from_rgb(
+        rgb, hue_min_s=hue_min_s, hue_min_v=hue_min_v, value_min_v=value_min_v
+    )
+
+
+def decay_histogram(acc, counts, decay):
+    """
+    動画用：これまでのヒストグラム acc を decay 倍して、新しいフレームの counts を足す（float64）
+    - acc が None なら counts から始める
+    - 分位点で代表値を選ぶときは np.rint で整数に丸めてから渡す
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    if acc is None:
+        return counts
+    acc = acc * decay
+    acc += counts
+    return acc
+
+
+def build_hue_histogram_from_surface(surf, step=2, min_s=0.12, min_v=0.10):
+    hue_hist, _ = build_histograms_from_surface(surf, step=step, hue_min_s=min_s, hue_min_v=min_v)
+    return hue_hist
+
+
+def build_value_histogram_from_surface(surf, step=2, min_v=0.02):
+    """
+    Value(0..100)の出現頻度ヒストグラムを作る
+    - min_v: 真っ黒近いところはノイズとして弾きたいなら少し上げる（0..1）
+    """
+    _, val_hist = build_histograms_from_surface(surf, step=step, value_min_v=min_v)
+    return val_hist
+
+
+# ============================================================
+# 2.5) COLOR LOOKUP GRID (カーソル用)
+# ============================================================
+def quantize_hsv(h, s, v):
+    """
+    HSV(0..1) -> (h1: 0..359, s1: 0..100, v1: 0..100)  ※メインループの int(h*360) 等と同じ
+    """
+    h1 = (h * 360).astype(np.uint16)
+    s1 = (s * 100).astype(np.uint8)
+    v1 = (v * 100).astype(np.uint8)
+    return h1, s1, v1
+
+
+@functools.lru_cache(maxsize=65536)
+def rgb_to_hsv_quantized(r, g, b):
+    """
+    1色ぶんの (h1, s1, v1)。同じ色は何度来ても計算しない
+    """
+    h, s, v = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
+    return int(h * 360), int(s * 100), int(v * 100)
+
+
+def build_color_lookup_grid(surf, step=4):
+    """
+    step px ごとのグリッドで (RGB, 量子化HSV) を前計算する
+    - セル (cx, cy) は Surface 上の (cx*step, cy*step) の色
+    - 戻り値: grid_rgb (gw, gh, 3) uint8, grid_hsv (gw, gh, 3) uint16
+      （h1 は 0..359 なので uint8 に収まらず、HSV 側だけ uint16）
+    """
+    step = max(1, int(step or 1))
+    return build_lookup_grid_from_rgb(surface_to_rgb_array(surf, step=step))
+
+
+def build_lookup_grid_from_rgb(grid_rgb):
+    h1, s1, v1 = quantize_hsv(*rgb_array_to_hsv(grid_rgb))
+    grid_hsv = np.stack([h1, s1.astype(np.uint16), v1.astype(np.uint16)], axis=-1)
+    return grid_rgb, grid_hsv
+
+
+# ============================================================
+# 2.6) SUMMED-AREA TABLE (任意半径の平均色)
+# ============================================================
+def build_summed_area_table(rgb):
+    """
+    (w, h, 3) uint8 -> (w+1, h+1, 3) の積分画像
+    - sat[x, y] は [0, x) x [0, y) の合計。255*w*h が収まるなら uint32 で持つ
+    """
+    w, h = rgb.shape[0], rgb.shape[1]
+    dtype = np.uint32 if 255 * w * h < 2 ** 32 else np.uint64
+    sat = np.zeros((w + 1, h + 1, 3), dtype=dtype)
+    # 先に型を揃えてから同じ配列の上で累積する（uint8 から型変換しながらの cumsum より 2〜3 倍速い）
+    acc = sat[1:, 1:]
+    acc[...] = rgb
+    np.cumsum(acc, axis=0, out=acc)
+    np.cumsum(acc, axis=1, out=acc)
+    return sat
+
+
+def sat_box_mean(sat, x, y, radius):
+    """
+    (x, y) を中心に一辺 2*radius+1 の正方形の平均色（画像外は切り詰め）を O(1) で返す
+    """
+    w, h = sat.shape[0] - 1, sat.shape[1] - 1
+    x0 = max(0, x - radius)
+    y0 = max(0, y - radius)
+    x1 = min(w, x + radius + 1)
+    y1 = min(h, y + radius + 1)
+    n = (x1 - x0) * (y1 - y0)
+    total = (
+        sat[x1, y1].astype(np.int64) - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]
+    ).tolist()
+    half = n // 2
+    return ((total[0] + half) // n, (total[1] + half) // n, (total[2] + half) // n)
+
+
+def sat_grid_means(sat, step, radius):
+    """
+    step px ごとのセル中心すべてについて sat_box_mean をまとめて計算する -> (gw, gh, 3) uint8
+    """
+    w, h = sat.shape[0] - 1, sat.shape[1] - 1
+    xs = np.arange(0, w, step)
+    ys = np.arange(0, h, step)
+    x0 = np.clip(xs - radius, 0, w)[:, None]
+    x1 = np.clip(xs + radius + 1, 0, w)[:, None]
+    y0 = np.clip(ys - radius, 0, h)[None, :]
+    y1 = np.clip(ys + radius + 1, 0, h)[None, :]
+
+    total = sat[x1, y1].astype(np.int64) - sat[x0, y1] - sat[x1, y0] + sat[x0, y0]
+    n = ((x1 - x0) * (y1 - y0))[..., None]
+    return ((total + n // 2) // n).astype(np.uint8)
+
+
+def sat_grid_sums(planes, step, radius):
+    """
+    画素ごとの量 (w, h) の並び -> ((gw, gh, C) float64 の合計, (gw, gh) の画素数)
+    - セル中心と窓（画像外は切り詰め）は sat_grid_means と同じ
+    - 量ごとに縦方向の積分画像を作ってセルの行だけ残し、その上で横方向に積分する
+      （(w+1, h+1, C) の表を持たず、1方向の累積なので float64 の桁落ちもほぼない）
+    """
+    w, h = planes[0].shape
+    xs = np.arange(0, w, step)
+    ys = np.arange(0, h, step)
+    x0 = np.clip(xs - radius, 0, w)
+    x1 = np.clip(xs + radius + 1, 0, w)
+    y0 = np.clip(ys - radius, 0, h)
+    y1 = np.clip(ys + radius + 1, 0, h)
+
+    sums = np.empty((len(xs), len(ys), len(planes)), dtype=np.float64)
+    acc = np.zeros((w + 1, h), dtype=np.float64)
+    rows = np.zeros((len(xs), h + 1), dtype=np.float64)
+    for k, plane in enumerate(planes):
+        np.cumsum(plane, axis=0, out=acc[1:])
+        np.subtract(acc[x1], acc[x0], out=rows[:, 1:])
+        np.cumsum(rows[:, 1:], axis=1, out=rows[:, 1:])
+        sums[..., k] = rows[:, y1] - rows[:, y0]
+    n = (x1 - x0)[:, None] * (y1 - y0)[None, :]
+    return sums, n
+
+
+# ============================================================
+# 2.7) MUSICAL REGIONS (Max 側で同じ音になる範囲)
+# ============================================================
+# klee_main.maxpat では H → table Hue（和音クラス）、S → scale 0 100 -2 3（オクターブ）、
+# V → table Value（velocity）。この3つが同じ色は Max では同じ音になる
+SATURATION_OCTAVES = 6
+VELOCITY_LEVELS = 129
+
+
+def saturation_octave(s1):
+    """
+    S(0..100) -> オクターブ -2..3（Max の scale 0 100 -2 3 と同じく 0 方向へ切り捨て）
+    """
+    return int(-2 + s1 * 5 / 100)
+
+
+def musical_label(h1, s1, v1, hue_map, value_map):
+    """
+    1色ぶんの音のラベル（和音クラス・オクターブ・velocity を1つの int にしたもの）
+    """
+    octave = saturation_octave(s1) + 2
+    velocity = value_map[min(99, v1)]
+    return (hue_map[h1 % 360] * SATURATION_OCTAVES + octave) * VELOCITY_LEVELS + velocity
+
+
+def build_label_grid(grid_hsv, hue_map, value_map):
+    """
+    grid_hsv (gw, gh, 3) -> 各セルの musical_label (gw, gh) int32
+    """
+    h1 = grid_hsv[..., 0].astype(np.int32) % 360
+    s1 = grid_hsv[..., 1].astype(np.float64)
+    v1 = np.minimum(grid_hsv[..., 2], 99)
+    octave = np.trunc(-2 + s1 * 5 / 100).astype(np.int32) + 2
+    hue_bin = np.asarray(hue_map, dtype=np.int32)[h1]
+    velocity = np.asarray(value_map, dtype=np.int32)[v1]
+    return (hue_bin * SATURATION_OCTAVES + octave) * VELOCITY_LEVELS + velocity
+
+
+def label_connected_regions(labels):
+    """
+    同じラベルが上下左右でつながった範囲ごとに番号を振る
+    - 戻り値: (regions (gw, gh) int32 … 0..n-1, n)
+    - 辺ごとに大きい根を小さい根へつなぎ、根をたどり切るまで縮める（Python のループはほぼ回らない）
+    """
+    gw, gh = labels.shape
+    idx = np.arange(gw * gh, dtype=np.int64).reshape(gw, gh)
+    same_x = labels[1:, :] == labels[:-1, :]
+    same_y = labels[:, 1:] == labels[:, :-1]
+    a = np.concatenate([idx[1:, :][same_x], idx[:, 1:][same_y]])
+    b = np.concatenate([idx[:-1, :][same_x], idx[:, :-1][same_y]])
+
+    parent = np.arange(gw * gh, dtype=np.int64)
+    while True:
+        pa, pb = parent[a], parent[b]
+        moved = pa != pb
+        if not moved.any():
+            break
+        np.minimum.at(parent, np.maximum(pa, pb)[moved], np.minimum(pa, pb)[moved])
+        while True:
+            nxt = parent[parent]
+            if np.array_equal(nxt, parent):
+                break
+            parent = nxt
+
+    roots, regions = np.unique(parent, return_inverse=True)
+    return regions.reshape(gw, gh).astype(np.int32), len(roots)
+
+
+def merge_small_regions(labels, min_cells, max_passes=8):
+    """
+    min_cells より小さい色面を、隣り合う一番大きな色面のラベルで塗りつぶす（筆致の細かな揺れを消す）
+    - 1回で外周1セルずつ取り込むので、max_passes 回で打ち切る
+    - 戻り値: 新しい labels（元の配列は変えない）
+    """
+    labels = labels.copy()
+    gw, gh = labels.shape
+    for _ in range(max_passes):
+        regions, _ = label_connected_regions(labels)
+        sizes = np.bincount(regions.ravel())[regions]
+        small = sizes < min_cells
+        if not small.any():
+            break
+
+        best_size = sizes.copy()
+        best_label = labels.copy()
+        for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            # 隣のセル（画像の外は大きさ 0 扱い）
+            n_size = np.zeros_like(sizes)
+            n_label = labels.copy()
+            xs = slice(max(0, dx), gw + min(0, dx))
+            ys = slice(max(0, dy), gh + min(0, dy))
+            xd = slice(max(0, -dx), gw + min(0, -dx))
+            yd = slice(max(0, -dy), gh + min(0, -dy))
+            n_size[xd, yd] = sizes[xs, ys]
+            n_label[xd, yd] = labels[xs, ys]
+            better = small & (n_size > best_size)
+            best_size[better] = n_size[better]
+            best_label[better] = n_label[better]
+
+        changed = small & (best_label != labels)
+        if not changed.any():
+            break
+        labels[changed] = best_label[changed]
+    return labels
+
+
+# ============================================================
+# 2.8) CURSOR PATH (フレームの間の通り道)
+# ============================================================
+def interpolate_path(xs, ys, ts, step, max_samples=512):
+    """
+    折れ線 (xs, ys, ts) を step px ごとの点に分ける -> (px, py, pt) の int 配列
+    - 最初の点は前のフレームで読んだ位置なので含めず、最後の点は必ず含める
+    - 点の数が max_samples を超えるときは等間隔に間引く
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    ts = np.asarray(ts, dtype=np.float64)
+    dx, dy, dt = np.diff(xs), np.diff(ys), np.diff(ts)
+    counts = np.maximum(1, np.ceil(np.hypot(dx, dy) / max(1, step))).astype(np.int64)
+
+    seg = np.repeat(np.arange(len(counts)), counts)
+    # 区間の中で何番目か (1..count) / count
+    nth = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    f = nth / counts[seg]
+    if len(seg) > max_samples:
+        keep = np.linspace(0, len(seg) - 1, max_samples).round().astype(np.int64)
+        seg, f = seg[keep], f[keep]
+
+    px = np.floor(xs[seg] + dx[seg] * f + 0.5).astype(np.int64)
+    py = np.floor(ys[seg] + dy[seg] * f + 0.5).astype(np.int64)
+    pt = np.floor(ts[seg] + dt[seg] * f + 0.5).astype(np.int64)
+    return px, py, pt
+
+
+# ============================================================
+# 2.9) TEXTURE FEATURES (セルごとの質感：色相のばらつき・明暗の差・輪郭・彩度のばらつき)
+# ============================================================
+# /texture で送る順番（どれも 0..100）
+TEXTURE_FEATURES = ("hue_spread", "contrast", "edges", "sat_entropy")
+# 輝度(0..255)の中心差分の大きさがこれ以上の画素を輪郭とみなす
+TEXTURE_EDGE_THRESHOLD = 16
+TEXTURE_SAT_BINS = 8
+# hue_spread が 100 になる色相の円周標準偏差（ラジアン。30°）
+# 1つの色面の中はふつう数度なので、色相環の半分を 100 にすると値がほとんど動かない
+TEXTURE_HUE_STD = np.pi / 6
+
+
+def build_texture_grid(rgb, step, radius, hue_min_s=0.12, hue_min_v=0.10,
+                       edge_threshold=TEXTURE_EDGE_THRESHOLD, sat_bins=TEXTURE_SAT_BINS):
+    """
+    (w, h, 3) uint8 -> (gw, gh, 4) uint8（セルの並びと窓は sat_grid_means と同じ。TEXTURE_FEATURES の順、各 0..100）
+      hue_spread  … 色相の円周標準偏差（彩度で重みづけ。無彩色の画素は数えない。TEXTURE_HUE_STD で 100）
+      contrast    … 輝度の標準偏差（127.5 で 100）
+      edges       … 輪郭の画素の割合
+      sat_entropy … 彩度の sat_bins 段階の分布のエントロピー（一様で 100）
+    画素ごとの量を並べ、sat_grid_sums でセルごとの窓の合計を取って求める
+    """
+    hue, s, v = rgb_array_to_hsv(rgb)
+    weight = np.where((s >= hue_min_s) & (v >= hue_min_v), s, 0.0)
+    angle = hue * (2.0 * np.pi)
+    luma = rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+    gx = np.zeros_like(luma)
+    gy = np.zeros_like(luma)
+    gx[1:-1, :] = (luma[2:, :] - luma[:-2, :]) * 0.5
+    gy[:, 1:-1] = (luma[:, 2:] - luma[:, :-2]) * 0.5
+    bins = np.minimum((s * sat_bins).astype(np.int64), sat_bins - 1)
+
+    # 0: 色相の重み, 1-2: 重みつきの cos / sin, 3-4: 輝度とその2乗, 5: 輪郭, 6..: 彩度の段階（最後の段階は残りの画素数）
+    planes = [weight, weight * np.cos(angle), weight * np.sin(angle), luma, luma * luma,
+              np.hypot(gx, gy) >= edge_threshold]
+    planes += [bins == b for b in range(sat_bins - 1)]
+    sums, n = sat_grid_sums(planes, step, radius)
+    counts = sums[..., 6:]
+    counts = np.concatenate([counts, (n - counts.sum(axis=-1))[..., None]], axis=-1)
+
+    # 色相：彩度で重みづけた単位ベクトルの平均の長さ R から円周標準偏差 sqrt(-2 ln R)
+    # （重みが画素 1 つ分に満たない窓は、累積の誤差を拾わないよう 0 にする）
+    sum_w = sums[..., 0]
+    resultant = np.hypot(sums[..., 1], sums[..., 2]) / np.maximum(sum_w, 1e-6)
+    circ_std = np.sqrt(-2.0 * np.log(np.clip(resultant, 1e-12, 1.0)))
+    hue_spread = np.where(sum_w >= hue_min_s, circ_std / TEXTURE_HUE_STD, 0.0)
+
+    mean_y = sums[..., 3] / n
+    contrast = np.sqrt(np.maximum(sums[..., 4] / n - mean_y * mean_y, 0.0)) / 127.5
+
+    edges = sums[..., 5] / n
+
+    frac = np.clip(counts / n[..., None], 0.0, 1.0)
+    entropy = -(frac * np.log(np.where(frac > 0, frac, 1.0))).sum(axis=-1)
+    sat_entropy = entropy / np.log(sat_bins)
+
+    features = np.stack([hue_spread, contrast, edges, sat_entropy], axis=-1)
+    return np.clip(np.floor(features * 100 + 0.5), 0, 100).astype(np.uint8)
+
+
+# ============================================================
+# 3) CENTERS / MAPS
+# ============================================================
+def quantile_indices(hist, k):
+    """
+    累積分布が (i + 0.5) / k に届く最初の index を k 個（CDF は1回だけ作って二分探索）
+    """
+    cdf = np.cumsum(np.asarray(hist, dtype=np.int64))
+    total = int(cdf[-1])
+    targets = [int(total * ((i + 0.5) / k)) for i in range(k)]
+    return np.searchsorted(cdf, targets, side="left").tolist()
+
+def separate_hue_centers(centers):
+    centers = sorted(centers)
+    for i in range(1, len(centers)):
+        if centers[i] == centers[i - 1]:
+            centers[i] = (centers[i] + 1) % 360
+    return centers
+
+def pick_hue_centers_by_quantiles(hist, k=9):
+    total = sum(hist)
+    if total <= 0:
+        return [int(i * 360 / k) for i in range(k)]
+
+    centers = [min(359, hi) for hi in quantile_indices(hist, k)]
+    return separate_hue_centers(centers)
+
+def circular_distance(a, b):
+    d = abs(a - b) % 360
+    return min(d, 360 - d)
+
+def build_hue_to_bin_map(centers):
+    """
+    Hue 0..359 -> 一番近い center の index（同じ距離なら先の center）
+    """
+    d = np.abs(np.arange(360)[:, None] - np.asarray(centers)[None, :]) % 360
+    d = np.minimum(d, 360 - d)
+    return np.argmin(d, axis=1).tolist()
+
+def pick_value_centers_by_quantiles(hist, k=16):
+    """
+    Valueの分位点で代表値をk個選ぶ（0..100）
+    """
+    total = sum(hist)
+    if total <= 0:
+        # ほぼ情報が無い場合：等間隔
+        return [int(i * 100 / (k - 1)) for i in range(k)]
+
+    centers = [min(100, vi) for vi in quantile_indices(hist, k)]
+    return separate_value_centers(centers)
+
+def separate_value_centers(centers):
+    centers = sorted(centers)
+
+    # 代表値が重複しすぎると段階が死ぬので、近すぎるものはずらす
+    for i in range(1, len(centers)):
+        if centers[i] <= centers[i - 1]:
+            centers[i] = min(100, centers[i - 1] + 1)
+
+    # それでも最後が溢れたら、後ろから詰め直す
+    for i in range(len(centers) - 2, -1, -1):
+        if centers[i] >= centers[i + 1]:
+            centers[i] = max(0, centers[i + 1] - 1)
+
+    return centers
+
+def build_value_to_velocity_map_100(centers, vmin=1, vmax=128):
+    """
+    index 0..99 のValueに対して、
+    「最も近い代表center」に量子化 → その代表に対応する velocity を返す (1..128)
+    """
+    k = len(centers)
+    if k <= 1:
+        return [vmin] * 100
+
+    # 代表段階ごとの velocity（分かりやすいよう線形）
+    vel_levels = []
+    for i in range(k):
+        vv = vmin + int(round(i * ((vmax - vmin) / float(k - 1))))
+        if vv < vmin:
+            vv = vmin
+        if vv > vmax:
+            vv = vmax
+        vel_levels.append(vv)
+
+    # value(0..99) -> nearest center（同じ距離なら先の center）-> velocity
+    best = np.argmin(np.abs(np.arange(100)[:, None] - np.asarray(centers)[None, :]), axis=1)
+    out = [vel_levels[i] for i in best.tolist()]
+
+    # 0は除外したいので念のため
+    out = [max(vmin, min(vmax, int(x))) for x in out]
+    return out
+
+# ============================================================
+# 3.5) PALETTE ENGINE (ヒストグラム上のクラスタリング)
+# ============================================================
+# 画素ではなくヒストグラムの bin（Hue 360 / Value 101 / RGB 16^3）を重み付きでクラスタリングする。
+# 計算量は画像の大きさに関係なく bin の数で決まる（ヒストグラム作りだけが画素数に比例）
+KMEANS_MAX_ITERS = 30
+COLOR_HIST_BITS = 4
+
+
+def weighted_kmeans_1d(weights, centers, period=None, iters=KMEANS_MAX_ITERS):
+    """
+    1次元ヒストグラム（bin = 0..n-1）上の重み付き k-means。period を渡すと円環（Hue は 360）
+    - 各 bin を一番近い center に割り当て、center を符号付きの差の重み付き平均だけ動かす
+    - 戻り値: (centers（float）, 重み付き二乗誤差)
+    """
+    w = np.asarray(weights, dtype=np.float64)
+    bins = np.arange(len(w), dtype=np.float64)
+    centers = np.array(centers, dtype=np.float64)
+    k = len(centers)
+
+    def offsets():
+        diff = bins[:, None] - centers[None, :]
+        if period is not None:
+            diff = (diff + period / 2.0) % period - period / 2.0
+        return diff
+
+    assign = None
+    for _ in range(iters):
+        diff = offsets()
+        new_assign = np.argmin(np.abs(diff), axis=1)
+        if assign is not None and np.array_equal(new_assign, assign):
+            break
+        assign = new_assign
+        wsum = np.bincount(assign, weights=w, minlength=k)
+        shift = np.bincount(assign, weights=w * diff[np.arange(len(w)), assign], minlength=k)
+        moved = wsum > 0
+        centers[moved] += shift[moved] / wsum[moved]
+        if period is not None:
+            centers %= period
+
+    sse = float((w * (offsets() ** 2).min(axis=1)).sum())
+    return centers, sse
+
+
+def maximin_centers_1d(weights, k, period=None):
+    """
+    k-means の初期値（乱数なし）：一番重い bin から始め、「重み × 既存 center との距離²」が最大の bin を足す
+    """
+    w = np.asarray(weights, dtype=np.float64)
+    bins = np.arange(len(w), dtype=np.float64)
+
+    def dist(c):
+        d = np.abs(bins - c)
+        return np.minimum(d, period - d) if period is not None else d
+
+    centers = [int(np.argmax(w))]
+    d = dist(centers[0])
+    for _ in range(1, k):
+        i = int(np.argmax(w * d * d))
+        centers.append(i)
+        d = np.minimum(d, dist(i))
+    return centers
+
+
+def kmeans_hue_centers(hist, k=9, iters=KMEANS_MAX_ITERS):
+    """
+    Hue ヒストグラム上の重み付き円環 k-means
+    - 初期値は分位点の center と maximin の2通り。誤差の小さい方を使う
+    - 戻り値は pick_hue_centers_by_quantiles と同じ形（0..359 の int、昇順）
+    """
+    if sum(hist) <= 0:
+        return pick_hue_centers_by_quantiles(hist, k)
+    runs = [
+        weighted_kmeans_1d(hist, init, period=360, iters=iters)
+        for init in (pick_hue_centers_by_quantiles(hist, k), maximin_centers_1d(hist, k, period=360))
+    ]
+    centers, _ = min(runs, key=lambda run: run[1])
+    return separate_hue_centers([int(round(c)) % 360 for c in centers])
+
+
+def kmeans_value_centers(hist, k=16, iters=KMEANS_MAX_ITERS):
+    """
+    Value ヒストグラム上の重み付き 1次元 k-means（初期値・戻り値は kmeans_hue_centers と同様）
+    """
+    if sum(hist) <= 0:
+        return pick_value_centers_by_quantiles(hist, k)
+    runs = [
+        weighted_kmeans_1d(hist, init, iters=iters)
+        for init in (pick_value_centers_by_quantiles(hist, k), maximin_centers_1d(hist, k))
+    ]
+    centers, _ = min(runs, key=lambda run: run[1])
+    return separate_value_centers([int(round(c)) for c in centers])
+
+
+def build_color_histogram_from_rgb(rgb, bits=COLOR_HIST_BITS, chunk_cols=ANALYSIS_CHUNK_COLS):
+    """
+    RGB 配列 (w, h, 3) -> 各チャンネルの上位 bits ビットで区切った 3次元ヒストグラム（平らな (2^bits)^3 個）
+    """
+    n = 1 << bits
+    hist = np.zeros(n ** 3, dtype=np.int64)
+    for x0 in range(0, rgb.shape[0], max(1, chunk_cols)):
+        q = (rgb[x0:x0 + chunk_cols] >> (8 - bits)).astype(np.int64)
+        idx = (q[..., 0] * n + q[..., 1]) * n + q[..., 2]
+        hist += np.bincount(idx.ravel(), minlength=n ** 3)
+    return hist
+
+
+def rgb_to_lab(rgb):
+    """
+    sRGB 0..255 (..., 3) -> CIE L*a*b*（D65）
+    """
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    m = np.array([
+        [0.4124, 0.3576, 0.1805],
+        [0.2126, 0.7152, 0.0722],
+        [0.0193, 0.1192, 0.9505],
+    ])
+    xyz = (c @ m.T) / np.array([0.95047, 1.0, 1.08883])
+    eps = (6.0 / 29.0) ** 3
+    f = np.where(xyz > eps, np.cbrt(xyz), xyz / (3 * (6.0 / 29.0) ** 2) + 4.0 / 29.0)
+    return np.stack([
+        116.0 * f[..., 1] - 16.0,
+        500.0 * (f[..., 0] - f[..., 1]),
+        200.0 * (f[..., 1] - f[..., 2]),
+    ], axis=-1)
+
+
+def build_palette(color_hist, k=8, bits=COLOR_HIST_BITS, iters=KMEANS_MAX_ITERS):
+    """
+    3次元カラーヒストグラム上の重み付き k-means（Lab 空間）で k 色のパレットを作る
+    - 初期値：一番重い bin から始め、「重み × 既存の center との距離²」が最大の bin を順に足す（乱数なし）
+    - 戻り値: [{"rgb": [r, g, b], "weight": 0..1}, ...]（重い順。色は割り当てた bin の重み付き平均）
+    """
+    hist = np.asarray(color_hist, dtype=np.float64)
+    nz = np.nonzero(hist)[0]
+    if len(nz) == 0:
+        return []
+    n = 1 << bits
+    step = 256 // n
+    rgb = np.stack([nz // (n * n), (nz // n) % n, nz % n], axis=-1) * step + (step - 1) / 2.0
+    w = hist[nz]
+    lab = rgb_to_lab(rgb)
+    k = max(1, min(k, len(nz)))
+
+    first = int(np.argmax(w))
+    centers = [lab[first]]
+    d2 = ((lab - lab[first]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        i = int(np.argmax(w * d2))
+        centers.append(lab[i])
+        d2 = np.minimum(d2, ((lab - lab[i]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    # 距離² = |x|² - 2 x・c + |c|²（|x|² は argmin に効かないので省く）
+    assign = None
+    for _ in range(max(1, iters)):
+        new_assign = np.argmin((centers * centers).sum(axis=1)[None, :] - 2.0 * (lab @ centers.T), axis=1)
+        if assign is not None and np.array_equal(new_assign, assign):
+            break
+        assign = new_assign
+        wsum = np.bincount(assign, weights=w, minlength=k)
+        moved = wsum > 0
+        for c in range(3):
+            centers[moved, c] = np.bincount(assign, weights=w * lab[:, c], minlength=k)[moved] / wsum[moved]
+
+    wsum = np.bincount(assign, weights=w, minlength=k)
+    sums = np.stack([np.bincount(assign, weights=w * rgb[:, c], minlength=k) for c in range(3)], axis=-1)
+    total = w.sum()
+    palette = []
+    for i in np.argsort(-wsum, kind="stable").tolist():
+        if wsum[i] <= 0:
+            continue
+        mean = sums[i] / wsum[i]
+        palette.append({"rgb": [int(round(v)) for v in mean], "weight": round(float(wsum[i] / total), 4)})
+    return palette
+
+
+# ============================================================
+# 4) OUTPUT
+# ============================================================
+def write_text_atomic(filepath, text):
+    """
+    同じフォルダの一時ファイルに書いてから置き換える
+    - 一時ファイルの名前は呼び出しごとに別（複数のスレッドが同時に書いても混ざらない）
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(filepath) + ".", suffix=".tmp", dir=os.path.dirname(filepath) or "."
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+        # mkstemp は 0600 で作るので、ふつうに open したファイルと同じ権限に戻す
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def save_as_max_table_line(values, filepath):
+    """
+    一時ファイルに書いてから置き換える（Max が書きかけの table 行を読まないように）
+    """
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    write_text_atomic(filepath, format_max_table_line(values))
+
+def format_max_table_line(values):
+    return "table " + " ".join(str(int(v)) for v in values) + "\n"
+
+def table_file_matches(values, filepath):
+    """
+    既存の txt が同じ内容なら True（書き直さずに使い回すため）
+    """
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            return f.read() == format_max_table_line(values)
+    except OSError:
+        return False
+
+# ============================================================
+# 5) ANALYSIS CACHE
+# ============================================================
+# キャッシュの形式を変えたら上げる（古いエントリは自然にヒットしなくなる）
+ANALYSIS_CACHE_VERSION = 1
+
+
+def hash_file(filepath, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def analysis_cache_key(image_path, params):
+    """
+    画像の中身(sha256) + 解析パラメータ から決まるキー
+    """
+    payload = json.dumps(
+        {"version": ANALYSIS_CACHE_VERSION, "image": hash_file(image_path), "params": params},
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_cached_analysis(cache_dir, key):
+    """
+    ヒットしたら {"hue_centers", "hue_map", "val_centers", "value_map"} を返す（無ければ None）
+    """
+    path = os.path.join(cache_dir, key + ".json")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get("version") != ANALYSIS_CACHE_VERSION:
+        return None
+    try:
+        # LRU 用に最終利用時刻を更新
+        os.utime(path, None)
+    except OSError:
+        pass
+    return entry.get("result")
+
+
+def store_cached_analysis(cache_dir, key, result, max_entries=16):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + ".json")
+    write_text_atomic(path, json.dumps({"version": ANALYSIS_CACHE_VERSION, "result": result}))
+    evict_analysis_cache(cache_dir, max_entries)
+
+
+def evict_analysis_cache(cache_dir, max_entries=16):
+    """
+    最終利用が古いものから消して max_entries 件に収める
+    """
+    try:
+        names = [n for n in os.listdir(cache_dir) if n.endswith(".json")]
+    except OSError:
+        return
+    paths = [os.path.join(cache_dir, n) for n in names]
+    paths.sort(key=lambda p: os.path.getmtime(p), reverse=True)
+    for p in paths[max(0, max_entries):]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def clear_analysis_cache(cache_dir):
+    evict_analysis_cache(cache_dir, max_entries=0)
@@ -0,0 +1,289 @@
+# klee_bench.py
+# 解析・サンプリング処理のベンチマーク（SDL の dummy ドライバで画面なしに動く）
+#
+#   python klee_bench.py                                 … 標準セット（0.3〜16 MP）
+#   python klee_bench.py --full                          … 50 / 100 MP も含める
+#   python klee_bench.py --save-baseline bench_baseline.json
+#   python klee_bench.py --compare bench_baseline.json   … 遅くなった項目があれば終了コード 1
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from klee_analysis import (
+    build_hue_histogram_from_surface,
+    build_value_histogram_from_surface,
+    build_histograms_from_surface,
+    pick_hue_centers_by_quantiles,
+    kmeans_hue_centers,
+    build_hue_to_bin_map,
+    pick_value_centers_by_quantiles,
+    kmeans_value_centers,
+    build_value_to_velocity_map_100,
+    build_color_histogram_from_rgb,
+    build_palette,
+    surface_to_rgb_array,
+    build_summed_area_table,
+    sat_grid_means,
+    sat_box_mean,
+    build_lookup_grid_from_rgb,
+    build_texture_grid,
+    build_label_grid,
+    merge_small_regions,
+    label_connected_regions,
+)
+from klee_perf import peak_rss_mb
+
+# ============================================================
+# 1) SETTINGS
+# ============================================================
+DEFAULT_SIZES_MP = [0.3, 1, 4, 16]
+FULL_SIZES_MP = [0.3, 1, 4, 16, 50, 100]
+HIST_STEPS = [1, 2, 4]
+HUE_KS = [9, 16, 32]
+VALUE_KS = [16, 32, 64]
+PALETTE_KS = [8, 16]
+
+SAMPLE_STEP_PX = 4
+SAMPLE_RADIUS_PX = 6
+SAMPLE_LOOKUPS = 20000
+REGION_MIN_CELLS = 16
+# --texture の質感（klee_main.py：静止画 2・動画のフレーム 4 ごとに間引く）
+TEXTURE_DECIMATES = [2, 4]
+
+# 回帰判定：基準より (1 + tolerance) 倍以上遅く、かつ NOISE_FLOOR_MS 以上の差があるもの
+DEFAULT_TOLERANCE = 0.25
+NOISE_FLOOR_MS = 0.5
+
+
+# ============================================================
+# 2) SYNTHETIC IMAGES
+# ============================================================
+def make_synthetic_surface(megapixels, seed=0):
+    """
+    絵画っぽい合成画像（色ブロック + グラデーション + ノイズ）を作る
+    - 縦横比 4:3、RGB 24bit（main.jpg を読み込んだときと同じく不透明）
+    """
+    w = max(16, int((megapixels * 1e6 * 4 / 3) ** 0.5))
+    h = max(12, int(w * 3 / 4))
+    rng = np.random.default_rng(seed)
+
+    block = max(8, w // 24)
+    bw, bh = (w + block - 1) // block, (h + block - 1) // block
+    palette = rng.integers(0, 256, (bw, bh, 3), dtype=np.uint8)
+    arr = np.repeat(np.repeat(palette, block, axis=0), block, axis=1)[:w, :h]
+
+    grad = np.linspace(-24, 24, h, dtype=np.float32)[None, :, None]
+    noise = rng.normal(0, 6, (w, 1, 3)).astype(np.float32)
+    arr = np.clip(arr.astype(np.float32) + grad + noise, 0, 255).astype(np.uint8)
+    return pygame.surfarray.make_surface(arr)
+
+
+# ============================================================
+# 3) MEASUREMENT
+# ============================================================
+def measure(fn, repeat=3, trace_memory=True):
+    """
+    fn を repeat 回実行して (中央値 ms, Python 側ピークメモリ KB, 最後の戻り値)
+    - 時間は tracemalloc なしで測り、メモリはその後の1回だけ tracemalloc 付きで測る
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - t0) * 1000)
+
+    peak = 0
+    if trace_memory:
+        result = None
+        tracemalloc.start()
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return statistics.median(times), peak / 1024, result
+
+
+def run_benchmarks(sizes_mp, repeat=3, log=print):
+    results = {}
+
+    def record(name, fn, rep=repeat):
+        ms, peak_kb, out = measure(fn, rep)
+        results[name] = {"time_ms": round(ms, 4), "peak_kb": round(peak_kb, 1)}
+        log(f"{name:<48} {ms:10.3f} ms   peak {peak_kb / 1024:8.1f} MB")
+        return out
+
+    for mp in sizes_mp:
+        surf = make_synthetic_surface(mp)
+        w, h = surf.get_size()
+        log(f"--- {mp} MP ({w}x{h}) ---")
+
+        hue_hist = val_hist = None
+        for step in HIST_STEPS:
+            tag = f"{mp}MP/step{step}"
+            hue_hist = record(f"{tag}/hue_histogram", lambda: build_hue_histogram_from_surface(surf, step=step))
+            val_hist = record(f"{tag}/value_histogram", lambda: build_value_histogram_from_surface(surf, step=step))
+            record(f"{tag}/histograms_1pass", lambda: build_histograms_from_surface(surf, step=step))
+
+        for k in HUE_KS:
+            centers = record(f"{mp}MP/k{k}/hue_centers", lambda: pick_hue_centers_by_quantiles(hue_hist, k=k))
+            record(f"{mp}MP/k{k}/hue_map", lambda: build_hue_to_bin_map(centers))
+            record(f"{mp}MP/k{k}/hue_kmeans", lambda: kmeans_hue_centers(hue_hist, k=k))
+        for k in VALUE_KS:
+            centers = record(f"{mp}MP/k{k}/value_centers", lambda: pick_value_centers_by_quantiles(val_hist, k=k))
+            record(f"{mp}MP/k{k}/value_map", lambda: build_value_to_velocity_map_100(centers))
+            record(f"{mp}MP/k{k}/value_kmeans", lambda: kmeans_value_centers(val_hist, k=k))
+
+        # 代表色：ヒストグラム作りは画素数に比例、クラスタリングは bin の数だけ
+        rgb = surface_to_rgb_array(surf, step=HIST_STEPS[-1])
+        color_hist = record(f"{mp}MP/step{HIST_STEPS[-1]}/color_histogram", lambda: build_color_histogram_from_rgb(rgb))
+        rgb = None
+        for k in PALETTE_KS:
+            record(f"{mp}MP/k{k}/palette", lambda: build_palette(color_hist, k=k))
+
+        # サンプリング：起動時の前計算と、1フレームあたりの引き当て
+        sat = record(f"{mp}MP/sat_build", lambda: build_summed_area_table(surface_to_rgb_array(surf)), rep=1)
+        grid_rgb, grid_hsv = record(
+            f"{mp}MP/grid_build",
+            lambda: build_lookup_grid_from_rgb(sat_grid_means(sat, SAMPLE_STEP_PX, SAMPLE_RADIUS_PX)),
+            rep=1
+        )
+        rgb = surface_to_rgb_array(surf)
+        for d in TEXTURE_DECIMATES:
+            record(
+                f"{mp}MP/texture_build_d{d}",
+                lambda: build_texture_grid(rgb[::d, ::d], SAMPLE_STEP_PX // d, max(1, SAMPLE_RADIUS_PX // d)),
+                rep=1
+            )
+        rgb = None
+
+        # 音のラベル + 色面（--send-on label / region の前計算）
+        hue_map = build_hue_to_bin_map(pick_hue_centers_by_quantiles(hue_hist, k=HUE_KS[0]))
+        value_map = build_value_to_velocity_map_100(pick_value_centers_by_quantiles(val_hist, k=VALUE_KS[0]))
+        record(
+            f"{mp}MP/region_build",
+            lambda: label_connected_regions(
+                merge_small_regions(build_label_grid(grid_hsv, hue_map, value_map), REGION_MIN_CELLS)
+            ),
+            rep=1
+        )
+
+        rnd = random.Random(0)
+        points = [(rnd.randrange(w), rnd.randrange(h)) for _ in range(SAMPLE_LOOKUPS)]
+        gw, gh = grid_rgb.shape[0], grid_rgb.shape[1]
+
+        def grid_lookups():
+            for x, y in points:
+                cx = min(gw - 1, x // SAMPLE_STEP_PX)
+                cy = min(gh - 1, y // SAMPLE_STEP_PX)
+                grid_rgb[cx, cy].tolist()
+                grid_hsv[cx, cy].tolist()
+
+        def sat_lookups(radius):
+            for x, y in points:
+                sat_box_mean(sat, x, y, radius)
+
+        ms, _, _ = measure(grid_lookups, repeat, trace_memory=False)
+        results[f"{mp}MP/sample_grid_per_lookup"] = {"time_ms": round(ms / SAMPLE_LOOKUPS, 6), "peak_kb": 0.0}
+        log(f"{mp}MP/sample_grid_per_lookup{'':<21} {ms * 1000 / SAMPLE_LOOKUPS:10.3f} us")
+        for radius in (2, SAMPLE_RADIUS_PX, 32):
+            ms, _, _ = measure(lambda: sat_lookups(radius), repeat, trace_memory=False)
+            results[f"{mp}MP/sample_sat_r{radius}_per_lookup"] = {"time_ms": round(ms / SAMPLE_LOOKUPS, 6), "peak_kb": 0.0}
+            log(f"{mp}MP/sample_sat_r{radius}_per_lookup{'':<19} {ms * 1000 / SAMPLE_LOOKUPS:10.3f} us")
+
+        # 次の大きさを作る前に手放す（del だとラムダが参照する名前が消えて見える）
+        surf = sat = grid_rgb = grid_hsv = None
+
+    return results
+
+
+# ============================================================
+# 4) BASELINE / REGRESSION CHECK
+# ============================================================
+def environment_info():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pygame": pygame.version.ver,
+        "machine": platform.machine(),
+        "system": platform.system(),
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    基準より遅くなった項目のリスト [(name, base_ms, now_ms), ...]
+    """
+    regressions = []
+    for name, now in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        base_ms, now_ms = base["time_ms"], now["time_ms"]
+        # 1回あたりの値 (per_lookup) はノイズ下限を µs 単位で見る
+        floor = NOISE_FLOOR_MS / 1000 if name.endswith("_per_lookup") else NOISE_FLOOR_MS
+        if now_ms > base_ms * (1 + tolerance) and now_ms - base_ms > floor:
+            regressions.append((name, base_ms, now_ms))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Klee Color Visualizer benchmarks")
+    parser.add_argument("--full", action="store_true", help="50 / 100 MP も測る")
+    parser.add_argument("--sizes", help="MP をカンマ区切りで指定（例: 0.3,4,16）")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save-baseline", metavar="PATH")
+    parser.add_argument("--compare", metavar="PATH")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    if args.sizes:
+        sizes = [float(v) for v in args.sizes.split(",")]
+    else:
+        sizes = FULL_SIZES_MP if args.full else DEFAULT_SIZES_MP
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+
+    results = run_benchmarks(sizes, repeat=args.repeat)
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"peak RSS: {rss:.1f} MB")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump({"env": environment_info(), "results": results}, f, indent=1, sort_keys=True)
+        print("✅ baseline saved:", args.save_baseline)
+
+    status = 0
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("env") != environment_info():
+            print("⚠️ baseline was recorded on a different environment:", baseline.get("env"))
+        regressions = compare_to_baseline(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print(f"❌ {len(regressions)} regression(s) (> +{args.tolerance * 100:.0f}%):")
+            for name, base_ms, now_ms in regressions:
+                print(f"   {name}: {base_ms:.4f} ms -> {now_ms:.4f} ms ({now_ms / base_ms:.2f}x)")
+            status = 1
+        else:
+            print("✅ no regressions against", args.compare)
+
+    pygame.quit()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,436 @@
+# klee_image.py
+# 作品画像の読み込み（巨大なスキャン画像でもメモリを抑えて表示サイズまで縮小する）
+# と、拡大表示用の画像ピラミッド
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pygame
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# ============================================================
+# 1) DISPLAY IMAGE
+# ============================================================
+# これより大きい画像は Pillow で「縮小デコード → 帯ごとに縮小」する
+# （小さい画像は従来どおり pygame で丸ごと読む）
+TILED_LOAD_MIN_MP = 40
+# 縮小デコード後の画像 + 帯1本分に使ってよいメモリの目安
+DEFAULT_LOAD_BUDGET_MB = 256
+# 表示サイズの何倍の解像度でデコードするか（縮小の画質用）
+DECODE_OVERSAMPLE = 2
+
+
+def read_image_size(path):
+    """
+    画素をデコードせずに (w, h) を読む。Pillow が無ければ None
+    """
+    if Image is None:
+        return None
+    with Image.open(path) as im:
+        return im.size
+
+
+def decoded_bytes(size):
+    # Pillow の RGB は 1画素 4byte で持つ
+    return size[0] * size[1] * 4
+
+
+def load_display_image(path, fit_size, budget_mb=DEFAULT_LOAD_BUDGET_MB):
+    """
+    画像を読み込み、fit_size(img_w, img_h) -> (w, h) の大きさに縮小した Surface を返す
+    - 戻り値: (surface, info)  info = {"source_size", "decode_size", "loader", "strips"}
+    - 元画像が TILED_LOAD_MIN_MP 以上で Pillow があれば load_display_image_tiled を使う
+    - 不透明な写真なので convert_alpha() はせず convert() する
+    """
+    src_size = read_image_size(path)
+    if src_size is not None and src_size[0] * src_size[1] >= TILED_LOAD_MIN_MP * 1e6:
+        return load_display_image_tiled(path, fit_size(*src_size), budget_mb)
+
+    raw = pygame.image.load(path)
+    info = {"source_size": raw.get_size(), "decode_size": raw.get_size(), "loader": "pygame", "strips": 1}
+    size = fit_size(*raw.get_size())
+    # smoothscale は 32bit のほうが速い（24bit のまま縮小すると結果も少し変わる）
+    raw = raw.convert()
+    scaled = pygame.transform.smoothscale(raw, size)
+    del raw
+    return scaled, info
+
+
+def load_display_image_tiled(path, size, budget_mb=DEFAULT_LOAD_BUDGET_MB):
+    """
+    巨大画像を元の解像度のまま展開せずに、表示サイズ size の Surface を作る
+    - JPEG はデコード時に 1/2・1/4・1/8 へ縮小できる（Pillow の draft）ので、
+      表示サイズの DECODE_OVERSAMPLE 倍を下回らない範囲でいちばん小さくデコードする
+    - そこから出力を横帯に分け、帯ごとに面積平均(BOX)で縮小して配列へ書き込む
+      （帯の高さは budget_mb の残りから決める）
+    """
+    out_w, out_h = size
+    budget = budget_mb * 1024 * 1024
+
+    with Image.open(path) as im:
+        src_size = im.size
+        im.draft("RGB", (out_w * DECODE_OVERSAMPLE, out_h * DECODE_OVERSAMPLE))
+        dec_w, dec_h = im.size
+        if decoded_bytes(im.size) > budget:
+            print(
+                f"⚠️ decoded image {dec_w}x{dec_h} ({decoded_bytes(im.size) / 2**20:.0f} MB) "
+                f"exceeds the load budget ({budget_mb} MB)"
+            )
+        im = im.convert("RGB") if im.mode != "RGB" else im
+        im.load()
+
+        # 帯1本 = 元画像側の行 + 出力側の行（どちらも RGB）
+        remaining = max(budget - decoded_bytes(im.size), 4 * 1024 * 1024)
+        row_bytes = (dec_w * dec_h / out_h + out_w) * 4
+        band_h = int(max(1, min(out_h, remaining // max(1, row_bytes))))
+
+        out = np.empty((out_w, out_h, 3), dtype=np.uint8)
+        sy_per_row = dec_h / out_h
+        strips = 0
+        for y0 in range(0, out_h, band_h):
+            y1 = min(out_h, y0 + band_h)
+            box = (0, y0 * sy_per_row, dec_w, y1 * sy_per_row)
+            band = im.resize((out_w, y1 - y0), Image.BOX, box=box)
+            out[:, y0:y1] = np.asarray(band).transpose(1, 0, 2)
+            strips += 1
+            del band
+
+    surf = pygame.surfarray.make_surface(out)
+    del out
+    info = {"source_size": src_size, "decode_size": (dec_w, dec_h), "loader": "tiled", "strips": strips}
+    return surf.convert(), info
+
+
+# ============================================================
+# 2) IMAGE PYRAMID (拡大表示・高解像度サンプリング用)
+# ============================================================
+# レベル 0 が基準解像度、レベル k は 1/2^k。各レベルを PYRAMID_TILE px 角のタイルに
+# 分けて .npy でディスクに置き、表示やサンプリングで必要になったタイルだけ読む
+PYRAMID_TILE = 256
+# タイルの形式を変えたら上げる（古いピラミッドは作り直しになる）
+PYRAMID_VERSION = 1
+DEFAULT_TILE_CACHE_TILES = 192
+
+
+def base_level_size(src_size, max_pixels):
+    """
+    レベル 0 の大きさ：元画像が max_pixels に収まればそのまま、超えるときはその画素数まで縮めた大きさ
+    """
+    src_w, src_h = src_size
+    if src_w * src_h <= max_pixels:
+        return src_w, src_h
+    scale = (max_pixels / float(src_w * src_h)) ** 0.5
+    return max(1, int(src_w * scale)), max(1, int(src_h * scale))
+
+
+def pyramid_level_sizes(size, min_size):
+    """
+    各レベルの (w, h)。min_size (w, h) 以下になったレベルで止める（表示サイズを渡す）
+    """
+    levels = [tuple(size)]
+    while True:
+        w, h = levels[-1]
+        if (w <= min_size[0] and h <= min_size[1]) or w < 2 or h < 2:
+            return levels
+        levels.append((w // 2, h // 2))
+
+
+def downsample_2x(rgb):
+    """
+    2x2 画素の平均で半分の大きさにする（端の奇数行・列は捨てる）
+    """
+    w, h = rgb.shape[0] // 2 * 2, rgb.shape[1] // 2 * 2
+    a = rgb[:w, :h].astype(np.uint16)
+    total = a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]
+    return ((total + 2) // 4).astype(np.uint8)
+
+
+def write_pyramid_strips(strips, size, out_dir, min_size, source_size=None, tile=PYRAMID_TILE):
+    """
+    上から順の横帯 (w, 行数, 3) を受け取り、タイルの行がそろうたびに書き出しながらピラミッドを作る
+    - 下のレベルも帯を 2x2 で縮めて同じように積むので、どのレベルも画像全体を持たない
+      （持つのは各レベルの書きかけのタイル1行分と、縮めるときに余った1行だけ）
+    - 一時ディレクトリに書いてから rename するので、途中で落ちても壊れたものは残らない
+    """
+    tmp_dir = out_dir + ".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    levels = pyramid_level_sizes(size, min_size)
+    pending = [np.empty((w, 0, 3), dtype=np.uint8) for w, _ in levels]
+    carry = [np.empty((w, 0, 3), dtype=np.uint8) for w, _ in levels]
+    tile_rows = [0] * len(levels)
+
+    def write_tile_row(k, rows):
+        ty = tile_rows[k]
+        for tx in range(0, (rows.shape[0] + tile - 1) // tile):
+            block = np.ascontiguousarray(rows[tx * tile:(tx + 1) * tile])
+            np.save(os.path.join(tmp_dir, f"L{k}_{tx}_{ty}.npy"), block)
+        tile_rows[k] += 1
+
+    def feed(k, rows):
+        buf = np.concatenate([pending[k], rows], axis=1)
+        while buf.shape[1] >= tile:
+            write_tile_row(k, buf[:, :tile])
+            buf = buf[:, tile:]
+        pending[k] = buf
+        if k + 1 < len(levels):
+            both = np.concatenate([carry[k], rows], axis=1)
+            even = both.shape[1] // 2 * 2
+            carry[k] = both[:, even:].copy()
+            if even:
+                feed(k + 1, downsample_2x(both[:, :even]))
+
+    fed = 0
+    for strip in strips:
+        feed(0, strip[:levels[0][0]])
+        fed += strip.shape[1]
+    if fed != levels[0][1]:
+        raise ValueError(f"pyramid strips cover {fed} rows, expected {levels[0][1]}")
+    # 最後のタイル行（tile に満たない分）
+    for k in range(len(levels)):
+        if pending[k].shape[1]:
+            write_tile_row(k, pending[k])
+
+    meta = {
+        "version": PYRAMID_VERSION,
+        "tile": tile,
+        "levels": [list(v) for v in levels],
+        "source_size": list(source_size or levels[0]),
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+
+
+def array_strips(rgb, rows=PYRAMID_TILE):
+    for y0 in range(0, rgb.shape[1], rows):
+        yield rgb[:, y0:y0 + rows]
+
+
+def build_pyramid(rgb, out_dir, min_size, source_size=None, tile=PYRAMID_TILE):
+    """
+    rgb (w, h, 3) からピラミッドを作り out_dir に書き出す（write_pyramid_strips に帯で渡す）
+    """
+    write_pyramid_strips(array_strips(rgb, tile), rgb.shape[:2], out_dir, min_size, source_size, tile)
+
+
+def image_strips(im, rows=PYRAMID_TILE):
+    """
+    Pillow の画像を上から rows 行ずつの RGB 配列 (w, rows, 3) にして返す（RGB への変換も帯ごと）
+    """
+    w, h = im.size
+    for y0 in range(0, h, rows):
+        band = im.crop((0, y0, w, min(h, y0 + rows)))
+        if band.mode != "RGB":
+            band = band.convert("RGB")
+        yield np.asarray(band).transpose(1, 0, 2)
+        del band
+
+
+def build_pyramid_from_file(path, out_dir, min_size, max_pixels):
+    """
+    画像ファイルからピラミッドを作る
+    - Pillow があれば、デコードした画像から帯を切り出して書き出す。レベル 0 は元画像の解像度
+      （デコード結果の 4 byte/画素 が max_pixels を決める。それを超える画像だけ縮小デコードして縮める）
+    - Pillow が無ければ pygame で丸ごと読む
+    """
+    src_size = read_image_size(path)
+    if src_size is not None:
+        size = base_level_size(src_size, max_pixels)
+        with Image.open(path) as im:
+            if size != src_size:
+                im.draft("RGB", size)
+                im = im.resize(size, Image.BOX) if im.size != size else im
+            im.load()
+            write_pyramid_strips(image_strips(im), size, out_dir, min_size, source_size=src_size)
+        return
+
+    surf = pygame.image.load(path)
+    src_size = surf.get_size()
+    size = base_level_size(src_size, max_pixels)
+    if size != src_size:
+        surf = pygame.transform.smoothscale(surf, size)
+    rgb = pygame.surfarray.array3d(surf)
+    del surf
+    build_pyramid(rgb, out_dir, min_size, source_size=src_size)
+
+
+def build_pyramid_in_subprocess(path, out_dir, min_size, max_pixels):
+    """
+    build_pyramid_from_file を優先度を下げた別プロセスで行う
+    （同じプロセスのスレッドだと、大きな画像では描画と GIL を取り合ってフレームが遅れる）
+    """
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "pyramid",
+        path, out_dir, str(min_size[0]), str(min_size[1]), str(int(max_pixels)),
+    ]
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"pyramid builder exited with {proc.returncode}")
+
+
+def evict_pyramid_cache(cache_dir, max_entries=4):
+    """
+    最終利用が古いピラミッドから消して max_entries 個に収める
+    """
+    try:
+        names = [n for n in os.listdir(cache_dir) if os.path.isfile(os.path.join(cache_dir, n, "meta.json"))]
+    except OSError:
+        return
+    paths = [os.path.join(cache_dir, n) for n in names]
+    paths.sort(key=lambda p: os.path.getmtime(os.path.join(p, "meta.json")), reverse=True)
+    for p in paths[max(0, max_entries):]:
+        shutil.rmtree(p, ignore_errors=True)
+
+
+class ImagePyramid:
+    """
+    ディスク上のピラミッドをタイル単位で読み、直近 cache_tiles 枚を LRU で持つ
+    - 描画もサンプリングもメインスレッドから呼ぶ前提
+    """
+
+    def __init__(self, root, meta, cache_tiles=DEFAULT_TILE_CACHE_TILES):
+        self.root = root
+        self.tile_size = meta["tile"]
+        self.levels = [tuple(v) for v in meta["levels"]]
+        self.source_size = tuple(meta["source_size"])
+        self.cache_tiles = cache_tiles
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.load_time = 0.0
+
+    @classmethod
+    def open(cls, root, cache_tiles=DEFAULT_TILE_CACHE_TILES):
+        """
+        作成済みなら ImagePyramid、無い・形式が古いなら None
+        """
+        meta_path = os.path.join(root, "meta.json")
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if meta.get("version") != PYRAMID_VERSION:
+            return None
+        try:
+            # LRU 用に最終利用時刻を更新
+            os.utime(meta_path, None)
+        except OSError:
+            pass
+        return cls(root, meta, cache_tiles)
+
+    def level_for_width(self, display_w):
+        """
+        画像全体を display_w px で描くときに使うレベル
+        - 表示の画素数を下回らない範囲でいちばん粗いレベル（足りなければレベル 0）
+        """
+        for k in range(len(self.levels) - 1, -1, -1):
+            if self.levels[k][0] >= display_w:
+                return k
+        return 0
+
+    def tile(self, level, tx, ty):
+        """
+        タイル (level, tx, ty) -> (RGB 配列, Surface)
+        """
+        key = (level, tx, ty)
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        t0 = time.perf_counter()
+        rgb = np.load(os.path.join(self.root, f"L{level}_{tx}_{ty}.npy"))
+        entry = (rgb, pygame.surfarray.make_surface(rgb).convert())
+        self.load_time += time.perf_counter() - t0
+
+        self.cache[key] = entry
+        while len(self.cache) > self.cache_tiles:
+            self.cache.popitem(last=False)
+        return entry
+
+    def tiles_in(self, level, x0, y0, x1, y1):
+        """
+        レベル座標の範囲 [x0, x1) x [y0, y1) にかかるタイルを (tx, ty, ox, oy) で列挙
+        """
+        t = self.tile_size
+        for tx in range(x0 // t, (x1 - 1) // t + 1):
+            for ty in range(y0 // t, (y1 - 1) // t + 1):
+                yield tx, ty, tx * t, ty * t
+
+    def read_region(self, level, x0, y0, x1, y1):
+        """
+        レベル座標の範囲 [x0, x1) x [y0, y1) の RGB 配列（範囲はレベル内に収めて渡す）
+        """
+        out = np.empty((x1 - x0, y1 - y0, 3), dtype=np.uint8)
+        t = self.tile_size
+        for tx, ty, ox, oy in self.tiles_in(level, x0, y0, x1, y1):
+            rgb, _ = self.tile(level, tx, ty)
+            sx0, sy0 = max(x0, ox), max(y0, oy)
+            sx1, sy1 = min(x1, ox + t), min(y1, oy + t)
+            out[sx0 - x0:sx1 - x0, sy0 - y0:sy1 - y0] = rgb[sx0 - ox:sx1 - ox, sy0 - oy:sy1 - oy]
+        return out
+
+    def box_mean(self, level, x, y, radius):
+        """
+        sat_box_mean と同じ丸めで、レベル座標 (x, y) を中心とする正方形の平均色
+        """
+        w, h = self.levels[level]
+        x0 = max(0, x - radius)
+        y0 = max(0, y - radius)
+        x1 = min(w, x + radius + 1)
+        y1 = min(h, y + radius + 1)
+        n = (x1 - x0) * (y1 - y0)
+        total = self.read_region(level, x0, y0, x1, y1).sum(axis=(0, 1), dtype=np.int64).tolist()
+        half = n // 2
+        return ((total[0] + half) // n, (total[1] + half) // n, (total[2] + half) // n)
+
+    def render_region(self, level, x0, y0, x1, y1):
+        """
+        レベル座標の範囲 [x0, x1) x [y0, y1) を1枚の Surface に並べる
+        """
+        surf = pygame.Surface((x1 - x0, y1 - y0)).convert()
+        for tx, ty, ox, oy in self.tiles_in(level, x0, y0, x1, y1):
+            _, tile_surf = self.tile(level, tx, ty)
+            surf.blit(tile_surf, (ox - x0, oy - y0))
+        return surf
+
+    def stats(self):
+        return {
+            "levels": len(self.levels),
+            "cached_tiles": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "load_ms": self.load_time * 1000,
+        }
+
+
+if __name__ == "__main__":
+    # build_pyramid_in_subprocess から呼ばれる
+    #   python klee_image.py pyramid <image> <out_dir> <min_w> <min_h> <max_pixels>
+    if len(sys.argv) == 7 and sys.argv[1] == "pyramid":
+        if hasattr(os, "nice"):
+            os.nice(10)
+        build_pyramid_from_file(sys.argv[2], sys.argv[3], (int(sys.argv[4]), int(sys.argv[5])), int(sys.argv[6]))
+    else:
+        print("usage: python klee_image.py pyramid <image> <out_dir> <min_w> <min_h> <max_pixels>")
+        sys.exit(2)
@@ -1,9 +1,69 @@
 # klee_main.py
+import time
+
+# 起動時間の基準（time-to-first-frame 計測用）
+PROCESS_T0 = time.perf_counter()
+
 import pygame
 import sys
 import os
-from colorsys import rgb_to_hsv
-from pythonosc import udp_client
+import math
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from klee_analysis import (
+    build_histograms_from_rgb,
+    decay_histogram,
+    build_color_histogram_from_rgb,
+    build_lookup_grid_from_rgb,
+    build_label_grid,
+    label_connected_regions,
+    merge_small_regions,
+    musical_label,
+    interpolate_path,
+    build_summed_area_table,
+    sat_box_mean,
+    sat_grid_means,
+    build_texture_grid,
+    surface_to_rgb_array,
+    rgb_to_hsv_quantized,
+    pick_hue_centers_by_quantiles,
+    kmeans_hue_centers,
+    build_hue_to_bin_map,
+    pick_value_centers_by_quantiles,
+    kmeans_value_centers,
+    build_value_to_velocity_map_100,
+    build_palette,
+    save_as_max_table_line,
+    table_file_matches,
+    analysis_cache_key,
+    load_cached_analysis,
+    store_cached_analysis,
+    clear_analysis_cache,
+)
+from klee_osc import OscSender
+from klee_sonify import (
+    SonifyProcess,
+    make_ring_rows,
+    should_send_color,
+    RING_KIND_POS,
+    RING_KIND_COLOR,
+    RING_KIND_RELEASE,
+    RING_FLAG_ENTER,
+)
+from klee_image import (
+    load_display_image,
+    DEFAULT_LOAD_BUDGET_MB,
+    build_pyramid_in_subprocess,
+    evict_pyramid_cache,
+    ImagePyramid,
+    DEFAULT_TILE_CACHE_TILES,
+)
+from klee_stream import open_frame_reader, FrameStream
+from klee_perf import FrameProfiler, format_hud_lines, FRAME_STAGES, peak_rss_mb, read_energy_j
 
 # ============================================================
 # 1) PATH SETUP
@@ -15,12 +75,85 @@ IMAGE_MAIN_DIR = os.path.join(BASE_DIR, "Image_Main")
 # txtの出力先：maxパッチと同じ階層（= BASE_DIR 直下）
 TXT_OUT_DIR = BASE_DIR
 
+# 解析結果のキャッシュ（画像ハッシュ + 解析パラメータ単位）
+ANALYSIS_CACHE_DIR = os.path.join(BASE_DIR, ".klee_cache")
+# 拡大表示用の画像ピラミッド（タイル）
+PYRAMID_CACHE_DIR = os.path.join(ANALYSIS_CACHE_DIR, "pyramid")
+
+# ============================================================
+# 1.5) RUN MODE (通常 / 軌跡の記録 / ヘッドレス再生)
+# ============================================================
+#   python klee_main.py --record trace.csv
+#       … 通常どおり起動し、フレームごとのカーソル位置・クリックと、届いた移動・タッチのイベントを記録する
+#   python klee_main.py --replay trace.csv [--realtime] [--size 1440x900] [--osc-log out.jsonl]
+#       … 画面を出さずに軌跡を再生し、同じ状態遷移で OSC を送る（既定は最速、--realtime で実時間）
+def arg_value(name, default=None):
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+#   --perf-hud             … 区間ごとの処理時間 HUD を表示した状態で起動（F3 で切り替え）
+#   --perf-log perf.jsonl  … 区間ごとのパーセンタイルを1秒ごとに JSON Lines で追記
+#   --perf-osc             … 同じ値を /perf/<区間> [p50, p95, p99] として OSC でも送る
+REPLAY_PATH = arg_value("--replay")
+RECORD_PATH = arg_value("--record")
+REPLAY_REALTIME = "--realtime" in sys.argv
+REPLAY_SIZE = arg_value("--size", "1440x900")
+OSC_LOG_PATH = arg_value("--osc-log")
+PERF_HUD_AT_START = "--perf-hud" in sys.argv
+PERF_LOG_PATH = arg_value("--perf-log")
+PERF_OSC = "--perf-osc" in sys.argv
+HEADLESS = REPLAY_PATH is not None
+
+if HEADLESS:
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
 # ============================================================
 # 2) OSC SETUP
 # ============================================================
 OSC_IP = "127.0.0.1"
 OSC_PORT = 8000
-client = udp_client.SimpleUDPClient(OSC_IP, OSC_PORT)
+# 1フレーム分のメッセージを1つの OSC bundle にまとめて送る（False なら1通ずつ）
+OSC_USE_BUNDLES = True
+# 予定送信：色を読んだ時刻（フレームの途中の点はその点の時刻）から OSC_LATENCY_MS 後に
+# 送信スレッドが時刻どおりに送り、bundle にはその時刻の NTP タイムタグを付ける
+#   python klee_main.py --osc-latency 40
+# フレームの間隔より長くすること（短いと間に合わなかった分はすぐ送り、終了時に数を表示）
+OSC_LATENCY_MS = arg_value("--osc-latency")
+if OSC_LATENCY_MS is not None:
+    try:
+        OSC_LATENCY_MS = float(OSC_LATENCY_MS)
+    except ValueError:
+        print(f"⚠️ --osc-latency {OSC_LATENCY_MS} is not a number; sending immediately")
+        OSC_LATENCY_MS = None
+if OSC_LATENCY_MS is not None and HEADLESS and not REPLAY_REALTIME:
+    print("⚠️ --osc-latency needs --realtime in headless replay; sending immediately")
+    OSC_LATENCY_MS = None
+# 送信は別スレッド。描画ループは client.flush() でフレーム分を渡すだけ
+# （ヘッドレス再生ではフレームごとの bundle をまとめずにそのまま送る）
+client = OscSender(
+    OSC_IP, OSC_PORT,
+    use_bundles=OSC_USE_BUNDLES,
+    max_queue=None if HEADLESS else 64,
+    merge_backlog=not HEADLESS,
+    log_path=OSC_LOG_PATH,
+    latency=OSC_LATENCY_MS / 1000.0 if OSC_LATENCY_MS is not None else None
+)
+
+# Hue / Value テーブルの渡し方
+#   既定：Hue.txt / Value.txt に書き出してから /txt 1 を送り、Max が txt を読み直す
+#   --osc-tables      … テーブルそのものを OSC でも送る（int の列、先頭は版数）
+#                         /table/hue   [version, hue_map(360個)]
+#                         /table/value [version, value_map(100個)]
+#   --no-table-files  … txt の書き出しと /txt をやめる（--osc-tables と一緒に使う）
+TABLES_OSC = "--osc-tables" in sys.argv
+TABLE_FILES = "--no-table-files" not in sys.argv
+if not TABLE_FILES and not TABLES_OSC:
+    print("⚠️ --no-table-files needs --osc-tables; writing Hue.txt / Value.txt anyway")
+    TABLE_FILES = True
 
 # ============================================================
 # 3) PYGAME INIT
@@ -28,7 +161,10 @@ client = udp_client.SimpleUDPClient(OSC_IP, OSC_PORT)
 pygame.init()
 pygame.font.init()
 
-screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+if HEADLESS:
+    screen = pygame.display.set_mode(tuple(int(v) for v in REPLAY_SIZE.lower().split("x")))
+else:
+    screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
 SCREEN_W, SCREEN_H = screen.get_size()
 pygame.display.set_caption("Klee Color Visualizer")
 
@@ -47,19 +183,154 @@ FONT_TITLE = pygame.font.SysFont("Arial", s(32), bold=True)
 FONT_BIG = pygame.font.SysFont("Arial", s(28), bold=True)
 FONT_SMALL = pygame.font.SysFont("Arial", s(20))
 FONT_LABEL = pygame.font.SysFont("Arial", s(20), bold=True)
+FONT_HUD = pygame.font.SysFont("Menlo,Consolas,Courier New,monospace", s(14))
 
 # ============================================================
 # 5) SMOOTHING / THRESHOLD SETTINGS
 # ============================================================
 SAMPLE_STEP_PX = 4
 RGB_DELTA_THRESHOLD = 14
+# Hue/Value 解析用のぼかし（縮小→拡大）。カーソルの色読み取りには使わない
 BLUR_DOWNSCALE = 12
 
+# カーソル位置の色 = 一辺 2*SAMPLE_RADIUS_PX+1 の正方形の平均（積分画像で O(1)）
+SAMPLE_RADIUS_PX = 6
+SAMPLE_RADIUS_MAX_PX = 32
+# カーソル速度(px/frame) に応じて半径を広げる係数（0 で固定半径）
+SAMPLE_RADIUS_SPEED_GAIN = 0.0
+
 # ============================================================
 # 6) OSC RATE LIMIT SETTINGS
 # ============================================================
 OSC_MIN_INTERVAL_MS = 50
 
+# /rgb・/hsv を送るきっかけ
+#   color  … 前回送った色から RGB_DELTA_THRESHOLD 以上変わったとき（既定）
+#   label  … Max 側で音が変わる色（和音クラス・オクターブ・velocity のどれか）に入ったとき
+#   region … label に加えて、同じ音でも離れた別の色面に入ったとき
+#   python klee_main.py --send-on label
+SEND_ON_MODES = ("color", "label", "region")
+SEND_ON = arg_value("--send-on", "color")
+if SEND_ON not in SEND_ON_MODES:
+    print(f"⚠️ --send-on {SEND_ON} is not one of {SEND_ON_MODES}; using color")
+    SEND_ON = "color"
+# label / region で使う色面は、REGION_MIN_CELLS セル（1セル = SAMPLE_STEP_PX 四方）より小さいものを
+# 隣の大きな色面に取り込んでおく（筆致の細かな揺れで境目を越え続けないように）
+REGION_MIN_CELLS = 16
+
+# 色の判定と /rgb・/hsv（/p/<番号>/...）の送信を別プロセス（klee_sonify.py のワーカー）で行う
+# 描画側はカーソル・指の通り道の点を共有メモリのリングに積むだけなので、
+# 重いフレーム（作品の切り替え・拡大表示の描画）があっても音の側の送信は遅れない
+#   python klee_main.py --sonify-process
+SONIFY_PROCESS = "--sonify-process" in sys.argv
+if SONIFY_PROCESS and HEADLESS:
+    # ヘッドレス再生はフレームごとに送信を確かめるので、同じプロセスで送る
+    print("⚠️ --sonify-process is ignored in headless replay")
+    SONIFY_PROCESS = False
+
+# ============================================================
+# 6.5) ANALYSIS SETTINGS (Hue.txt / Value.txt)
+# ============================================================
+ANALYSIS_STEP = 2
+HUE_K = 9
+HUE_MIN_S = 0.12
+HUE_MIN_V = 0.10
+VALUE_K = 16
+VALUE_MIN_V = 0.02
+
+# 代表値の選び方
+#   quantile … Hue / Value それぞれの分位点（既定）
+#   kmeans   … ヒストグラム上の重み付き k-means（Hue は円環）。bin の数だけで計算が済む
+CENTER_METHODS = ("quantile", "kmeans")
+CENTER_METHOD = "quantile"
+# 作品の代表色（Lab 空間で RGB 16^3 ヒストグラムをクラスタリング）の数
+PALETTE_K = 8
+
+# klee_params.json があれば上の値（と BLUR_DOWNSCALE）を上書きする。実行中に書き換えても反映される
+#   {"hue_k": 12, "value_k": 24, "blur_downscale": 8, "centers": "kmeans"}
+# 読み込んだ値は (世代, AnalysisParams) の組 analysis_snapshot として1回で差し替える。
+# 解析は始めるときにこの組を1つ取り、最後までその値だけを使う（途中で読み直されても混ざらない）
+ANALYSIS_PARAMS_PATH = os.path.join(BASE_DIR, "klee_params.json")
+ANALYSIS_PARAM_NAMES = {
+    "step": "ANALYSIS_STEP",
+    "hue_k": "HUE_K",
+    "hue_min_s": "HUE_MIN_S",
+    "hue_min_v": "HUE_MIN_V",
+    "value_k": "VALUE_K",
+    "value_min_v": "VALUE_MIN_V",
+    "blur_downscale": "BLUR_DOWNSCALE",
+    "centers": "CENTER_METHOD",
+    "palette_k": "PALETTE_K",
+}
+ANALYSIS_PARAM_DEFAULTS = {key: globals()[name] for key, name in ANALYSIS_PARAM_NAMES.items()}
+# 数値の項目が取れる範囲 (最小, 最大)。None は上限なし
+ANALYSIS_PARAM_RANGES = {
+    "step": (1, None),
+    "hue_k": (1, None),
+    "hue_min_s": (0.0, 1.0),
+    "hue_min_v": (0.0, 1.0),
+    "value_k": (1, None),
+    "value_min_v": (0.0, 1.0),
+    "blur_downscale": (1, None),
+    "palette_k": (1, None),
+}
+AnalysisParams = namedtuple("AnalysisParams", list(ANALYSIS_PARAM_NAMES))
+analysis_snapshot = None
+
+def check_analysis_params(values):
+    """
+    範囲外の項目があればその説明（文字列）、なければ None
+    """
+    for key, (lo, hi) in ANALYSIS_PARAM_RANGES.items():
+        v = values[key]
+        if v < lo or (hi is not None and v > hi):
+            return f"{key} must be {lo}..{hi}, got {v}" if hi is not None else f"{key} must be >= {lo}, got {v}"
+    if values["centers"] not in CENTER_METHODS:
+        return f"centers must be one of {CENTER_METHODS}"
+    return None
+
+def apply_analysis_params_file(path=ANALYSIS_PARAMS_PATH):
+    """
+    klee_params.json を読んで analysis_snapshot を次の世代に差し替える（無い項目は既定値）
+    - ファイルが無ければ既定値に戻す
+    - 読めない・範囲外の値があるときは何も変えずに False（起動時なら既定値で始める）
+    """
+    global analysis_snapshot
+    values = dict(ANALYSIS_PARAM_DEFAULTS)
+    error = None
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                loaded = json.load(f)
+            for key, value in loaded.items():
+                if key not in ANALYSIS_PARAM_NAMES:
+                    print(f"⚠️ {os.path.basename(path)}: unknown key {key!r}")
+                    continue
+                values[key] = type(ANALYSIS_PARAM_DEFAULTS[key])(value)
+            error = check_analysis_params(values)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            error = e
+    if error is not None:
+        print(f"⚠️ {os.path.basename(path)} not applied:", error)
+        if analysis_snapshot is None:
+            analysis_snapshot = (0, AnalysisParams(**ANALYSIS_PARAM_DEFAULTS))
+        return False
+    gen = 0 if analysis_snapshot is None else analysis_snapshot[0] + 1
+    analysis_snapshot = (gen, AnalysisParams(**values))
+    return True
+
+apply_analysis_params_file()
+
+# キャッシュ：最近使った ANALYSIS_CACHE_MAX_ENTRIES 件だけ残す
+#   python klee_main.py --no-cache     … キャッシュを使わずに解析する
+#   python klee_main.py --clear-cache  … キャッシュを全削除してから起動する
+ANALYSIS_CACHE_ENABLED = "--no-cache" not in sys.argv
+ANALYSIS_CACHE_MAX_ENTRIES = 16
+
+if "--clear-cache" in sys.argv:
+    clear_analysis_cache(ANALYSIS_CACHE_DIR)
+    evict_pyramid_cache(PYRAMID_CACHE_DIR, max_entries=0)
+
 # ============================================================
 # 7) LOAD ASSETS
 # ============================================================
@@ -71,13 +342,6 @@ except Exception as e:
     print("❌ Image/back.png が読み込めません:", e)
     sys.exit()
 
-try:
-    klee_path = os.path.join(IMAGE_MAIN_DIR, "main.jpg")
-    raw_image = pygame.image.load(klee_path).convert_alpha()
-except Exception as e:
-    print("❌ Image_Main/main.jpg が読み込めません:", e)
-    sys.exit()
-
 # ============================================================
 # 8) RESPONSIVE LAYOUT CALCULATION
 # ============================================================
@@ -89,231 +353,1337 @@ FRAME_PAD = s(40)
 MAX_IMG_W = int(SCREEN_W * 0.72)
 MAX_IMG_H = max(120, SCREEN_H - (TOP_MARGIN + BOTTOM_UI_RESERVED))
 
-img_w, img_h = raw_image.get_size()
-aspect = img_w / img_h
+def fit_image_size(img_w, img_h):
+    """
+    元画像サイズ -> 表示サイズ (new_w, new_h)
+    """
+    aspect = img_w / img_h
 
-new_h = min(MAX_IMG_H, int(MAX_IMG_W / aspect))
-new_w = int(new_h * aspect)
+    new_h = min(MAX_IMG_H, int(MAX_IMG_W / aspect))
+    new_w = int(new_h * aspect)
 
-if new_w > MAX_IMG_W:
-    new_w = MAX_IMG_W
-    new_h = int(new_w / aspect)
+    if new_w > MAX_IMG_W:
+        new_w = MAX_IMG_W
+        new_h = int(new_w / aspect)
 
-new_w = max(160, new_w)
-new_h = max(120, new_h)
+    return max(160, new_w), max(120, new_h)
 
-scaled_image = pygame.transform.smoothscale(raw_image, (new_w, new_h))
+# 作品画像は表示サイズの Surface だけを残す（元解像度の Surface は持ち続けない）
+# 大きなスキャン画像は縮小デコード + 帯ごとの縮小でメモリを抑える（Pillow がある場合）
+#   python klee_main.py --load-budget-mb 128  … 読み込み時に使うメモリの目安（既定 256 MB）
+IMAGE_LOAD_BUDGET_MB = int(arg_value("--load-budget-mb", DEFAULT_LOAD_BUDGET_MB))
 
-if BLUR_DOWNSCALE and BLUR_DOWNSCALE > 0:
-    small_w = max(2, new_w // BLUR_DOWNSCALE)
-    small_h = max(2, new_h // BLUR_DOWNSCALE)
-    small = pygame.transform.smoothscale(scaled_image, (small_w, small_h))
-    sample_image = pygame.transform.smoothscale(small, (new_w, new_h))
+# ============================================================
+# 8.1) GALLERY (Image_Main 内の作品)
+# ============================================================
+# Image_Main 内の画像をファイル名順に並べ、main.jpg があればそこから始める。
+# 作品1枚分のデータ（表示用画像・解析結果・色の引き当て表）は painting(dict) にまとめ、
+# 切り替えるときはフレームの合間にグローバルへ差し替える
+GALLERY_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+def list_gallery_images():
+    names = sorted(
+        n for n in os.listdir(IMAGE_MAIN_DIR)
+        if n.lower().endswith(GALLERY_EXTENSIONS) and not n.startswith(".")
+    )
+    return [os.path.join(IMAGE_MAIN_DIR, n) for n in names]
+
+def load_painting(path):
+    """
+    作品画像を読み込んで painting を作る（解析・グリッドは analyze_painting で足す）
+    """
+    t0 = time.perf_counter()
+    image, info = load_display_image(path, fit_image_size, IMAGE_LOAD_BUDGET_MB)
+    w, h = image.get_size()
+    rss = peak_rss_mb()
+    print(
+        f"✅ Image loaded: {os.path.basename(path)} {info['source_size'][0]}x{info['source_size'][1]} -> {w}x{h} "
+        f"({info['loader']}, decode {info['decode_size'][0]}x{info['decode_size'][1]}, "
+        f"{info['strips']} strip(s)) {(time.perf_counter() - t0) * 1000:.1f} ms"
+        + (f", peak RSS {rss:.1f} MB" if rss is not None else "")
+    )
+    return {
+        "path": path,
+        "name": os.path.basename(path),
+        "image": image,
+        "load_info": info,
+        "size": (w, h),
+        "tables": None,
+        "sat": None,
+        "grid_rgb": None,
+        "grid_hsv": None,
+        "labels": None,
+        "regions": None,
+        "texture": None,
+        "frame": None,
+        "params_gen": None,
+    }
+
+def painting_bytes(p):
+    """
+    先読みキャッシュの上限判定に使う、作品1枚分のおおよそのメモリ量
+    """
+    w, h = p["size"]
+    total = w * h * p["image"].get_bytesize()
+    for key in ("sat", "grid_rgb", "grid_hsv", "labels", "regions", "texture"):
+        if p[key] is not None:
+            total += p[key].nbytes
+    return total
+
+# 動画・連番画像を作品の代わりに流す（klee_stream.py。ギャラリー・拡大表示・Image_Main の監視は使わない）
+#   python klee_main.py --source study.mp4             … 動画（opencv-python が必要）
+#   python klee_main.py --source Image_Video/pan       … フォルダ内の連番画像（ファイル名の数字順）
+#   python klee_main.py --source "Image_Video/*.png"   … glob で指定した連番画像
+#   python klee_main.py --source study.gif             … アニメーション GIF / WebP / APNG
+#   --source-fps 12   … フレームレート（既定：動画・GIF はファイルの値、連番画像は 12）
+# 先頭フレームは起動時に読み、2枚目からは 8.12) のスレッドが1枚先まで用意する
+SOURCE_PATH = arg_value("--source")
+SOURCE_FPS = arg_value("--source-fps")
+if SOURCE_PATH is not None and HEADLESS:
+    # 再生はフレームの時刻が決まっていないと同じ結果にならない
+    print("⚠️ --source is ignored in headless replay")
+    SOURCE_PATH = None
+source_reader = None
+
+def stream_painting(frame, index):
+    """
+    動画・連番画像の1フレーム（元の大きさの Surface）-> painting（解析・グリッドは後で足す）
+    """
+    size = fit_image_size(*frame.get_size())
+    image = pygame.transform.smoothscale(frame.convert(), size)
+    return {
+        "path": SOURCE_PATH,
+        "name": os.path.basename(SOURCE_PATH.rstrip("/\\")),
+        "image": image,
+        "load_info": {
+            "source_size": frame.get_size(), "decode_size": frame.get_size(),
+            "loader": source_reader.kind, "strips": 1,
+        },
+        "size": size,
+        "tables": None,
+        "sat": None,
+        "grid_rgb": None,
+        "grid_hsv": None,
+        "labels": None,
+        "regions": None,
+        "texture": None,
+        "frame": index,
+        "params_gen": None,
+    }
+
+if SOURCE_PATH is not None:
+    try:
+        source_reader = open_frame_reader(SOURCE_PATH, float(SOURCE_FPS) if SOURCE_FPS else None)
+        first_frame = source_reader.read(0)
+        if first_frame is None:
+            raise OSError("no frames")
+        current_painting = stream_painting(first_frame, 0)
+        del first_frame
+    except Exception as e:
+        print(f"❌ --source {SOURCE_PATH} が読み込めません:", e)
+        sys.exit()
+    print(
+        f"✅ Stream source: {current_painting['name']} ({source_reader.kind},"
+        f" {source_reader.frame_count or '?'} frames @ {source_reader.fps:.2f} fps)"
+    )
+    gallery_paths = [SOURCE_PATH]
+    gallery_index = 0
+    # 動画ファイル全体のハッシュは取らない（フレームごとのテーブルは 8.12) で作る）
+    ANALYSIS_CACHE_ENABLED = False
+    if SEND_ON == "region":
+        # 色面の番号はフレームごとに付け直すので、同じ色面でも番号が変わって送り続けてしまう
+        print("⚠️ --send-on region is not available with --source; using label")
+        SEND_ON = "label"
 else:
-    sample_image = scaled_image
+    gallery_paths = list_gallery_images()
+    if not gallery_paths:
+        print("❌ Image_Main に画像がありません")
+        sys.exit()
+    main_path = os.path.join(IMAGE_MAIN_DIR, "main.jpg")
+    gallery_index = gallery_paths.index(main_path) if main_path in gallery_paths else 0
 
-img_x = (SCREEN_W - new_w) // 2
-img_y = TOP_MARGIN
+    try:
+        current_painting = load_painting(gallery_paths[gallery_index])
+    except Exception as e:
+        print(f"❌ Image_Main/{os.path.basename(gallery_paths[gallery_index])} が読み込めません:", e)
+        sys.exit()
+
+# --sonify-process のワーカーは、作品が読めてから起動する（グリッドは解析が済むたびに渡す）
+sonify = None
+sonify_gen = 0
+if SONIFY_PROCESS:
+    try:
+        sonify = SonifyProcess(
+            OSC_IP, OSC_PORT, SEND_ON, RGB_DELTA_THRESHOLD, OSC_MIN_INTERVAL_MS,
+            latency_ms=OSC_LATENCY_MS, use_bundles=OSC_USE_BUNDLES
+        )
+        print(f"✅ Sonify worker started (pid {sonify.proc.pid})")
+    except Exception as e:
+        print("❌ Sonify worker could not start; sending colors from this process:", e)
+        sonify = None
+
+def set_painting_globals(p):
+    """
+    表示・サンプリングが参照するグローバルを painting p のものにする
+    """
+    global klee_path, scaled_image, image_load_info, new_w, new_h, img_x, img_y
+    global color_sat, grid_rgb, grid_hsv, grid_labels, grid_regions, grid_texture, label_tables, GRID_W, GRID_H
+    global sonify_gen
+    klee_path = p["path"]
+    scaled_image = p["image"]
+    image_load_info = p["load_info"]
+    new_w, new_h = p["size"]
+    img_x = (SCREEN_W - new_w) // 2
+    img_y = TOP_MARGIN
+    color_sat, grid_rgb, grid_hsv = p["sat"], p["grid_rgb"], p["grid_hsv"]
+    grid_labels, grid_regions, label_tables = p["labels"], p["regions"], p["tables"]
+    grid_texture = p["texture"]
+    GRID_W, GRID_H = (grid_rgb.shape[0], grid_rgb.shape[1]) if grid_rgb is not None else (0, 0)
+    if sonify is not None and grid_rgb is not None:
+        sonify_gen = sonify.set_grid(SAMPLE_GRID_STEP, grid_rgb, grid_hsv, grid_labels, grid_regions, grid_texture)
+
+def build_sample_image(image, blur_downscale):
+    """
+    色の読み取り用にぼかした画像（縮小→拡大）
+    """
+    w, h = image.get_size()
+    if blur_downscale and blur_downscale > 0:
+        small_w = max(2, w // blur_downscale)
+        small_h = max(2, h // blur_downscale)
+        small = pygame.transform.smoothscale(image, (small_w, small_h))
+        return pygame.transform.smoothscale(small, (w, h))
+    return image
+
+set_painting_globals(current_painting)
 
 # ============================================================
-# 8.5) TXT GENERATION (Hue.txt / Value.txt) BEFORE TITLE SCREEN
+# 8.5) TXT GENERATION (Hue.txt / Value.txt)
 # ============================================================
-def build_hue_histogram_from_surface(surf, step=2, min_s=0.12, min_v=0.10):
-    w, h = surf.get_size()
-    hist = [0] * 360
-    for y in range(0, h, step):
-        for x in range(0, w, step):
-            r, g, b, *_ = surf.get_at((x, y))
-            hh, ss, vv = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
-            if ss < min_s or vv < min_v:
-                continue
-            hi = int(hh * 360) % 360
-            hist[hi] += 1
-    return hist
-
-def pick_hue_centers_by_quantiles(hist, k=9):
-    total = sum(hist)
-    if total <= 0:
-        return [int(i * 360 / k) for i in range(k)]
-
-    cdf = []
-    acc = 0
-    for v in hist:
-        acc += v
-        cdf.append(acc)
-
-    centers = []
-    for i in range(k):
-        target = int(total * ((i + 0.5) / k))
-        hi = 0
-        while hi < 360 and cdf[hi] < target:
-            hi += 1
-        centers.append(min(359, hi))
-
-    centers = sorted(centers)
-    for i in range(1, len(centers)):
-        if centers[i] == centers[i - 1]:
-            centers[i] = (centers[i] + 1) % 360
-    return centers
-
-def circular_distance(a, b):
-    d = abs(a - b) % 360
-    return min(d, 360 - d)
-
-def build_hue_to_bin_map(centers):
-    hue_map = [0] * 360
-    for h in range(360):
-        best_i = 0
-        best_d = 10**9
-        for i, c in enumerate(centers):
-            d = circular_distance(h, c)
-            if d < best_d:
-                best_d = d
-                best_i = i
-        hue_map[h] = best_i
-    return hue_map
-
-def build_value_histogram_from_surface(surf, step=2, min_v=0.02):
-    """
-    Value(0..100)の出現頻度ヒストグラムを作る
-    - min_v: 真っ黒近いところはノイズとして弾きたいなら少し上げる（0..1）
-    """
-    w, h = surf.get_size()
-    hist = [0] * 101  # 0..100
-    for y in range(0, h, step):
-        for x in range(0, w, step):
-            r, g, b, *_ = surf.get_at((x, y))
-            hh, ss, vv = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
-            if vv < min_v:
-                continue
-            vi = int(vv * 100)
-            if vi < 0:
-                vi = 0
-            if vi > 100:
-                vi = 100
-            hist[vi] += 1
-    return hist
-
-def pick_value_centers_by_quantiles(hist, k=16):
-    """
-    Valueの分位点で代表値をk個選ぶ（0..100）
-    """
-    total = sum(hist)
-    if total <= 0:
-        # ほぼ情報が無い場合：等間隔
-        return [int(i * 100 / (k - 1)) for i in range(k)]
-
-    cdf = []
-    acc = 0
-    for v in hist:
-        acc += v
-        cdf.append(acc)
-
-    centers = []
-    for i in range(k):
-        target = int(total * ((i + 0.5) / k))
-        vi = 0
-        while vi < 101 and cdf[vi] < target:
-            vi += 1
-        centers.append(min(100, vi))
-
-    centers = sorted(centers)
-
-    # 代表値が重複しすぎると段階が死ぬので、近すぎるものはずらす
-    for i in range(1, len(centers)):
-        if centers[i] <= centers[i - 1]:
-            centers[i] = min(100, centers[i - 1] + 1)
-
-    # それでも最後が溢れたら、後ろから詰め直す
-    for i in range(len(centers) - 2, -1, -1):
-        if centers[i] >= centers[i + 1]:
-            centers[i] = max(0, centers[i + 1] - 1)
-
-    return centers
-
-def build_value_to_velocity_map_100(centers, vmin=1, vmax=128):
-    """
-    index 0..99 のValueに対して、
-    「最も近い代表center」に量子化 → その代表に対応する velocity を返す (1..128)
-    """
-    k = len(centers)
-    if k <= 1:
-        return [vmin] * 100
-
-    # 代表段階ごとの velocity（分かりやすいよう線形）
-    vel_levels = []
-    for i in range(k):
-        vv = vmin + int(round(i * ((vmax - vmin) / float(k - 1))))
-        if vv < vmin:
-            vv = vmin
-        if vv > vmax:
-            vv = vmax
-        vel_levels.append(vv)
-
-    # value(0..99) -> nearest center -> velocity
-    out = [vmin] * 100
-    for v in range(100):
-        best_i = 0
-        best_d = 10**9
-        for i, c in enumerate(centers):
-            d = abs(v - c)
-            if d < best_d:
-                best_d = d
-                best_i = i
-        out[v] = vel_levels[best_i]
-
-    # 0は除外したいので念のため
-    out = [max(vmin, min(vmax, int(x))) for x in out]
-    return out
+def analysis_params(p, params):
+    """
+    キャッシュキーに含める解析パラメータ（どれか変われば別エントリ）
+    """
+    return dict(params._asdict(), size=list(p["size"]), loader=p["load_info"]["loader"])
+
+def run_analysis(p, params):
+    # Hue / Value / RGB のヒストグラムは、ぼかし画像を1回だけ配列にして作る
+    # （ぼかし画像は解析の間だけ作って捨てる。表示サイズなので元のスキャンの大きさには依らない）
+    rgb = surface_to_rgb_array(build_sample_image(p["image"], params.blur_downscale), step=params.step)
+    hue_hist, val_hist = build_histograms_from_rgb(
+        rgb, hue_min_s=params.hue_min_s, hue_min_v=params.hue_min_v, value_min_v=params.value_min_v
+    )
+    color_hist = build_color_histogram_from_rgb(rgb)
+    del rgb
 
-def save_as_max_table_line(values, filepath):
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    line = "table " + " ".join(str(int(v)) for v in values) + "\n"
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(line)
+    # ここから先はヒストグラムの bin だけを見る
+    t0 = time.perf_counter()
+    hue_centers, val_centers = pick_centers(hue_hist, val_hist, params)
+    result = build_tables(hue_centers, val_centers, color_hist, params)
+    print(f"✅ Centers ({params.centers}) + palette: {(time.perf_counter() - t0) * 1000:.1f} ms")
+    return result
 
-def generate_txt_files_and_notify():
+def pick_centers(hue_hist, val_hist, params):
+    """
+    ヒストグラム -> (Hue の代表値, Value の代表値)（params.centers の方法で）
+    """
+    if params.centers == "kmeans":
+        return kmeans_hue_centers(hue_hist, k=params.hue_k), kmeans_value_centers(val_hist, k=params.value_k)
+    return (pick_hue_centers_by_quantiles(hue_hist, k=params.hue_k),
+            pick_value_centers_by_quantiles(val_hist, k=params.value_k))
+
+def build_tables(hue_centers, val_centers, color_hist, params):
     # Hue（0..8 の 360個）
-    hue_hist = build_hue_histogram_from_surface(sample_image, step=2, min_s=0.12, min_v=0.10)
-    hue_centers = pick_hue_centers_by_quantiles(hue_hist, k=9)
     hue_map = build_hue_to_bin_map(hue_centers)
-    if len(hue_map) != 360:
-        print("❌ Hue map length is not 360:", len(hue_map))
-        sys.exit()
-    hue_txt_path = os.path.join(TXT_OUT_DIR, "Hue.txt")
-    save_as_max_table_line(hue_map, hue_txt_path)
 
     # Value（頻度ベース → 代表16段階 → velocity 1..128 の 100個）
-    val_hist = build_value_histogram_from_surface(sample_image, step=2, min_v=0.02)
-    val_centers = pick_value_centers_by_quantiles(val_hist, k=16)
     value_map = build_value_to_velocity_map_100(val_centers, vmin=1, vmax=128)
+
+    palette = build_palette(color_hist, k=params.palette_k)
+    return {
+        "hue_centers": hue_centers,
+        "hue_map": hue_map,
+        "val_centers": val_centers,
+        "value_map": value_map,
+        "palette": palette,
+    }
+
+def analyze_tables(p):
+    """
+    painting p の Hue / Value テーブルを作って p["tables"] に入れる（キャッシュがあれば使う）
+    - 始めたときの analysis_snapshot だけを使い、その世代を p["params_gen"] に残す
+    """
+    t0 = time.perf_counter()
+    gen, params = analysis_snapshot
+
+    result = None
+    cache_key = None
+    if ANALYSIS_CACHE_ENABLED:
+        try:
+            cache_key = analysis_cache_key(p["path"], analysis_params(p, params))
+            result = load_cached_analysis(ANALYSIS_CACHE_DIR, cache_key)
+        except OSError as e:
+            print("⚠️ analysis cache unavailable:", e)
+
+    cache_hit = result is not None
+    if not cache_hit:
+        result = run_analysis(p, params)
+
+    hue_map = result["hue_map"]
+    if len(hue_map) != 360:
+        raise ValueError(f"Hue map length is not 360: {len(hue_map)}")
+    value_map = result["value_map"]
     if len(value_map) != 100:
-        print("❌ Value map length is not 100:", len(value_map))
-        sys.exit()
-    value_txt_path = os.path.join(TXT_OUT_DIR, "Value.txt")
-    save_as_max_table_line(value_map, value_txt_path)
+        raise ValueError(f"Value map length is not 100: {len(value_map)}")
+
+    if not cache_hit and cache_key is not None:
+        try:
+            store_cached_analysis(
+                ANALYSIS_CACHE_DIR, cache_key, result, max_entries=ANALYSIS_CACHE_MAX_ENTRIES
+            )
+        except OSError as e:
+            print("⚠️ analysis cache not saved:", e)
+
+    p["tables"] = result
+    p["params_gen"] = gen
+    print(
+        f"✅ Analysis time ({p['name']}): {(time.perf_counter() - t0) * 1000:.1f} ms"
+        + (" (cache hit)" if cache_hit else "")
+    )
+
+# /table/* に付ける版数（テーブルを送るたびに1つ増やす）
+table_version = 0
+# push_tables は起動時の解析スレッドと tables_worker の両方から呼ばれるので1回ずつ順に渡す
+# （Hue.txt と Value.txt が別々のテーブルのものにならないように）
+tables_lock = threading.Lock()
 
-    print("✅ Hue.txt saved:", hue_txt_path)
-    print("✅ Value.txt saved:", value_txt_path)
-    print("✅ Hue centers:", hue_centers)
-    print("✅ Value centers:", val_centers)
+def push_tables(p, verbose=True):
+    """
+    painting p のテーブルを Max に渡す
+    - TABLE_FILES：Hue.txt / Value.txt に書き出し、/txt で知らせる
+    - TABLES_OSC：/table/hue・/table/value で中身をそのまま送る（txt を読み直さずに済む）
+    - verbose=False なら表示は代表値の1行だけ（動画でテーブルが何度も変わるとき）
+    """
+    global table_version
+    with tables_lock:
+        result = p["tables"]
+
+        if TABLE_FILES:
+            # 中身が同じならそのまま使い回す
+            hue_txt_path = os.path.join(TXT_OUT_DIR, "Hue.txt")
+            if not table_file_matches(result["hue_map"], hue_txt_path):
+                save_as_max_table_line(result["hue_map"], hue_txt_path)
+            value_txt_path = os.path.join(TXT_OUT_DIR, "Value.txt")
+            if not table_file_matches(result["value_map"], value_txt_path):
+                save_as_max_table_line(result["value_map"], value_txt_path)
+
+            if verbose:
+                print("✅ Hue.txt saved:", hue_txt_path)
+                print("✅ Value.txt saved:", value_txt_path)
+        palette = result.get("palette", [])
+        if verbose:
+            print("✅ Hue centers:", result["hue_centers"])
+            print("✅ Value centers:", result["val_centers"])
+            if palette:
+                print("✅ Palette:", ", ".join(
+                    "#%02x%02x%02x %.0f%%" % (*c["rgb"], c["weight"] * 100) for c in palette
+                ))
+        else:
+            print(f"✅ Tables updated (frame {p['frame']}): hue {result['hue_centers']} value {result['val_centers']}")
+
+        # 同じフレームの bundle にまとめて送られる（作品ごとに1回）
+        try:
+            if TABLES_OSC:
+                table_version += 1
+                client.send_message("/table/hue", [table_version] + [int(v) for v in result["hue_map"]])
+                client.send_message("/table/value", [table_version] + [int(v) for v in result["value_map"]])
+                # 代表色：r, g, b, 割合(‰) を重い順に並べたもの
+                client.send_message("/table/palette", [table_version] + [
+                    int(v) for c in palette for v in (*c["rgb"], round(c["weight"] * 1000))
+                ])
+                if verbose:
+                    print(f"✅ Tables sent over OSC: version {table_version}")
+            if TABLE_FILES:
+                client.send_message("/txt", 1)
+        except Exception:
+            pass
+
+# ============================================================
+# 8.6) COLOR LOOKUP GRID (カーソル位置の色を前計算)
+# ============================================================
+# scaled_image の積分画像(SAT)を持っておき、任意半径の平均色を O(1) で引く。
+# SAMPLE_RADIUS_PX の色だけは SAMPLE_STEP_PX ごとのセルで RGB / HSV(量子化済み) を
+# 前計算しておき、メインループでは配列を1回引くだけにする
+SAMPLE_GRID_STEP = SAMPLE_STEP_PX if (SAMPLE_STEP_PX and SAMPLE_STEP_PX > 1) else 1
+
+# --texture：セルごとの質感（klee_analysis 2.9）も読み込みのときに前計算しておき、色を送るたびに
+#   /texture [色相のばらつき, 明暗の差, 輪郭の量, 彩度のばらつき]（各 0..100）も送る（フレームごとの計算はなし）
+# 質感は画素を間引いて求める（静止画 2 ごと・動画のフレーム 4 ごと。表示画像 1MP あたり約 90ms / 40ms）
+TEXTURE_ENABLED = "--texture" in sys.argv
+TEXTURE_DECIMATE = 2
+STREAM_TEXTURE_DECIMATE = 4
+
+def build_painting_texture(image_rgb, decimate):
+    """
+    表示サイズの RGB 配列 -> グリッドと同じ並びの (GRID_W, GRID_H, 4) uint8
+    """
+    # セルの一辺を割り切れる間引き幅にする（セルの中心が間引いた画素に乗るように）
+    d = max(1, min(decimate, SAMPLE_GRID_STEP))
+    while SAMPLE_GRID_STEP % d:
+        d -= 1
+    return build_texture_grid(image_rgb[::d, ::d], SAMPLE_GRID_STEP // d, max(1, SAMPLE_RADIUS_PX // d))
+
+# --send-on label / region のときは、セルごとの音のラベル（テーブルが要るので analyze_tables の後）と
+# つながった色面の番号も持ち、カーソルがラベル（色面）の境目を越えたときだけ送る
+def build_painting_grid(p):
+    image_rgb = surface_to_rgb_array(p["image"])
+    sat = build_summed_area_table(image_rgb)
+    rgb, hsv = build_lookup_grid_from_rgb(sat_grid_means(sat, SAMPLE_GRID_STEP, SAMPLE_RADIUS_PX))
+    p["sat"], p["grid_rgb"], p["grid_hsv"] = sat, rgb, hsv
+    if TEXTURE_ENABLED:
+        p["texture"] = build_painting_texture(
+            image_rgb, TEXTURE_DECIMATE if p["frame"] is None else STREAM_TEXTURE_DECIMATE
+        )
+    if SEND_ON != "color" and p["tables"] is not None:
+        labels = build_label_grid(hsv, p["tables"]["hue_map"], p["tables"]["value_map"])
+        if p["frame"] is None:
+            # 小さな色面の取り込みは 1 枚 100ms ほどかかるので、動画のフレームではしない
+            labels = merge_small_regions(labels, REGION_MIN_CELLS)
+        p["labels"] = labels
+        p["regions"], _ = label_connected_regions(labels)
+
+def analyze_painting(p):
+    """
+    解析（テーブル）+ 色の引き当て表。ワーカースレッドで呼ぶ
+    """
+    analyze_tables(p)
+    build_painting_grid(p)
 
-    # 完了通知（1回だけ）
+# ============================================================
+# 8.7) ZOOM / PAN (画像ピラミッドからの拡大表示)
+# ============================================================
+# マウスホイールでカーソル位置を中心に拡大・縮小、右ドラッグか矢印キーで移動、0 キーで全体表示。
+# 拡大中は表示倍率に合ったレベルのタイルだけを読み（LRU キャッシュ）、カーソルの色もそのレベルから取る。
+# 等倍のときは従来どおり scaled_image とグリッドを使う。
+#   python klee_main.py --no-zoom  … ピラミッドを作らず、拡大表示を無効にする
+ZOOM_ENABLED = not HEADLESS and "--no-zoom" not in sys.argv and source_reader is None
+ZOOM_MAX = 16.0
+ZOOM_STEP = 1.25
+# 矢印キー1回で表示幅の何割動かすか
+PAN_KEY_STEP = 0.1
+PYRAMID_CACHE_MAX_ENTRIES = 4
+# レベル 0 の最大画素数（読み込みメモリの目安から決める。作るときに丸ごと持つのはデコード結果の 4byte/画素 だけ）
+# これを超える画像だけ縮めてから作るので、拡大中に読める色の細かさもそこまでになる（起動時に表示）
+PYRAMID_MAX_PIXELS = IMAGE_LOAD_BUDGET_MB * 1024 * 1024 // 4
+TILE_CACHE_MAX_TILES = DEFAULT_TILE_CACHE_TILES
+
+# pyramid は表示中の作品のもの（pyramid_path がその作品のパス）
+pyramid = None
+pyramid_path = None
+view_zoom = 1.0
+# 表示中心（画像全体を 0..1 とした座標）
+view_cx, view_cy = 0.5, 0.5
+pan_drag_pos = None
+
+def prepare_pyramid(p):
+    """
+    painting p のピラミッドをキャッシュから開く（無ければ作る）。失敗しても拡大表示が無効になるだけ
+    """
+    global pyramid, pyramid_path
+    t0 = time.perf_counter()
+    pyr = None
     try:
-        client.send_message("/txt", 1)
-    except Exception:
+        key = analysis_cache_key(p["path"], {"pyramid_max_pixels": PYRAMID_MAX_PIXELS, "min_size": list(p["size"])})
+        root = os.path.join(PYRAMID_CACHE_DIR, key)
+        pyr = ImagePyramid.open(root, TILE_CACHE_MAX_TILES)
+        built = pyr is None
+        if built:
+            build_pyramid_in_subprocess(p["path"], root, p["size"], PYRAMID_MAX_PIXELS)
+            pyr = ImagePyramid.open(root, TILE_CACHE_MAX_TILES)
+        evict_pyramid_cache(PYRAMID_CACHE_DIR, PYRAMID_CACHE_MAX_ENTRIES)
+        base_w, base_h = pyr.levels[0]
+        print(
+            f"✅ Image pyramid ready ({p['name']}): {len(pyr.levels)} levels from {base_w}x{base_h}"
+            f" {(time.perf_counter() - t0) * 1000:.1f} ms" + (" (built)" if built else " (cached)")
+        )
+        if (base_w, base_h) != pyr.source_size:
+            print(
+                f"⚠️ zoom samples at most {base_w}x{base_h} (source {pyr.source_size[0]}x{pyr.source_size[1]});"
+                f" raise --load-budget-mb to sample at full resolution"
+            )
+    except Exception as e:
+        pyr = None
+        print("⚠️ image pyramid unavailable (zoom disabled):", e)
+
+    # 作っている間に別の作品へ切り替わっていたら使わない
+    with gallery_lock:
+        if p is current_painting:
+            pyramid = pyr
+            pyramid_path = p["path"]
+    wake_main_loop()
+
+def view_zoomed():
+    return pyramid is not None and view_zoom > 1.0
+
+def view_rect():
+    """
+    表示中の範囲 (x0, y0, x1, y1)（画像全体を 0..1 とした座標）
+    """
+    half = 0.5 / view_zoom
+    return view_cx - half, view_cy - half, view_cx + half, view_cy + half
+
+def set_view(zoom, cx, cy):
+    global view_zoom, view_cx, view_cy
+    view_zoom = max(1.0, min(ZOOM_MAX, zoom))
+    half = 0.5 / view_zoom
+    view_cx = max(half, min(1.0 - half, cx))
+    view_cy = max(half, min(1.0 - half, cy))
+
+def zoom_at(factor, ix, iy):
+    """
+    画像内座標 (ix, iy) の下にある点を動かさずに factor 倍する
+    """
+    x0, y0, x1, y1 = view_rect()
+    u = x0 + ix / new_w * (x1 - x0)
+    v = y0 + iy / new_h * (y1 - y0)
+    zoom = max(1.0, min(ZOOM_MAX, view_zoom * factor))
+    span = 1.0 / zoom
+    set_view(zoom, u + (0.5 - ix / new_w) * span, v + (0.5 - iy / new_h) * span)
+
+def pan_by(dx, dy):
+    """
+    表示を画面上で (dx, dy) px ずらす（画像がカーソルについてくる向き）
+    """
+    x0, y0, x1, y1 = view_rect()
+    set_view(view_zoom, view_cx - dx / new_w * (x1 - x0), view_cy - dy / new_h * (y1 - y0))
+
+def view_key():
+    """
+    シーンのキャッシュキー用（等倍のときは None）
+    """
+    if not view_zoomed():
+        return None
+    return (round(view_zoom, 4), round(view_cx, 6), round(view_cy, 6))
+
+def view_level():
+    return pyramid.level_for_width(new_w * view_zoom)
+
+def render_view():
+    """
+    拡大中の作品部分を (new_w, new_h) の Surface に描く
+    """
+    k = view_level()
+    lw, lh = pyramid.levels[k]
+    x0, y0, x1, y1 = view_rect()
+    fx0, fy0, fx1, fy1 = x0 * lw, y0 * lh, x1 * lw, y1 * lh
+    ix0, iy0 = int(fx0), int(fy0)
+    ix1, iy1 = min(lw, int(math.ceil(fx1))), min(lh, int(math.ceil(fy1)))
+
+    region = pyramid.render_region(k, ix0, iy0, ix1, iy1)
+    sx, sy = new_w / (fx1 - fx0), new_h / (fy1 - fy0)
+    size = (max(1, int(round((ix1 - ix0) * sx))), max(1, int(round((iy1 - iy0) * sy))))
+    view = pygame.Surface((new_w, new_h)).convert()
+    view.blit(
+        pygame.transform.smoothscale(region, size),
+        (-int(round((fx0 - ix0) * sx)), -int(round((fy0 - iy0) * sy)))
+    )
+    return view
+
+def lookup_color_zoomed(ix, iy, radius=SAMPLE_RADIUS_PX):
+    """
+    拡大中の画像内座標 -> ((r, g, b), (h1, s1, v1))
+    - 表示に使っているレベルから読み、半径は画面上の px をレベルの px に換算する
+    """
+    k = view_level()
+    lw, lh = pyramid.levels[k]
+    x0, y0, x1, y1 = view_rect()
+    lx = max(0, min(lw - 1, int((x0 + (ix + 0.5) / new_w * (x1 - x0)) * lw)))
+    ly = max(0, min(lh - 1, int((y0 + (iy + 0.5) / new_h * (y1 - y0)) * lh)))
+    r = int(round(radius * (x1 - x0) * lw / new_w))
+    rgb = pyramid.box_mean(k, lx, ly, r)
+    return rgb, rgb_to_hsv_quantized(*rgb)
+
+def print_pyramid_stats():
+    if pyramid is None:
+        return
+    st = pyramid.stats()
+    print(
+        f"✅ Pyramid tiles: {st['hits']} hits / {st['misses']} loads"
+        f" ({st['load_ms']:.1f} ms loading, {st['cached_tiles']} cached)"
+    )
+
+# ============================================================
+# 8.8) GALLERY WORKER (タイトル画面を出しながら裏で解析・先読み)
+# ============================================================
+# 1本のワーカースレッドが、必要なものから順に片付ける
+#   1) 起動時：表示中の作品の解析・txt 書き出し・/txt 送信・グリッド作成 → startup_ready
+#   2) 切り替え先に指定された作品の読み込み・解析
+#   3) 表示中の作品のピラミッド（拡大表示用。別プロセスで作る）
+#   4) 前後 GALLERY_PRELOAD_RADIUS 枚の先読み（GALLERY_CACHE_MB に収まる範囲で）
+# 切り替えた作品のテーブルの書き出しと /txt 送信は、重い仕事の後ろで待たないよう別スレッドで行う
+# 読み込み・解析済みの作品は gallery_cache に置き、切り替えはそこから差し替えるだけにする
+#   python klee_main.py --gallery-cache-mb 128  … 先読みキャッシュの上限（既定 256 MB）
+GALLERY_PRELOAD_RADIUS = 1
+GALLERY_CACHE_MB = int(arg_value("--gallery-cache-mb", 256))
+
+gallery_lock = threading.Lock()
+gallery_wakeup = threading.Event()
+
+# 裏の仕事が終わったことを、入力待ち（アイドル）で止まっているメインループに知らせる
+MAIN_WAKE_EVENT = pygame.USEREVENT + 1
+
+def wake_main_loop():
+    try:
+        pygame.event.post(pygame.event.Event(MAIN_WAKE_EVENT))
+    except pygame.error:
         pass
+# path -> painting（解析済み。古い順）
+gallery_cache = OrderedDict()
+# 読み込みに失敗した作品（何度も読み直さない）
+gallery_failed = set()
+# 切り替え待ちの作品の index（無ければ None）
+gallery_target = None
+# Hue.txt / Value.txt に書き出してある（Max に渡した）テーブル
+# （作品ごと・動画ではテーブルが変わるたびに別の dict なので、同じものかどうかで判断する）
+tables_sent = None
+
+startup_ready = threading.Event()
+startup_progress = 0.0
+startup_error = None
+
+def gallery_wanted_paths():
+    """
+    キャッシュから追い出さない作品（表示中・切り替え待ち・前後の先読み対象）
+    """
+    n = len(gallery_paths)
+    wanted = {current_painting["path"]}
+    if gallery_target is not None:
+        wanted.add(gallery_paths[gallery_target])
+    for d in range(1, GALLERY_PRELOAD_RADIUS + 1):
+        wanted.add(gallery_paths[(gallery_index + d) % n])
+        wanted.add(gallery_paths[(gallery_index - d) % n])
+    return wanted
+
+def trim_gallery_cache():
+    """
+    GALLERY_CACHE_MB を超えた分を古い順に追い出し、残った合計 byte を返す（gallery_lock 内で呼ぶ）
+    """
+    cap = GALLERY_CACHE_MB * 1024 * 1024
+    wanted = gallery_wanted_paths()
+    total = sum(painting_bytes(p) for p in gallery_cache.values())
+    for path in list(gallery_cache):
+        if total <= cap:
+            break
+        if path in wanted:
+            continue
+        total -= painting_bytes(gallery_cache.pop(path))
+    return total
+
+def next_gallery_job():
+    """
+    次にやること ("load", path) / ("pyramid", painting) / None
+    """
+    with gallery_lock:
+        if gallery_target is not None:
+            path = gallery_paths[gallery_target]
+            if path not in gallery_cache and path not in gallery_failed:
+                return "load", path
+
+        if ZOOM_ENABLED and pyramid_path != current_painting["path"]:
+            return "pyramid", current_painting
+
+        # 先読みは、入れても上限を超えない見込みのときだけ
+        total = trim_gallery_cache()
+        estimate = painting_bytes(current_painting)
+        if total + estimate > GALLERY_CACHE_MB * 1024 * 1024:
+            return None
+        n = len(gallery_paths)
+        for d in range(1, GALLERY_PRELOAD_RADIUS + 1):
+            for index in ((gallery_index + d) % n, (gallery_index - d) % n):
+                path = gallery_paths[index]
+                if path not in gallery_cache and path not in gallery_failed:
+                    return "load", path
+    return None
+
+def startup_analysis():
+    global startup_progress, startup_error, tables_sent
+    t0 = time.perf_counter()
+    p = current_painting
+    try:
+        startup_progress = 0.1
+        analyze_tables(p)
+        push_tables(p)
+        tables_sent = p["tables"]
+
+        startup_progress = 0.6
+        build_painting_grid(p)
+        with gallery_lock:
+            set_painting_globals(p)
+            gallery_cache[p["path"]] = p
+
+        startup_progress = 1.0
+        print(f"✅ Startup analysis ready: {(time.perf_counter() - t0) * 1000:.1f} ms")
+    except Exception as e:
+        startup_error = e
+        print("❌ Startup analysis failed:", e)
+    finally:
+        startup_ready.set()
+        wake_main_loop()
+
+def gallery_worker():
+    global gallery_target
+    startup_analysis()
+    if startup_error is not None:
+        return
+
+    while True:
+        gallery_wakeup.clear()
+        job = next_gallery_job()
+        if job is None:
+            gallery_wakeup.wait()
+            continue
+
+        kind, arg = job
+        if kind == "pyramid":
+            prepare_pyramid(arg)
+            continue
+
+        try:
+            p = load_painting(arg)
+            analyze_painting(p)
+        except Exception as e:
+            print(f"⚠️ {os.path.basename(arg)} could not be loaded:", e)
+            with gallery_lock:
+                gallery_failed.add(arg)
+                if gallery_target is not None and gallery_paths[gallery_target] == arg:
+                    gallery_target = None
+            continue
+        with gallery_lock:
+            if p["params_gen"] != analysis_snapshot[0]:
+                # 解析の途中で klee_params.json が読み直された：古い値のテーブルなので入れずに作り直す
+                print(f"⚠️ {p['name']}: analysis params changed while analyzing; redoing")
+                continue
+            gallery_cache[arg] = p
+            trim_gallery_cache()
+        wake_main_loop()
+
+tables_wakeup = threading.Event()
+
+def tables_worker():
+    """
+    表示中の作品のテーブルがまだ書き出されていなければ書き出して /txt を送る
+    """
+    global tables_sent, reload_txt_t0
+    startup_ready.wait()
+    while True:
+        tables_wakeup.wait()
+        tables_wakeup.clear()
+        with gallery_lock:
+            p = current_painting
+        if p["tables"] is tables_sent:
+            continue
+        try:
+            push_tables(p, verbose=p["frame"] is None)
+            tables_sent = p["tables"]
+        except Exception as e:
+            print("⚠️ tables not written:", e)
+        if reload_txt_t0 is not None:
+            print(f"✅ Reload tables sent: {(time.perf_counter() - reload_txt_t0) * 1000:.1f} ms after detection")
+            reload_txt_t0 = None
+
+gallery_thread = threading.Thread(target=gallery_worker, name="klee-gallery", daemon=True)
+gallery_thread.start()
+tables_thread = threading.Thread(target=tables_worker, name="klee-tables", daemon=True)
+tables_thread.start()
+
+def lookup_color(ix, iy, radius=SAMPLE_RADIUS_PX):
+    """
+    画像内座標 -> ((r, g, b), (h1, s1, v1))
+    - radius が既定値ならグリッドを引くだけ、違えば積分画像から平均を取る
+    """
+    cx = max(0, min(GRID_W - 1, ix // SAMPLE_GRID_STEP))
+    cy = max(0, min(GRID_H - 1, iy // SAMPLE_GRID_STEP))
+    if radius == SAMPLE_RADIUS_PX:
+        return tuple(grid_rgb[cx, cy].tolist()), tuple(grid_hsv[cx, cy].tolist())
+    rgb = sat_box_mean(color_sat, cx * SAMPLE_GRID_STEP, cy * SAMPLE_GRID_STEP, radius)
+    return rgb, rgb_to_hsv_quantized(*rgb)
+
+def lookup_texture(ix, iy):
+    """
+    画像内座標 -> 質感 (hue_spread, contrast, edges, sat_entropy)。--texture でなければ None
+    - 拡大中も等倍のグリッドから引く（表示中の位置を等倍の座標に直す）
+    """
+    if grid_texture is None:
+        return None
+    if view_zoomed():
+        x0, y0, x1, y1 = view_rect()
+        ix = int((x0 + (ix + 0.5) / new_w * (x1 - x0)) * new_w)
+        iy = int((y0 + (iy + 0.5) / new_h * (y1 - y0)) * new_h)
+    cx = max(0, min(GRID_W - 1, ix // SAMPLE_GRID_STEP))
+    cy = max(0, min(GRID_H - 1, iy // SAMPLE_GRID_STEP))
+    return tuple(grid_texture[cx, cy].tolist())
+
+def sample_region(ix, iy, hsv, radius=SAMPLE_RADIUS_PX):
+    """
+    カーソル位置の (音のラベル, 色面の番号)
+    - 既定の半径・等倍表示ならグリッドを引くだけ。それ以外は読み取った色からラベルだけ求める（番号は None）
+    """
+    if radius == SAMPLE_RADIUS_PX and not view_zoomed() and grid_labels is not None:
+        cx = max(0, min(GRID_W - 1, ix // SAMPLE_GRID_STEP))
+        cy = max(0, min(GRID_H - 1, iy // SAMPLE_GRID_STEP))
+        return int(grid_labels[cx, cy]), int(grid_regions[cx, cy])
+    return musical_label(*hsv, label_tables["hue_map"], label_tables["value_map"]), None
+
+def sample_radius_for_speed(speed):
+    """
+    カーソル速度(px/frame) -> 平均を取る半径
+    """
+    r = SAMPLE_RADIUS_PX + int(speed * SAMPLE_RADIUS_SPEED_GAIN)
+    return max(0, min(SAMPLE_RADIUS_MAX_PX, r))
+
+# ============================================================
+# 8.9) MOTION SAMPLING (フレームの間にカーソルが通った色も読む)
+# ============================================================
+# 描画は 60fps でも、速く動かすとカーソルは1フレームで何十 px も飛ぶ。
+# そのフレームに届いた MOUSEMOTION を全部つなぎ、MOTION_STEP_PX ごとに補間した点の色を
+# まとめて引いて、RGB_DELTA_THRESHOLD / OSC_MIN_INTERVAL_MS の判定を点ごとの時刻で行う
+#   python klee_main.py --frame-sampling   … 従来どおりフレームごとに1点だけ読む
+MOTION_SAMPLING = "--frame-sampling" not in sys.argv
+MOTION_STEP_PX = SAMPLE_GRID_STEP
+MOTION_MAX_SAMPLES = 512
+
+motion_frames = 0
+motion_points = 0
+motion_points_max = 0
+motion_lookups = 0
+motion_sends = 0
+motion_sends_between = 0
+
+def cursor_path(prev_pos, prev_ms, moves, pos, now_ms):
+    """
+    前フレームの位置から今の位置までに通った点 -> (xs, ys, ts) の int 配列（画面座標・ms、時刻順）
+    - moves はこのフレームに届いた移動イベントの位置
+    - pygame のイベントには時刻が無いので、前フレームから今までの間に等間隔で並べる
+    """
+    global motion_frames, motion_points, motion_points_max
+    if not MOTION_SAMPLING or prev_pos is None or prev_ms is None or now_ms <= prev_ms:
+        xs, ys, ts = [pos[0], pos[0]], [pos[1], pos[1]], [now_ms, now_ms]
+    else:
+        pts = list(moves)
+        if not pts or tuple(pts[-1]) != tuple(pos):
+            pts.append(pos)
+        n = len(pts)
+        xs = [prev_pos[0]] + [p[0] for p in pts]
+        ys = [prev_pos[1]] + [p[1] for p in pts]
+        ts = [prev_ms] + [prev_ms + (now_ms - prev_ms) * (i + 1) / n for i in range(n)]
+    path = interpolate_path(xs, ys, ts, MOTION_STEP_PX, MOTION_MAX_SAMPLES)
+
+    motion_frames += 1
+    motion_points += len(path[0])
+    motion_points_max = max(motion_points_max, len(path[0]))
+    return path
+
+def pointer_path(prev_pos, prev_ms, moves, pos, now_ms, last_send_ms, entered):
+    """
+    1つのポインタ（マウス / 指）について、このフレームで色を引く点 -> (ixs, iys, ts, radius)
+    - 前フレームからの通り道のうち、画像の上で、送信間隔が空いてからの点だけ（入った直後は全部）
+    """
+    speed = 0.0
+    if prev_pos is not None:
+        speed = math.hypot(pos[0] - prev_pos[0], pos[1] - prev_pos[1])
+    radius = sample_radius_for_speed(speed)
+
+    xs, ys, ts = cursor_path(prev_pos, prev_ms, moves, pos, now_ms)
+    ixs, iys = xs - img_x, ys - img_y
+    usable = (ixs >= 0) & (ixs < new_w) & (iys >= 0) & (iys < new_h)
+    if not entered:
+        usable &= ts >= last_send_ms + OSC_MIN_INTERVAL_MS
+    return ixs[usable], iys[usable], ts[usable].tolist(), radius
+
+def lookup_paths(paths):
+    """
+    [(ixs, iys, radius), ...] -> ポインタごとの lookup_path の結果
+    - 同じ半径のポインタはつなげて1回で引く
+    """
+    out = [None] * len(paths)
+    for radius in set(r for _, _, r in paths):
+        idx = [i for i, path in enumerate(paths) if path[2] == radius]
+        sizes = [len(paths[i][0]) for i in idx]
+        samples = lookup_path(
+            np.concatenate([paths[i][0] for i in idx]),
+            np.concatenate([paths[i][1] for i in idx]),
+            radius
+        )
+        start = 0
+        for i, n in zip(idx, sizes):
+            out[i] = samples[start:start + n]
+            start += n
+    return out
+
+def pick_sends(samples, ts, last_rgb, last_region, last_send_ms, entered):
+    """
+    通り道の色のうち送るものだけ -> [(rgb, hsv, 色面のキー, 質感, t), ...]
+    - RGB_DELTA_THRESHOLD（--send-on label / region なら色面の境目）と OSC_MIN_INTERVAL_MS を点ごとの時刻で判定
+    - entered（画像に入った直後）なら最初の1回は間隔を待たない
+    """
+    out = []
+    for (rgb, hsv, key, texture), t in zip(samples, ts):
+        if not should_send_color(rgb, key, t, last_rgb, last_region, last_send_ms, entered,
+                                 SEND_ON, RGB_DELTA_THRESHOLD, OSC_MIN_INTERVAL_MS):
+            continue
+        out.append((rgb, hsv, key, texture, t))
+        last_rgb, last_region, last_send_ms, entered = rgb, key, t, False
+    return out
+
+def lookup_path(ixs, iys, radius=SAMPLE_RADIUS_PX):
+    """
+    画像内座標の配列 -> [((r, g, b), (h1, s1, v1), 色面のキー, 質感), ...]
+    - 色面のキーは --send-on label なら音のラベル、region なら (ラベル, 色面の番号)、color なら None
+    - 質感は --texture のときだけ（lookup_texture と同じもの。それ以外は None）
+    - 等倍・既定の半径ならグリッドをまとめて引く。それ以外は1点ずつ
+    """
+    global motion_lookups
+    motion_lookups += len(ixs)
+    if radius == SAMPLE_RADIUS_PX and not view_zoomed():
+        cx = (ixs // SAMPLE_GRID_STEP).clip(0, GRID_W - 1)
+        cy = (iys // SAMPLE_GRID_STEP).clip(0, GRID_H - 1)
+        rgbs = [tuple(v) for v in grid_rgb[cx, cy].tolist()]
+        hsvs = [tuple(v) for v in grid_hsv[cx, cy].tolist()]
+        if SEND_ON == "color":
+            keys = [None] * len(rgbs)
+        elif grid_labels is not None:
+            labels = grid_labels[cx, cy].tolist()
+            keys = labels if SEND_ON == "label" else list(zip(labels, grid_regions[cx, cy].tolist()))
+        else:
+            keys = [sample_region_key(int(x), int(y), hsv, radius) for x, y, hsv in zip(ixs, iys, hsvs)]
+        if grid_texture is not None:
+            textures = [tuple(v) for v in grid_texture[cx, cy].tolist()]
+        else:
+            textures = [None] * len(rgbs)
+        return list(zip(rgbs, hsvs, keys, textures))
+
+    out = []
+    for x, y in zip(ixs.tolist(), iys.tolist()):
+        if view_zoomed():
+            rgb, hsv = lookup_color_zoomed(x, y, radius)
+        else:
+            rgb, hsv = lookup_color(x, y, radius)
+        key = None if SEND_ON == "color" else sample_region_key(x, y, hsv, radius)
+        out.append((rgb, hsv, key, lookup_texture(x, y)))
+    return out
+
+def sample_region_key(ix, iy, hsv, radius=SAMPLE_RADIUS_PX):
+    label, region = sample_region(ix, iy, hsv, radius)
+    return label if SEND_ON == "label" else (label, region)
+
+def count_motion_send(t, now_ms):
+    """
+    実際に送った（OscSender でまとめられずに出ていく）/rgb・/hsv の送信を数える
+    """
+    global motion_sends, motion_sends_between
+    motion_sends += 1
+    if t < now_ms:
+        motion_sends_between += 1
+
+def print_motion_stats():
+    if not motion_frames:
+        return
+    print(
+        f"✅ Motion sampling: {motion_points} path points over {motion_frames} pointer-frames"
+        f" (avg {motion_points / motion_frames:.1f}, max {motion_points_max}), {motion_lookups} looked up,"
+        + (" color sends counted by the sonify worker" if SONIFY_PROCESS else
+           f" {motion_sends_between} of {motion_sends} color sends between frames")
+    )
+
+# ============================================================
+# 8.10) TOUCH POINTERS (タッチテーブルで複数の指を別々の声部として扱う)
+# ============================================================
+# FINGERDOWN / FINGERMOTION / FINGERUP を指ごとのポインタとして追い、
+# それぞれ /p/<番号>/rgb・/p/<番号>/hsv で送る（番号は 1〜MAX_TOUCH_POINTERS、空いている一番小さいもの）
+# 送るきっかけ・間隔の判定はマウスと同じものを指ごとに持ち、色はマウスと合わせて1フレーム1回で引く
+# 画像の外へ出た・指を離した・Watch OFF のときは /p/<番号>/rgb・hsv に 0 0 0
+# （タッチ画面では SDL が1本目の指でマウスも動かすので、/rgb・/hsv は従来どおり届く）
+#   python klee_main.py --no-touch   … 指を個別に扱わない
+TOUCH_ENABLED = "--no-touch" not in sys.argv
+MAX_TOUCH_POINTERS = 16
+
+# (touch_id, finger_id) -> ポインタの状態
+touch_pointers = {}
+touch_dropped = 0
+
+def point_in_image(pos):
+    return img_x <= pos[0] < img_x + new_w and img_y <= pos[1] < img_y + new_h
+
+def track_finger(ev):
+    """
+    指のイベントをポインタの状態に反映する（色はフレームの最後にまとめて読む）
+    """
+    global touch_dropped
+    key = (ev.touch_id, ev.finger_id)
+    pos = (max(0, min(SCREEN_W - 1, int(ev.x * SCREEN_W))), max(0, min(SCREEN_H - 1, int(ev.y * SCREEN_H))))
+    p = touch_pointers.get(key)
+    if ev.type == pygame.FINGERDOWN and p is None:
+        used = set(q["slot"] for q in touch_pointers.values())
+        free = [n for n in range(1, MAX_TOUCH_POINTERS + 1) if n not in used]
+        if not free:
+            if touch_dropped == 0:
+                print(f"⚠️ more than {MAX_TOUCH_POINTERS} touches; extra fingers are ignored")
+            touch_dropped += 1
+            return
+        touch_pointers[key] = {
+            "slot": free[0], "pos": pos, "prev_pos": None, "prev_ms": None, "moves": [], "up": False,
+            "inside": False, "color": (0, 0, 0),
+            "last_sent_rgb": None, "last_sent_hsv": None, "last_sent_texture": None, "last_sent_region": None,
+            "last_color_send_ms": 0,
+        }
+        return
+    if p is None:
+        return
+    p["moves"].append(pos)
+    p["pos"] = pos
+    if ev.type == pygame.FINGERUP:
+        p["up"] = True
+
+def any_touch_in_image():
+    return any(point_in_image(p["pos"]) for p in touch_pointers.values())
+
+def touch_sampling_paths(now_ms, every_point=False):
+    """
+    色を読む指ごとの (ポインタ, pointer_path の結果)（メイン画面・Watch 中・画像の上の指だけ）
+    - every_point なら送信間隔で間引かない（--sonify-process：判定はワーカーがする）
+    """
+    if state != STATE_MAIN or not watch_enabled:
+        return []
+    return [
+        (p, pointer_path(p["prev_pos"], p["prev_ms"], p["moves"], p["pos"], now_ms,
+                         p["last_color_send_ms"], every_point or not p["inside"]))
+        for p in touch_pointers.values() if point_in_image(p["pos"])
+    ]
+
+def apply_touch_samples(touch_paths, samples_list, now_ms):
+    """
+    指ごとに送るかどうかを決めて /p/<番号>/... を送り、フレームの終わりの片付けをする
+    """
+    sampled = set()
+    for (p, path), samples in zip(touch_paths, samples_list):
+        prefix = f"/p/{p['slot']}"
+        for rgb, hsv, key, texture, t in pick_sends(
+            samples, path[2], p["last_sent_rgb"], p["last_sent_region"], p["last_color_send_ms"], not p["inside"]
+        ):
+            # 通り道の点ごとの送信なので、同じフレームの同じアドレスでもまとめずに全部送る
+            sent = False
+            try:
+                if p["last_sent_rgb"] != rgb:
+                    client.send_message(prefix + "/rgb", list(rgb), at=event_clock(t, now_ms), coalesce=False)
+                    p["last_sent_rgb"] = rgb
+                    sent = True
+                if p["last_sent_hsv"] != hsv:
+                    client.send_message(prefix + "/hsv", list(hsv), at=event_clock(t, now_ms), coalesce=False)
+                    p["last_sent_hsv"] = hsv
+                    sent = True
+                if texture is not None and p["last_sent_texture"] != texture:
+                    client.send_message(prefix + "/texture", list(texture), at=event_clock(t, now_ms),
+                                        coalesce=False)
+                    p["last_sent_texture"] = texture
+            except Exception:
+                pass
+            p["last_sent_region"] = key
+            p["last_color_send_ms"] = t
+            p["color"] = rgb
+            if sent:
+                count_motion_send(t, now_ms)
+        p["inside"] = True
+        sampled.add(p["slot"])
+    finish_touch_frame(now_ms, sampled)
+
+def zero_touch_pointer(p):
+    prefix = f"/p/{p['slot']}"
+    if sonify is not None:
+        release_sonify_pointer(p["slot"])
+    else:
+        try:
+            client.send_message(prefix + "/rgb", [0, 0, 0])
+            client.send_message(prefix + "/hsv", [0, 0, 0])
+            if TEXTURE_ENABLED:
+                client.send_message(prefix + "/texture", [0, 0, 0, 0])
+        except Exception:
+            pass
+    p["last_sent_rgb"] = (0, 0, 0)
+    p["last_sent_hsv"] = (0, 0, 0)
+    p["last_sent_texture"] = (0, 0, 0, 0)
+    p["last_sent_region"] = None
+    p["inside"] = False
+
+def finish_touch_frame(now_ms, sampled=()):
+    """
+    このフレームで読まなかった指・離した指を 0 に戻し、離した指を消す
+    """
+    for key, p in list(touch_pointers.items()):
+        if p["inside"] and (p["slot"] not in sampled or p["up"]):
+            zero_touch_pointer(p)
+        if p["up"]:
+            del touch_pointers[key]
+        else:
+            p["prev_pos"], p["prev_ms"], p["moves"] = p["pos"], now_ms, []
+
+def touch_markers():
+    """
+    画面に出す指の印 ((x, y), 最後に送った色) のタプル
+    """
+    return tuple((p["pos"], p["color"]) for p in touch_pointers.values() if p["inside"])
+
+# ============================================================
+# 8.11) SONIFY PROCESS (--sonify-process：色の判定と送信をワーカーに任せる)
+# ============================================================
+# 描画側は通り道の点を送信間隔で間引かずにリングへ積み、判定（RGB_DELTA_THRESHOLD /
+# --send-on / OSC_MIN_INTERVAL_MS）はワーカーが点ごとの時刻で行う。
+# 等倍・既定の半径の点は座標だけ渡し、ワーカーが共有メモリのグリッドで引く。
+# 拡大表示中・半径が既定でない点は、ここで読んだ色をそのまま渡す
+def push_sonify_path(pointer, path, entered, now_ms):
+    """
+    1つのポインタの通り道（pointer_path の結果）をワーカーのリングに積む
+    """
+    global motion_lookups
+    ixs, iys, ts, radius = path
+    n = len(ts)
+    if n == 0:
+        return
+    ts = np.asarray(ts, dtype=np.float64)
+    rows = make_ring_rows(n)
+    rows["at"] = frame_clock - (now_ms - ts) / 1000.0
+    rows["t_ms"] = ts
+    rows["pointer"] = pointer
+    rows["gen"] = sonify_gen
+    if entered:
+        rows["flags"][0] = RING_FLAG_ENTER
+    if radius == SAMPLE_RADIUS_PX and not view_zoomed():
+        rows["kind"] = RING_KIND_POS
+        rows["x"] = ixs
+        rows["y"] = iys
+    else:
+        rows["kind"] = RING_KIND_COLOR
+        motion_lookups += n
+        for i, (x, y) in enumerate(zip(ixs.tolist(), iys.tolist())):
+            if view_zoomed():
+                rgb, hsv = lookup_color_zoomed(x, y, radius)
+            else:
+                rgb, hsv = lookup_color(x, y, radius)
+            rows["rgb"][i] = rgb
+            rows["hsv"][i] = hsv
+            if grid_texture is not None:
+                rows["texture"][i] = lookup_texture(x, y)
+            if SEND_ON != "color":
+                label, region = sample_region(x, y, hsv, radius)
+                rows["label"][i] = label
+                rows["region"][i] = -1 if region is None else region
+    sonify.push(rows)
+
+def release_sonify_pointer(pointer):
+    """
+    ワーカーにポインタを 0 0 0 に戻させる（画像から出た・指を離した）
+    """
+    rows = make_ring_rows(1)
+    rows["kind"] = RING_KIND_RELEASE
+    rows["pointer"] = pointer
+    rows["at"] = time.perf_counter()
+    sonify.push(rows)
+
+def push_sonify_frame(active_now, entered_now, mouse_moves, pos, now_ms):
+    """
+    このフレームの指とマウスの通り道をワーカーに渡す -> 渡せたか
+    （ワーカーが止まっていたら片付けて False。以降はこのプロセスで送る）
+    """
+    global sonify
+    if not sonify.alive():
+        print("❌ Sonify worker exited; sending colors from this process")
+        sonify.close()
+        sonify = None
+        return False
+
+    sampled = set()
+    for p, path in touch_sampling_paths(now_ms, every_point=True):
+        push_sonify_path(p["slot"], path, not p["inside"], now_ms)
+        p["inside"] = True
+        p["color"] = sonify.last_sent(p["slot"])[0]
+        sampled.add(p["slot"])
+    finish_touch_frame(now_ms, sampled)
+
+    if active_now:
+        path = pointer_path(last_mouse_pos, last_mouse_ms, mouse_moves, pos, now_ms, last_color_send_ms, True)
+        push_sonify_path(0, path, entered_now, now_ms)
+    return True
+
+# ============================================================
+# 8.12) STREAM SOURCE (--source：フレームの差し替えとテーブルの更新)
+# ============================================================
+# メイン画面に入ると klee_stream.FrameStream のスレッドが次のフレームを読み、prepare_stream_frame で
+#   1) 表示サイズに縮小
+#   2) Hue / Value ヒストグラムを更新：作り直さず、これまでの分を STREAM_HIST_HALF_LIFE_S の半減期で
+#      減らしてから新しいフレームの分（STREAM_ANALYSIS_STEP ごとに間引いて数える）を足す
+#   3) 代表値が動いたときだけ新しいテーブルを作る（Max へは tables_worker が渡す。
+#      隣の bin との行き来で送り続けないよう、間隔は STREAM_TABLES_MIN_INTERVAL_S 以上あける）
+#   4) 色の引き当て表（グリッド）を作る
+# まで済ませておく。メインループは表示時刻になったフレームを show_stream_frame で差し替えるだけ
+STREAM_ANALYSIS_STEP = 4
+STREAM_HIST_HALF_LIFE_S = 2.0
+STREAM_TABLES_MIN_INTERVAL_S = 1.0
+
+source_stream = None
+stream_hue_hist = None
+stream_val_hist = None
+stream_tables = None
+stream_tables_t = 0.0
+stream_table_updates = 0
+stream_swap_time = 0.0
+stream_swap_max = 0.0
+
+def update_stream_tables(p, dt_s):
+    """
+    フレーム p の分をヒストグラムに足し、代表値が動いていれば新しいテーブルを p["tables"] に入れる
+    （動いていなければ前のフレームと同じ dict のまま）
+    """
+    global stream_hue_hist, stream_val_hist, stream_tables, stream_tables_t, stream_table_updates
+    gen, params = analysis_snapshot
+    p["params_gen"] = gen
+    rgb = surface_to_rgb_array(build_sample_image(p["image"], params.blur_downscale), step=STREAM_ANALYSIS_STEP)
+    hue_hist, val_hist = build_histograms_from_rgb(
+        rgb, hue_min_s=params.hue_min_s, hue_min_v=params.hue_min_v, value_min_v=params.value_min_v
+    )
+    decay = 0.5 ** (dt_s / STREAM_HIST_HALF_LIFE_S)
+    stream_hue_hist = decay_histogram(stream_hue_hist, hue_hist, decay)
+    stream_val_hist = decay_histogram(stream_val_hist, val_hist, decay)
+
+    if stream_tables is None:
+        # 起動時に解析した先頭フレームのテーブルから始める
+        stream_tables = current_painting["tables"]
+    p["tables"] = stream_tables
+    now = time.perf_counter()
+    if now - stream_tables_t < STREAM_TABLES_MIN_INTERVAL_S:
+        return
+    hue_centers, val_centers = pick_centers(
+        np.rint(stream_hue_hist).astype(np.int64), np.rint(stream_val_hist).astype(np.int64), params
+    )
+    if hue_centers == stream_tables["hue_centers"] and val_centers == stream_tables["val_centers"]:
+        return
+    stream_tables = build_tables(hue_centers, val_centers, build_color_histogram_from_rgb(rgb), params)
+    stream_tables_t = now
+    stream_table_updates += 1
+    p["tables"] = stream_tables
+
+def prepare_stream_frame(frame, index, dt_s):
+    """
+    FrameStream のスレッドで呼ばれる：フレーム -> 差し替えるだけの painting
+    """
+    p = stream_painting(frame, index)
+    update_stream_tables(p, dt_s)
+    build_painting_grid(p)
+    return p
+
+def show_stream_frame(p):
+    """
+    用意済みのフレームを表示中の作品にする（同じ大きさなら作品部分だけ描き直す）
+    """
+    global current_painting, image_dim, stream_swap_time, stream_swap_max
+    t0 = time.perf_counter()
+    resized = p["size"] != (new_w, new_h)
+    with gallery_lock:
+        current_painting = p
+        gallery_cache[p["path"]] = p
+        set_painting_globals(p)
+    if resized:
+        place_controls()
+        image_dim = make_image_dim()
+        invalidate_layers(("main_on", "main_off"))
+    else:
+        refresh_image_layers()
+    if p["tables"] is not tables_sent:
+        tables_wakeup.set()
+    dt = time.perf_counter() - t0
+    stream_swap_time += dt
+    stream_swap_max = max(stream_swap_max, dt)
+
+def poll_stream():
+    """
+    メイン画面のフレームごとに呼ぶ。最初の呼び出しで流し始める
+    （タイトル画面にいる間は呼ばれないので止まり、戻ると続きから流れる）
+    """
+    global source_stream
+    if source_reader is None or startup_error is not None:
+        return
+    if source_stream is None:
+        if source_reader.frame_count == 1:
+            return
+        source_stream = FrameStream(source_reader, prepare_stream_frame)
+        source_stream.start(first_index=0)
+        return
+    p = source_stream.poll()
+    if p is not None:
+        show_stream_frame(p)
 
-# 起動直後（Start画面を描く前）に生成して通知
-generate_txt_files_and_notify()
+def print_stream_stats():
+    if source_stream is None:
+        return
+    st = source_stream.stats()
+    print(
+        f"✅ Stream: {st['shown']} frames shown / {st['decoded']} prepared @ {st['fps']:.2f} fps,"
+        f" {st['skipped']} skipped, {st['loops']} loops, {st['resyncs']} resyncs;"
+        f" prepare avg {st['prepare_avg_ms']:.1f} ms / max {st['prepare_max_ms']:.1f} ms,"
+        f" swap avg {stream_swap_time * 1000 / max(1, st['shown']):.2f} ms / max {stream_swap_max * 1000:.2f} ms,"
+        f" late max {st['late_max_ms']:.1f} ms"
+    )
+    print(
+        f"✅ Stream tables: {stream_table_updates} updates"
+        f" (centers unchanged on {max(0, st['decoded'] - stream_table_updates)} frames)"
+    )
 
 # ============================================================
 # 9) UI HELPERS
 # ============================================================
-def draw_button(rect, text, bg, fg):
-    pygame.draw.rect(screen, bg, rect, border_radius=s(10))
-    label = FONT_BIG.render(text, True, fg)
-    screen.blit(
+# 同じ文字列を毎フレーム rasterize しないよう (font, text, color) 単位でキャッシュ
+TEXT_CACHE_MAX = 256
+text_cache = OrderedDict()
+text_cache_hits = 0
+text_cache_misses = 0
+
+def render_text(font, text, color):
+    global text_cache_hits, text_cache_misses
+    key = (font, text, tuple(color))
+    surf = text_cache.get(key)
+    if surf is not None:
+        text_cache.move_to_end(key)
+        text_cache_hits += 1
+        return surf
+    text_cache_misses += 1
+    surf = font.render(text, True, color)
+    text_cache[key] = surf
+    if len(text_cache) > TEXT_CACHE_MAX:
+        text_cache.popitem(last=False)
+    return surf
+
+# Sound / Delay の丸は on/off の2状態しかないので、スプライトを作っておいて blit する
+circle_sprites = {}
+
+def get_circle_sprite(base_r, selected, on_color, off_color):
+    key = (base_r, selected, on_color, off_color)
+    sprite = circle_sprites.get(key)
+    if sprite is None:
+        sprite = pygame.Surface((base_r * 2 + 1, base_r * 2 + 1), pygame.SRCALPHA)
+        c = (base_r, base_r)
+        pygame.draw.circle(sprite, (0, 0, 0), c, base_r)
+        if selected:
+            inner_r = int(base_r * 0.86)
+            color = on_color
+        else:
+            inner_r = int(base_r * 0.80)
+            color = off_color
+        pygame.draw.circle(sprite, color, c, inner_r)
+        circle_sprites[key] = sprite
+    return sprite
+
+def draw_button(rect, text, bg, fg, dst=None):
+    dst = screen if dst is None else dst
+    pygame.draw.rect(dst, bg, rect, border_radius=s(10))
+    label = render_text(FONT_BIG, text, fg)
+    dst.blit(
         label,
         (
             rect.x + (rect.width - label.get_width()) // 2,
@@ -325,34 +1695,21 @@ def inside_rect(rect, pos):
     x, y = pos
     return rect.x <= x <= rect.x + rect.width and rect.y <= y <= rect.y + rect.height
 
-def draw_sound_circle(center, base_r, selected, on_color, off_color):
-    cx, cy = center
-    pygame.draw.circle(screen, (0, 0, 0), (cx, cy), base_r)
-    if selected:
-        inner_r = int(base_r * 0.86)
-        color = on_color
-    else:
-        inner_r = int(base_r * 0.80)
-        color = off_color
-    pygame.draw.circle(screen, color, (cx, cy), inner_r)
-
-def draw_sound_label(center, base_r, text):
-    label = FONT_LABEL.render(text, True, (255, 255, 255))
-    screen.blit(label, (center[0] - label.get_width() // 2, center[1] + base_r + s(10)))
-
-def draw_delay_circle(center, base_r, enabled):
-    pygame.draw.circle(screen, (0, 0, 0), center, base_r)
-    if enabled:
-        inner_r = int(base_r * 0.86)
-        color = (120, 220, 120)
-    else:
-        inner_r = int(base_r * 0.80)
-        color = (200, 120, 120)
-    pygame.draw.circle(screen, color, center, inner_r)
+def draw_sound_circle(center, base_r, selected, on_color, off_color, dst=None):
+    dst = screen if dst is None else dst
+    sprite = get_circle_sprite(base_r, selected, on_color, off_color)
+    dst.blit(sprite, (center[0] - base_r, center[1] - base_r))
 
-def draw_delay_label(center, base_r, text="Delay"):
-    label = FONT_LABEL.render(text, True, (255, 255, 255))
-    screen.blit(label, (center[0] - label.get_width() // 2, center[1] + base_r + s(10)))
+def draw_sound_label(center, base_r, text, dst=None):
+    dst = screen if dst is None else dst
+    label = render_text(FONT_LABEL, text, (255, 255, 255))
+    dst.blit(label, (center[0] - label.get_width() // 2, center[1] + base_r + s(10)))
+
+def draw_delay_circle(center, base_r, enabled, dst=None):
+    draw_sound_circle(center, base_r, enabled, (120, 220, 120), (200, 120, 120), dst=dst)
+
+def draw_delay_label(center, base_r, text="Delay", dst=None):
+    draw_sound_label(center, base_r, text, dst=dst)
 
 # ============================================================
 # 10) STATES
@@ -367,16 +1724,10 @@ exit_rect = pygame.Rect(SCREEN_W - s(150), s(20), s(130), s(52))
 # ============================================================
 # 11) UI PLACEMENT (Watch button etc.)
 # ============================================================
+# Watch・Sound・Delay は作品画像の下に並べる（位置は place_controls() で作品ごとに決める）
 WATCH_W = s(170)
 WATCH_H = s(48)
 
-watch_rect = pygame.Rect(
-    SCREEN_W // 2 - WATCH_W // 2,
-    img_y + new_h + s(100),
-    WATCH_W,
-    WATCH_H
-)
-
 watch_enabled = False
 running = True
 
@@ -393,33 +1744,7 @@ ON_YELLOW = (255, 220, 90)
 OFF_YELLOW = (95, 80, 35)
 
 WATCH_TO_CIRCLES_GAP = s(86)
-
-circles_y = watch_rect.y + watch_rect.height + WATCH_TO_CIRCLES_GAP
-circles_x0 = SCREEN_W // 2 - CIRCLE_GAP
-
-sound1_center = (int(circles_x0 + CIRCLE_GAP * 0), int(circles_y))
-sound2_center = (int(circles_x0 + CIRCLE_GAP * 1), int(circles_y))
-sound3_center = (int(circles_x0 + CIRCLE_GAP * 2), int(circles_y))
-
 CLICK_PAD = s(12)
-sound1_rect = pygame.Rect(
-    sound1_center[0] - BASE_R - CLICK_PAD,
-    sound1_center[1] - BASE_R - CLICK_PAD,
-    (BASE_R + CLICK_PAD) * 2,
-    (BASE_R + CLICK_PAD) * 2
-)
-sound2_rect = pygame.Rect(
-    sound2_center[0] - BASE_R - CLICK_PAD,
-    sound2_center[1] - BASE_R - CLICK_PAD,
-    (BASE_R + CLICK_PAD) * 2,
-    (BASE_R + CLICK_PAD) * 2
-)
-sound3_rect = pygame.Rect(
-    sound3_center[0] - BASE_R - CLICK_PAD,
-    sound3_center[1] - BASE_R - CLICK_PAD,
-    (BASE_R + CLICK_PAD) * 2,
-    (BASE_R + CLICK_PAD) * 2
-)
 
 def send_modes(value: int):
     global last_modes_sent
@@ -464,13 +1789,64 @@ def send_delay(value: int):
 
 DELAY_R = s(24)
 DELAY_GAP = s(120)
-delay_center = (sound3_center[0] + DELAY_GAP, sound3_center[1])
-delay_rect = pygame.Rect(
-    delay_center[0] - (DELAY_R + CLICK_PAD),
-    delay_center[1] - (DELAY_R + CLICK_PAD),
-    (DELAY_R + CLICK_PAD) * 2,
-    (DELAY_R + CLICK_PAD) * 2
-)
+
+# ============================================================
+# 14.5) CONTROL PLACEMENT (作品画像の大きさに合わせて配置)
+# ============================================================
+def place_controls():
+    """
+    Watch ボタン・Sound・Delay の位置を、今の作品画像 (img_y, new_h) から決める
+    """
+    global watch_rect, sound1_center, sound2_center, sound3_center
+    global sound1_rect, sound2_rect, sound3_rect, delay_center, delay_rect
+
+    watch_rect = pygame.Rect(
+        SCREEN_W // 2 - WATCH_W // 2,
+        img_y + new_h + s(100),
+        WATCH_W,
+        WATCH_H
+    )
+
+    circles_y = watch_rect.y + watch_rect.height + WATCH_TO_CIRCLES_GAP
+    circles_x0 = SCREEN_W // 2 - CIRCLE_GAP
+
+    sound1_center = (int(circles_x0 + CIRCLE_GAP * 0), int(circles_y))
+    sound2_center = (int(circles_x0 + CIRCLE_GAP * 1), int(circles_y))
+    sound3_center = (int(circles_x0 + CIRCLE_GAP * 2), int(circles_y))
+
+    sound1_rect = pygame.Rect(
+        sound1_center[0] - BASE_R - CLICK_PAD,
+        sound1_center[1] - BASE_R - CLICK_PAD,
+        (BASE_R + CLICK_PAD) * 2,
+        (BASE_R + CLICK_PAD) * 2
+    )
+    sound2_rect = pygame.Rect(
+        sound2_center[0] - BASE_R - CLICK_PAD,
+        sound2_center[1] - BASE_R - CLICK_PAD,
+        (BASE_R + CLICK_PAD) * 2,
+        (BASE_R + CLICK_PAD) * 2
+    )
+    sound3_rect = pygame.Rect(
+        sound3_center[0] - BASE_R - CLICK_PAD,
+        sound3_center[1] - BASE_R - CLICK_PAD,
+        (BASE_R + CLICK_PAD) * 2,
+        (BASE_R + CLICK_PAD) * 2
+    )
+
+    delay_center = (sound3_center[0] + DELAY_GAP, sound3_center[1])
+    delay_rect = pygame.Rect(
+        delay_center[0] - (DELAY_R + CLICK_PAD),
+        delay_center[1] - (DELAY_R + CLICK_PAD),
+        (DELAY_R + CLICK_PAD) * 2,
+        (DELAY_R + CLICK_PAD) * 2
+    )
+
+place_controls()
+
+# 作品の切り替え（2枚以上あるときだけ表示）。タイトル・メインとも画面下の左右
+prev_rect = pygame.Rect(s(20), SCREEN_H - s(72), s(130), s(52))
+next_rect = pygame.Rect(SCREEN_W - s(150), SCREEN_H - s(72), s(130), s(52))
+GALLERY_NAV = len(gallery_paths) > 1
 
 # ============================================================
 # 15) COLOR PANEL / OSC STATE
@@ -481,35 +1857,871 @@ rgb_txt = (0, 0, 0)
 hsv_txt = (0, 0, 0)
 
 last_inside_active = False
+last_mouse_pos = None
+last_mouse_ms = None
 last_sent_rgb = None
 last_sent_hsv = None
+last_sent_texture = None
+last_sent_region = None
 last_color_send_ms = 0
 
 def send_zero_color():
-    global last_sent_rgb, last_sent_hsv
-    try:
-        client.send_message("/rgb", [0, 0, 0])
-        client.send_message("/hsv", [0, 0, 0])
-    except Exception:
-        pass
+    global last_sent_rgb, last_sent_hsv, last_sent_texture, last_sent_region
+    if sonify is not None:
+        release_sonify_pointer(0)
+    else:
+        try:
+            client.send_message("/rgb", [0, 0, 0])
+            client.send_message("/hsv", [0, 0, 0])
+            if TEXTURE_ENABLED:
+                client.send_message("/texture", [0, 0, 0, 0])
+        except Exception:
+            pass
     last_sent_rgb = (0, 0, 0)
     last_sent_hsv = (0, 0, 0)
-
-def rgb_delta(a, b):
-    return abs(a[0]-b[0]) + abs(a[1]-b[1]) + abs(a[2]-b[2])
+    last_sent_texture = (0, 0, 0, 0)
+    last_sent_region = None
 
 send_delay(1 if delay_enabled else 0)
 
+# ============================================================
+# 15.5) RENDER LAYERS (静的レイヤーのキャッシュ / dirty rect)
+# ============================================================
+# 背景・額縁・作品・暗幕は一度だけ合成してキャッシュし、
+# ボタン類はその上に「シーン」として焼き込む。
+# 毎フレーム描き直すのはカーソルの十字とカラーパネルだけ。
+DIM_ALPHA = 150
+FRAME_COLORS = ["#f0d468", "#b68a4e", "#ead26c", "#a77945", "#e2ba48"]
+
+static_layers = {}
+scene_surf = pygame.Surface((SCREEN_W, SCREEN_H)).convert()
+
+def make_image_dim():
+    """
+    拡大表示中、Watch していないときに作品部分へかける暗幕
+    """
+    dim = pygame.Surface((new_w, new_h))
+    dim.set_alpha(DIM_ALPHA)
+    dim.fill((0, 0, 0))
+    return dim
+
+image_dim = make_image_dim()
+scene_key = None
+force_full_redraw = True
+dirty_prev = []
+# 動的部分のほかに、次のフレームで描き直す範囲（動画のフレームが変わった作品部分）
+dirty_pending = []
+dynamic_key_prev = None
+
+def build_frame_surface():
+    frame_surf = pygame.Surface((new_w + FRAME_PAD * 2, new_h + FRAME_PAD * 2), pygame.SRCALPHA)
+    offs = [0, s(5), s(10), s(20), s(30)]
+    for c, o in zip(FRAME_COLORS, offs):
+        pygame.draw.rect(
+            frame_surf,
+            pygame.Color(c),
+            (o, o, new_w + FRAME_PAD * 2 - 2 * o, new_h + FRAME_PAD * 2 - 2 * o)
+        )
+    return frame_surf
+
+# 暗幕と、暗幕をかけた背景（作品に関係ないので一度だけ作る）
+screen_dim = pygame.Surface((SCREEN_W, SCREEN_H))
+screen_dim.set_alpha(DIM_ALPHA)
+screen_dim.fill((0, 0, 0))
+dimmed_background = None
+
+def get_dimmed_background():
+    global dimmed_background
+    if dimmed_background is None:
+        dimmed_background = background.copy()
+        dimmed_background.blit(screen_dim, (0, 0))
+    return dimmed_background
+
+def build_static_layer(kind):
+    """
+    kind: "title" / "main_on"(Watch中) / "main_off"(暗幕あり)
+    """
+    if kind == "title":
+        layer = get_dimmed_background().copy()
+        title = render_text(FONT_TITLE, "Welcome to the Paul Klee exhibition", (255, 255, 255))
+        layer.blit(title, ((SCREEN_W - title.get_width()) // 2, SCREEN_H // 2 - s(60)))
+        return layer
+
+    if kind == "main_on":
+        layer = background.copy()
+        layer.blit(build_frame_surface(), (img_x - FRAME_PAD, img_y - FRAME_PAD))
+        layer.blit(scaled_image, (img_x, img_y))
+        return layer
+
+    # 額縁は不透明なので、暗くした背景に額縁と作品を置いてから、その範囲だけ暗幕をかければ
+    # 「全部置いてから全面に暗幕」と同じ結果になる（切り替え時に全面の合成をしないで済む）
+    layer = get_dimmed_background().copy()
+    frame_rect = layer.blit(build_frame_surface(), (img_x - FRAME_PAD, img_y - FRAME_PAD))
+    layer.blit(scaled_image, (img_x, img_y))
+    layer.blit(screen_dim, frame_rect.topleft, pygame.Rect(0, 0, frame_rect.width, frame_rect.height))
+    return layer
+
+def get_static_layer(kind):
+    layer = static_layers.get(kind)
+    if layer is None:
+        layer = build_static_layer(kind)
+        static_layers[kind] = layer
+    return layer
+
+def invalidate_layers(kinds=None):
+    """
+    レイアウトや作品画像が変わったときに呼ぶ（次のフレームで作り直す）
+    - kinds を渡すとそのレイヤーだけ捨てる（作品の切り替えではタイトルは残す）
+    """
+    global scene_key, force_full_redraw
+    if kinds is None:
+        static_layers.clear()
+    else:
+        for kind in kinds:
+            static_layers.pop(kind, None)
+    scene_key = None
+    force_full_redraw = True
+
+def refresh_image_layers():
+    """
+    作品画像だけが同じ大きさのまま変わったとき（--source の次のフレーム）、
+    静的レイヤーと scene_surf の作品部分だけを描き直し、次の present で画面に出す
+    """
+    rect = pygame.Rect(img_x, img_y, new_w, new_h)
+    for kind in ("main_on", "main_off"):
+        layer = static_layers.get(kind)
+        if layer is None:
+            continue
+        layer.blit(scaled_image, rect)
+        if kind == "main_off":
+            layer.blit(screen_dim, rect.topleft, pygame.Rect(0, 0, new_w, new_h))
+    if scene_key is not None and scene_key[0] == "main":
+        scene_surf.blit(get_static_layer("main_on" if scene_key[1] else "main_off"), rect, rect)
+        dirty_pending.append(rect)
+
+def render_scene(key):
+    """
+    静的レイヤー + ボタン類を scene_surf に焼き込む（key が変わったときだけ）
+    """
+    if key[0] == "title":
+        _, ready, pct, gallery = key
+        scene_surf.blit(get_static_layer("title"), (0, 0))
+        if ready:
+            draw_button(start_rect, "Start", (255, 255, 255), (0, 0, 0), dst=scene_surf)
+        else:
+            draw_button(start_rect, f"Loading {pct}%", (90, 90, 90), (200, 200, 200), dst=scene_surf)
+        draw_gallery_nav(gallery)
+        return
+
+    _, watch_on, mode, delay_on, view, gallery = key
+    scene_surf.blit(get_static_layer("main_on" if watch_on else "main_off"), (0, 0))
+    if view is not None:
+        scene_surf.blit(render_view(), (img_x, img_y))
+        if not watch_on:
+            scene_surf.blit(image_dim, (img_x, img_y))
+
+    draw_button(exit_rect, "Exit", (255, 255, 255), (0, 0, 0), dst=scene_surf)
+    draw_button(
+        watch_rect,
+        "Close" if watch_on else "Watch",
+        (50, 50, 50) if watch_on else (255, 255, 255),
+        (255, 255, 255) if watch_on else (0, 0, 0),
+        dst=scene_surf
+    )
+
+    draw_sound_circle(sound1_center, BASE_R, mode == 1, ON_YELLOW, OFF_YELLOW, dst=scene_surf)
+    draw_sound_circle(sound2_center, BASE_R, mode == 2, ON_YELLOW, OFF_YELLOW, dst=scene_surf)
+    draw_sound_circle(sound3_center, BASE_R, mode == 3, ON_YELLOW, OFF_YELLOW, dst=scene_surf)
+
+    draw_sound_label(sound1_center, BASE_R, "Sound1", dst=scene_surf)
+    draw_sound_label(sound2_center, BASE_R, "Sound2", dst=scene_surf)
+    draw_sound_label(sound3_center, BASE_R, "Sound3", dst=scene_surf)
+
+    draw_delay_circle(delay_center, DELAY_R, delay_on, dst=scene_surf)
+    draw_delay_label(delay_center, DELAY_R, "Delay", dst=scene_surf)
+    draw_gallery_nav(gallery)
+
+def draw_gallery_nav(label):
+    """
+    Prev / Next ボタンと「作品名 (i/n)」（作品が1枚だけなら何も描かない）
+    """
+    if label is None:
+        return
+    draw_button(prev_rect, "Prev", (255, 255, 255), (0, 0, 0), dst=scene_surf)
+    draw_button(next_rect, "Next", (255, 255, 255), (0, 0, 0), dst=scene_surf)
+    text = render_text(FONT_SMALL, label, (255, 255, 255))
+    scene_surf.blit(text, ((SCREEN_W - text.get_width()) // 2, s(30)))
+
+def draw_dynamic(crosshair_pos, panel, hud=None, touches=()):
+    """
+    十字カーソル・指の印・カラーパネル・(あれば)性能 HUD を screen に描き、描いた範囲の Rect を返す
+    """
+    rects = []
+    if crosshair_pos is not None:
+        cx, cy = crosshair_pos
+        rects.append(pygame.draw.line(screen, (255, 255, 255), (cx - s(6), cy), (cx + s(6), cy), s(2)))
+        rects.append(pygame.draw.line(screen, (255, 255, 255), (cx, cy - s(6)), (cx, cy + s(6)), s(2)))
+
+    for pos, color in touches:
+        rects.append(pygame.draw.circle(screen, color, pos, s(12)))
+        rects.append(pygame.draw.circle(screen, (255, 255, 255), pos, s(12), s(2)))
+
+    if panel is not None:
+        color, rgb_t, hsv_t = panel
+        px, py = s(20), s(20)
+        rects.append(pygame.draw.rect(screen, color, (px, py, s(120), s(120))))
+        t1 = render_text(FONT_SMALL, f"RGB: {rgb_t[0]}, {rgb_t[1]}, {rgb_t[2]}", (255, 255, 255))
+        rects.append(screen.blit(t1, (px, py + s(130))))
+        t2 = render_text(FONT_SMALL, f"HSV: {hsv_t[0]}°, {hsv_t[1]}%, {hsv_t[2]}%", (255, 255, 255))
+        rects.append(screen.blit(t2, (px, py + s(130) + t1.get_height() + s(6))))
+
+    if hud:
+        line_h = FONT_HUD.get_linesize()
+        hx = s(20)
+        hy = SCREEN_H - s(20) - line_h * (len(hud) + 1)
+        box = pygame.Rect(hx - s(8), hy - s(6), s(360), line_h * (len(hud) + 1) + s(12))
+        rects.append(pygame.draw.rect(screen, (0, 0, 0), box))
+        header = render_text(FONT_HUD, f"{'ms':<16} {'p50':>6} {'p95':>6} {'p99':>6}", (160, 160, 160))
+        rects.append(screen.blit(header, (hx, hy)))
+        for i, line in enumerate(hud):
+            label = render_text(FONT_HUD, line, (255, 255, 255))
+            rects.append(screen.blit(label, (hx, hy + line_h * (i + 1))))
+    return rects
+
+# 描画コストの計測（終了時に平均を表示）
+render_time_total = 0.0
+render_frames = 0
+
+def present_frame(key, crosshair_pos=None, panel=None, touches=()):
+    """
+    1フレーム分を画面に出し、かかった時間を記録する（ヘッドレスでは何もしない）
+    """
+    global render_time_total, render_frames
+    if HEADLESS:
+        return
+    t0 = time.perf_counter()
+    try:
+        present_frame_layers(key, crosshair_pos, panel, touches)
+    finally:
+        render_time_total += time.perf_counter() - t0
+        render_frames += 1
+
+def present_frame_layers(key, crosshair_pos, panel, touches=()):
+    """
+    シーンが変わったときだけ全面を描き直して flip、
+    それ以外は前回と今回の動的部分だけ update する
+    """
+    global scene_key, force_full_redraw, dirty_prev, dynamic_key_prev, dirty_pending
+
+    if key != scene_key:
+        render_scene(key)
+        scene_key = key
+        force_full_redraw = True
+
+    hud = perf_hud_lines if perf_hud_enabled else None
+    dynamic_key = (crosshair_pos, panel, hud, touches)
+
+    if force_full_redraw:
+        screen.blit(scene_surf, (0, 0))
+        profiler.mark("layers")
+        dirty_prev = draw_dynamic(crosshair_pos, panel, hud, touches)
+        profiler.mark("widgets")
+        dynamic_key_prev = dynamic_key
+        force_full_redraw = False
+        dirty_pending = []
+        pygame.display.flip()
+        profiler.mark("flip")
+        return
+
+    if dynamic_key == dynamic_key_prev and not dirty_pending:
+        return
+
+    for r in dirty_prev + dirty_pending:
+        screen.blit(scene_surf, r, r)
+    profiler.mark("layers")
+    new_rects = draw_dynamic(crosshair_pos, panel, hud, touches)
+    profiler.mark("widgets")
+    pygame.display.update(dirty_prev + dirty_pending + new_rects)
+    dirty_pending = []
+    profiler.mark("flip")
+    dirty_prev = new_rects
+    dynamic_key_prev = dynamic_key
+
+def print_render_stats():
+    if render_frames <= 0:
+        return
+    print(
+        f"✅ Render: {render_time_total * 1000 / render_frames:.3f} ms/frame avg over {render_frames} frames"
+        f" (text cache: {text_cache_hits} hits / {text_cache_misses} misses)"
+    )
+
+def print_osc_stats():
+    st = client.stats()
+    print(
+        f"✅ OSC: {st['messages_sent']} msgs in {st['packets_sent']} packets"
+        f" ({st['messages_coalesced']} coalesced, {st['frames_deferred']} frames deferred, {st['send_errors']} errors),"
+        f" queue max {st['max_queue_depth']},"
+        f" latency avg {st['latency_avg_ms']:.3f} ms / max {st['latency_max_ms']:.3f} ms"
+    )
+    line = (
+        f"✅ OSC timing: event -> send avg {st['event_delay_avg_ms']:.2f} ms"
+        f" (min {st['event_delay_min_ms']:.2f} / max {st['event_delay_max_ms']:.2f}), jitter {st['event_jitter_ms']:.3f} ms"
+    )
+    if st["scheduled"]:
+        line += (
+            f"; scheduled +{OSC_LATENCY_MS:g} ms, late vs schedule avg {st['lateness_avg_ms']:.3f} ms"
+            f" / max {st['lateness_max_ms']:.3f} ms, {st['scheduled_late']} bundles past due"
+        )
+    print(line)
+
+# フレームの頭の perf_counter（OSC の出来事の時刻の基準）
+frame_clock = time.perf_counter()
+
+def event_clock(t_ms, now_ms):
+    """
+    フレーム内の時刻 t_ms（get_ticks の ms）-> perf_counter の時刻
+    """
+    return frame_clock - (now_ms - t_ms) / 1000.0
+
+# ============================================================
+# 15.6) GALLERY SWITCH (フレームの合間に作品を差し替える)
+# ============================================================
+# Prev / Next はワーカーに切り替え先を頼むだけ。解析済みになったフレームの頭で
+# グローバル・配置・レイヤーを差し替える（先読み済みなら次のフレームで切り替わる）。
+# テーブルの書き出しと /txt 送信はワーカーが続けて行う
+gallery_switches = 0
+gallery_switch_t0 = None
+gallery_switch_max_ms = 0.0
+
+def gallery_label():
+    """
+    シーンのキー兼表示用の「作品名 (i/n)」（作品が1枚なら None）
+    """
+    if not GALLERY_NAV:
+        return None
+    label = f"{current_painting['name']}  ({gallery_index + 1}/{len(gallery_paths)})"
+    if gallery_target is not None:
+        label += f"  → {os.path.basename(gallery_paths[gallery_target])} loading…"
+    return label
+
+def request_painting(step):
+    """
+    今の作品から step 枚先（負なら前）への切り替えを頼む
+    """
+    global gallery_target
+    with gallery_lock:
+        base = gallery_target if gallery_target is not None else gallery_index
+        gallery_target = (base + step) % len(gallery_paths)
+        if gallery_target == gallery_index and reload_path is None:
+            gallery_target = None
+    gallery_wakeup.set()
+
+def poll_gallery_switch():
+    """
+    切り替え先が解析済みなら差し替える（差し替えたら True）
+    """
+    global gallery_target
+    with gallery_lock:
+        if gallery_target is None:
+            return False
+        index = gallery_target
+        p = gallery_cache.get(gallery_paths[index])
+        if p is None:
+            return False
+        gallery_target = None
+    switch_painting(p, index)
+    return True
+
+def switch_painting(p, index):
+    global current_painting, gallery_index, pyramid, pyramid_path, image_dim, pan_drag_pos
+    global gallery_switches, gallery_switch_t0
+    gallery_switch_t0 = time.perf_counter()
+    with gallery_lock:
+        current_painting = p
+        gallery_index = index
+        gallery_cache.move_to_end(p["path"])
+        set_painting_globals(p)
+        pyramid = None
+        pyramid_path = None
+
+    place_controls()
+    image_dim = make_image_dim()
+    set_view(1.0, 0.5, 0.5)
+    pan_drag_pos = None
+    invalidate_layers(("main_on", "main_off"))
+    gallery_switches += 1
+
+def report_gallery_switch():
+    """
+    切り替えたフレームの描画まで終わったところで呼ぶ（差し替え + 1フレーム分の時間）
+    """
+    global gallery_switch_t0, gallery_switch_max_ms, reload_path, reload_t0, reload_txt_t0
+    global reloads, reload_max_ms
+    if gallery_switch_t0 is None:
+        return
+    now = time.perf_counter()
+    ms = (now - gallery_switch_t0) * 1000
+    gallery_switch_t0 = None
+    gallery_switch_max_ms = max(gallery_switch_max_ms, ms)
+    if reload_t0 is not None and current_painting["path"] == reload_path:
+        latency = (now - reload_t0) * 1000
+        reloads += 1
+        reload_max_ms = max(reload_max_ms, latency)
+        print(
+            f"✅ Reloaded {current_painting['name']}: {latency:.1f} ms from detection to new frame"
+            f" (swap + frame {ms:.1f} ms, {reload_write_age_ms + latency:.0f} ms after the file was written)"
+        )
+        reload_txt_t0 = reload_t0
+        reload_path = None
+        reload_t0 = None
+    else:
+        print(f"✅ Switched to {current_painting['name']}: {ms:.1f} ms (swap + frame)")
+    # テーブルの書き出し・/txt 送信、ピラミッド、前後の先読みは、
+    # 切り替えたフレームを出し終えてからワーカーに頼む（描画と CPU を取り合わないように）
+    tables_wakeup.set()
+    gallery_wakeup.set()
+
+def print_gallery_stats():
+    if not GALLERY_NAV:
+        return
+    with gallery_lock:
+        cached = len(gallery_cache)
+        total = sum(painting_bytes(p) for p in gallery_cache.values())
+    print(
+        f"✅ Gallery: {gallery_switches} switches (max {gallery_switch_max_ms:.1f} ms),"
+        f" {cached}/{len(gallery_paths)} paintings cached ({total / 2**20:.1f} MB)"
+    )
+
+# ============================================================
+# 15.7) HOT RELOAD (Image_Main / klee_params.json の変更を再起動なしで反映)
+# ============================================================
+# 監視スレッドが WATCH_POLL_SEC ごとにファイルの (mtime, size) を見て、
+# 2回続けて同じで、最後の書き込みから WATCH_SETTLE_SEC 経った（= コピーが終わった）変更だけを取り込む。
+# 変わった作品は先読みキャッシュから外し、表示中の作品ならワーカーに読み直しを頼む。
+# 解析はワーカー、差し替えは poll_gallery_switch、txt の書き出しと /txt は tables_worker が
+# 作品の切り替えと同じ手順で行う（txt は一時ファイル + rename で置き換える）
+#   python klee_main.py --no-watch            … 監視しない
+#   python klee_main.py --watch-interval 0.5  … 監視の間隔（秒、既定 1.0）
+WATCH_ENABLED = not HEADLESS and "--no-watch" not in sys.argv and source_reader is None
+WATCH_POLL_SEC = float(arg_value("--watch-interval", 1.0))
+WATCH_SETTLE_SEC = 0.5
+
+# 読み直し中の作品と、変更に気づいた時刻（差し替え・/txt までの時間の計測用）
+reload_path = None
+reload_t0 = None
+reload_write_age_ms = 0.0
+reload_txt_t0 = None
+reloads = 0
+reload_max_ms = 0.0
+
+def watch_snapshot():
+    """
+    {path: (mtime_ns, size)}（Image_Main の作品 + klee_params.json。作品はファイル名順）
+    """
+    try:
+        paths = list_gallery_images()
+    except OSError:
+        paths = []
+    snap = {}
+    for path in paths + [ANALYSIS_PARAMS_PATH]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        snap[path] = (st.st_mtime_ns, st.st_size)
+    return snap
+
+def watch_settled(snap):
+    newest = max((mtime for mtime, _ in snap.values()), default=0)
+    return time.time_ns() - newest >= WATCH_SETTLE_SEC * 1e9
+
+def apply_watch_changes(old, new):
+    global gallery_paths, gallery_index, gallery_target, GALLERY_NAV
+    global reload_path, reload_t0, reload_write_age_ms, tables_sent
+    changed = {path for path in set(old) | set(new) if old.get(path) != new.get(path)}
+    newest = max((new[path][0] for path in changed if path in new), default=time.time_ns())
+    params_changed = ANALYSIS_PARAMS_PATH in changed
+    if params_changed:
+        params_changed = apply_analysis_params_file()
+        changed.discard(ANALYSIS_PARAMS_PATH)
+        if params_changed:
+            print("✅ Analysis params reloaded:", analysis_snapshot[1]._asdict())
+
+    paths = [path for path in new if path != ANALYSIS_PARAMS_PATH]
+    if not paths:
+        print("⚠️ Image_Main is empty; keeping", current_painting["name"])
+        return
+    for path in sorted(changed):
+        print("✅ Change detected:", os.path.basename(path) + ("" if path in new else " (removed)"))
+
+    with gallery_lock:
+        if params_changed:
+            # テーブルを作り直すので解析済みの作品はすべて捨てる
+            gallery_cache.clear()
+            gallery_failed.clear()
+        for path in changed:
+            gallery_cache.pop(path, None)
+            gallery_failed.discard(path)
+
+        cur = current_painting["path"]
+        target_path = gallery_paths[gallery_target] if gallery_target is not None else None
+        gallery_paths = paths
+        GALLERY_NAV = len(paths) > 1
+        if cur in paths:
+            gallery_index = paths.index(cur)
+        else:
+            gallery_index = min(gallery_index, len(paths) - 1)
+        gallery_target = paths.index(target_path) if target_path in paths else None
+
+        if params_changed or cur in changed:
+            # 表示中の作品を読み直す（消えていたら同じ位置の作品へ）
+            gallery_target = gallery_index
+            reload_path = paths[gallery_index]
+            reload_t0 = time.perf_counter()
+            reload_write_age_ms = (time.time_ns() - newest) / 1e6
+            tables_sent = None
+    gallery_wakeup.set()
+
+def watch_worker(applied):
+    startup_ready.wait()
+    last = applied
+    while True:
+        time.sleep(WATCH_POLL_SEC)
+        snap = watch_snapshot()
+        if snap == last and snap != applied and watch_settled(snap):
+            try:
+                apply_watch_changes(applied, snap)
+            except Exception as e:
+                print("⚠️ reload failed:", e)
+            applied = snap
+        last = snap
+
+def print_reload_stats():
+    if reloads:
+        print(f"✅ Hot reload: {reloads} reloads (max {reload_max_ms:.1f} ms from detection to new frame)")
+
+if WATCH_ENABLED:
+    watch_thread = threading.Thread(target=watch_worker, args=(watch_snapshot(),), name="klee-watch", daemon=True)
+    watch_thread.start()
+
+# ============================================================
+# 15.8) INPUT (ライブ / 記録 / 再生)
+# ============================================================
+# 軌跡ファイル: 1行1フレーム "t_ms,x,y,click"（click は左クリックがあったフレームだけ 1）
+# その前に、そのフレームに届いた移動イベントを届いた順に1行ずつ書く（フレームの間の通り道と指も同じに再生するため。
+# pygame のイベントには時刻が無いので、t_ms は受け取ったフレームの時刻）
+#   m,t_ms,x,y                                       … MOUSEMOTION の位置
+#   f,t_ms,down|motion|up,touch_id,finger_id,x,y     … FINGERDOWN / FINGERMOTION / FINGERUP（x, y は 0..1）
+#   q,t_ms                                           … QUIT（終わりのフレームまで同じに再生する）
+# イベントの行が無い古い軌跡も読める（フレームの間の点は無いものとして再生する）
+TRACE_FINGER_KINDS = {"down": pygame.FINGERDOWN, "motion": pygame.FINGERMOTION, "up": pygame.FINGERUP}
+TRACE_FINGER_NAMES = {v: k for k, v in TRACE_FINGER_KINDS.items()}
+
+def load_trace(path):
+    """
+    -> [(t_ms, x, y, click, [そのフレームの前に届いたイベントの行, ...]), ...]
+    """
+    frames = []
+    pending = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("t_ms"):
+                continue
+            fields = line.split(",")
+            if fields[0] == "m":
+                pending.append(("m", int(fields[2]), int(fields[3])))
+            elif fields[0] == "q":
+                pending.append(("q",))
+            elif fields[0] == "f":
+                pending.append((
+                    "f", TRACE_FINGER_KINDS[fields[2]], int(fields[3]), int(fields[4]),
+                    float(fields[5]), float(fields[6])
+                ))
+            else:
+                t_ms, x, y, click = fields[:4]
+                frames.append((int(t_ms), int(x), int(y), int(click), pending))
+                pending = []
+    return frames
+
+def record_trace_frame(now_ms, pos, events):
+    for ev in events:
+        if ev.type == pygame.MOUSEMOTION:
+            record_file.write(f"m,{now_ms},{ev.pos[0]},{ev.pos[1]}\n")
+        elif ev.type in TRACE_FINGER_NAMES:
+            record_file.write(
+                f"f,{now_ms},{TRACE_FINGER_NAMES[ev.type]},{ev.touch_id},{ev.finger_id},{ev.x!r},{ev.y!r}\n"
+            )
+        elif ev.type == pygame.QUIT:
+            record_file.write(f"q,{now_ms}\n")
+    click = any(ev.type == pygame.MOUSEBUTTONDOWN and ev.button == 1 for ev in events)
+    record_file.write(f"{now_ms},{pos[0]},{pos[1]},{1 if click else 0}\n")
+
+def trace_events(rows):
+    """
+    軌跡のイベントの行 -> 再生用の pygame イベント
+    """
+    events = []
+    for row in rows:
+        if row[0] == "m":
+            events.append(pygame.event.Event(pygame.MOUSEMOTION, pos=(row[1], row[2]), rel=(0, 0), buttons=(0, 0, 0)))
+        elif row[0] == "q":
+            events.append(pygame.event.Event(pygame.QUIT))
+        else:
+            _, kind, touch_id, finger_id, x, y = row
+            events.append(pygame.event.Event(
+                kind, touch_id=touch_id, finger_id=finger_id, x=x, y=y, dx=0.0, dy=0.0, pressure=1.0
+            ))
+    return events
+
+replay_frames = load_trace(REPLAY_PATH) if HEADLESS else []
+replay_index = 0
+replay_t0 = None
+replay_last = (0, (0, 0))
+
+record_file = None
+if RECORD_PATH:
+    record_file = open(RECORD_PATH, "w", encoding="utf-8")
+    record_file.write("t_ms,x,y,click\n")
+
+def read_input():
+    """
+    1フレーム分の入力 -> (now_ms, (mx, my), events)
+    """
+    global replay_index, replay_t0, replay_last, idle_wait_event
+
+    if not HEADLESS:
+        now_ms = pygame.time.get_ticks()
+        pos = pygame.mouse.get_pos()
+        events = pygame.event.get()
+        if idle_wait_event is not None:
+            # アイドル中の待ちで受け取ったイベントを先頭に戻す
+            events.insert(0, idle_wait_event)
+            idle_wait_event = None
+        if record_file is not None:
+            record_trace_frame(now_ms, pos, events)
+        return now_ms, pos, events
+
+    # 軌跡を使い切ったら通常の終了と同じく QUIT
+    if replay_index >= len(replay_frames):
+        return replay_last[0], replay_last[1], [pygame.event.Event(pygame.QUIT)]
+
+    t_ms, x, y, click, rows = replay_frames[replay_index]
+    replay_index += 1
+
+    if REPLAY_REALTIME:
+        if replay_t0 is None:
+            replay_t0 = time.perf_counter() - t_ms / 1000.0
+        wait = replay_t0 + t_ms / 1000.0 - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+    events = trace_events(rows)
+    if click:
+        events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=(x, y), button=1))
+    replay_last = (t_ms, (x, y))
+    return t_ms, (x, y), events
+
+# ============================================================
+# 15.9) FRAME PROFILER (区間ごとの処理時間 / HUD / ログ / OSC)
+# ============================================================
+PERF_WINDOW_FRAMES = 300
+PERF_REPORT_INTERVAL_MS = 1000
+
+profiler = FrameProfiler(FRAME_STAGES, window=PERF_WINDOW_FRAMES, log_path=PERF_LOG_PATH)
+perf_hud_enabled = PERF_HUD_AT_START
+perf_hud_lines = None
+perf_last_report_ms = None
+
+def report_perf(now_ms):
+    """
+    PERF_REPORT_INTERVAL_MS ごとに HUD の文字列更新・ログ追記・/perf 送信を行う
+    """
+    global perf_hud_lines, perf_last_report_ms
+    if not (perf_hud_enabled or PERF_LOG_PATH or PERF_OSC):
+        return
+    if perf_last_report_ms is not None and now_ms - perf_last_report_ms < PERF_REPORT_INTERVAL_MS:
+        return
+    perf_last_report_ms = now_ms
+
+    summary = profiler.summary()
+    fps = clock.get_fps()
+    if perf_hud_enabled:
+        perf_hud_lines = tuple(format_hud_lines(summary, fps))
+    cpu_pct = pacing_cpu_percent()
+    if PERF_LOG_PATH:
+        st = client.stats()
+        profiler.write_log(summary, {"fps": fps, "osc_queue_depth": st["queue_depth"],
+                                     "osc_latency_avg_ms": st["latency_avg_ms"],
+                                     "pacing": pacing_mode, "cpu_pct": cpu_pct})
+    if PERF_OSC:
+        for name, st in summary.items():
+            client.send_message(f"/perf/{name}", [round(st["p50"], 3), round(st["p95"], 3), round(st["p99"], 3)])
+        client.send_message("/perf/fps", round(fps, 1))
+        client.send_message("/perf/cpu", round(cpu_pct, 1))
+
+def end_frame(now_ms):
+    """
+    フレーム分の OSC を送信スレッドへ渡して次のフレームまで待つ（ヘッドレス再生では待たない）
+    """
+    report_gallery_switch()
+    client.flush(now_ms)
+    profiler.mark("osc")
+    if not HEADLESS:
+        pace_frame(now_ms)
+    profiler.mark("tick")
+    profiler.end_frame()
+    report_perf(now_ms)
+
+# ============================================================
+# 15.10) FRAME PACING (何もしていないときは描画の回数を減らす)
+# ============================================================
+# 長時間のキオスク運用向けに、状況に合わせてフレームレートを変える
+#   active  … Watch 中にカーソルが画像の上 / 右ドラッグ中 / 入力から ACTIVE_HOLD_MS 以内 → ACTIVE_FPS
+#   reduced … カーソルが画像の外・Watch OFF・タイトル画面 → REDUCED_FPS
+#   idle    … 入力が IDLE_AFTER_MS 無い → pygame.event.wait で入力を待つ（最長 IDLE_WAIT_MS）
+#             裏の解析・先読み・ピラミッドが終わったときは MAIN_WAKE_EVENT ですぐに起きる
+#             ※ 入力待ちを OS に任せられない SDL ドライバ（dummy / kmsdrm など）では
+#               event.wait が 1ms ごとの空回りになるので、IDLE_POLL_MS ずつ眠って様子を見る
+# 入力（マウス・キー・ホイール）があれば次のフレームから active に戻る
+#   python klee_main.py --fixed-fps   … 常に 60fps（従来どおり）
+ACTIVE_FPS = 60
+REDUCED_FPS = 15
+ACTIVE_HOLD_MS = 1000
+IDLE_AFTER_MS = 5000
+IDLE_WAIT_MS = 500
+IDLE_POLL_MS = 100
+WAIT_EVENT_DRIVERS = ("x11", "wayland", "windows", "cocoa")
+IDLE_BLOCKING_WAIT = pygame.display.get_driver() in WAIT_EVENT_DRIVERS
+ADAPTIVE_FPS = "--fixed-fps" not in sys.argv
+PACING_MODES = ("active", "reduced", "idle")
+
+pacing_mode = "active"
+last_input_ms = 0
+last_input_pos = None
+idle_wait_event = None
+# モードごとの [経過時間 s, メインスレッドの CPU 時間 s, フレーム数]
+pacing_totals = {mode: [0.0, 0.0, 0] for mode in PACING_MODES}
+pacing_t = time.perf_counter()
+pacing_cpu = time.thread_time()
+pacing_energy0 = read_energy_j()
+pacing_report_t = (pacing_t, time.process_time())
+
+def note_input(now_ms, pos, events):
+    """
+    このフレームに入力があったか（マウスが動いた・クリック・キー・ホイール）を記録する
+    """
+    global last_input_ms, last_input_pos
+    if pos != last_input_pos or any(ev.type != MAIN_WAKE_EVENT for ev in events):
+        last_input_ms = now_ms
+    last_input_pos = pos
+
+def choose_pacing_mode(now_ms):
+    if not ADAPTIVE_FPS:
+        return "active"
+    if source_stream is not None and state == STATE_MAIN:
+        return "active"
+    if state == STATE_MAIN and watch_enabled and (inside_image or any_touch_in_image()):
+        return "active"
+    if pan_drag_pos is not None or now_ms - last_input_ms < ACTIVE_HOLD_MS:
+        return "active"
+    # 切り替え待ち・起動中の解析中は、進み具合を出すため止めきらない
+    if now_ms - last_input_ms < IDLE_AFTER_MS or gallery_target is not None or not startup_ready.is_set():
+        return "reduced"
+    return "idle"
+
+def pace_frame(now_ms):
+    """
+    モードに合わせて次のフレームまで待つ。待った時間と CPU 時間をモードごとに数える
+    """
+    global pacing_mode, pacing_t, pacing_cpu, idle_wait_event
+    mode = choose_pacing_mode(now_ms)
+    pacing_mode = mode
+    if mode == "active":
+        clock.tick(ACTIVE_FPS)
+    elif mode == "reduced":
+        clock.tick(REDUCED_FPS)
+    elif IDLE_BLOCKING_WAIT:
+        ev = pygame.event.wait(IDLE_WAIT_MS)
+        if ev.type != pygame.NOEVENT:
+            idle_wait_event = ev
+        clock.tick()
+    else:
+        if not pygame.event.peek():
+            pygame.time.wait(IDLE_POLL_MS)
+        clock.tick()
+
+    t, cpu = time.perf_counter(), time.thread_time()
+    total = pacing_totals[mode]
+    total[0] += t - pacing_t
+    total[1] += cpu - pacing_cpu
+    total[2] += 1
+    pacing_t, pacing_cpu = t, cpu
+
+def pacing_cpu_percent():
+    """
+    前回呼んだときからのプロセスの CPU 使用率 (%)（1コア = 100%）
+    """
+    global pacing_report_t
+    t, cpu = time.perf_counter(), time.process_time()
+    t0, cpu0 = pacing_report_t
+    pacing_report_t = (t, cpu)
+    return (cpu - cpu0) * 100.0 / max(t - t0, 1e-9)
+
+def print_pacing_stats():
+    wall = sum(v[0] for v in pacing_totals.values())
+    if wall <= 0:
+        return
+    parts = []
+    for mode in PACING_MODES:
+        secs, cpu, frames = pacing_totals[mode]
+        if frames:
+            parts.append(f"{mode} {secs:.1f} s ({frames / secs:.1f} fps, CPU {cpu * 100 / secs:.1f}%)")
+    cpu_total = sum(v[1] for v in pacing_totals.values())
+    line = f"✅ Frame pacing: {', '.join(parts)}; main loop CPU {cpu_total * 100 / wall:.1f}%"
+    energy = read_energy_j()
+    if pacing_energy0 is not None and energy is not None and energy >= pacing_energy0:
+        line += f", CPU package {energy - pacing_energy0:.1f} J ({(energy - pacing_energy0) / wall:.2f} W avg)"
+    else:
+        line += ", power n/a (no RAPL counter)"
+    print(line)
+
+def print_replay_stats(wall_s):
+    frames = replay_index
+    st = client.stats()
+    print(
+        f"✅ Replay: {frames} frames in {wall_s * 1000:.1f} ms"
+        f" ({frames / max(wall_s, 1e-9):.0f} frames/s, {st['messages_sent']} OSC messages)"
+    )
+
+first_frame_shown = False
+
+# 再生は Start を押せる状態（解析完了）から始める
+if HEADLESS:
+    startup_ready.wait()
+loop_t0 = time.perf_counter()
+
 # ============================================================
 # 16) MAIN LOOP
 # ============================================================
 while running:
-    now_ms = pygame.time.get_ticks()
+    profiler.begin_frame()
+    now_ms, (mx, my), events = read_input()
+    frame_clock = time.perf_counter()
+    client.set_frame_time(frame_clock)
+    note_input(now_ms, (mx, my), events)
+
+    # 裏の解析が失敗したら従来どおり終了
+    if startup_ready.is_set() and startup_error is not None:
+        running = False
+        break
+
+    # 切り替え先の作品が用意できていれば、このフレームから差し替える
+    poll_gallery_switch()
 
-    mx, my = pygame.mouse.get_pos()
     inside_image = (img_x <= mx < img_x + new_w) and (img_y <= my < img_y + new_h)
 
-    for ev in pygame.event.get():
+    for ev in events:
         if ev.type == pygame.QUIT:
             send_tempo(0)
             send_zero_color()
@@ -522,9 +2734,56 @@ while running:
             send_delay(0)
             running = False
 
+        if ev.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+            force_full_redraw = True
+
+        if TOUCH_ENABLED and ev.type in (pygame.FINGERDOWN, pygame.FINGERMOTION, pygame.FINGERUP):
+            track_finger(ev)
+
+        if ev.type == pygame.KEYDOWN and ev.key == pygame.K_F3:
+            perf_hud_enabled = not perf_hud_enabled
+            perf_last_report_ms = None
+
+        # 作品の切り替え（タイトル・メインどちらでも）
+        if GALLERY_NAV:
+            if ev.type == pygame.KEYDOWN and ev.key in (pygame.K_n, pygame.K_PAGEDOWN):
+                request_painting(1)
+            elif ev.type == pygame.KEYDOWN and ev.key in (pygame.K_p, pygame.K_PAGEUP):
+                request_painting(-1)
+            elif ev.type == pygame.MOUSEBUTTONDOWN and ev.button == 1:
+                if inside_rect(next_rect, (mx, my)):
+                    request_painting(1)
+                elif inside_rect(prev_rect, (mx, my)):
+                    request_painting(-1)
+
+        # 拡大・移動（ピラミッドができてから）
+        if state == STATE_MAIN and pyramid is not None:
+            if ev.type == pygame.MOUSEWHEEL and inside_image and ev.y != 0:
+                zoom_at(ZOOM_STEP ** ev.y, mx - img_x, my - img_y)
+            if ev.type == pygame.MOUSEBUTTONDOWN and ev.button == 3 and inside_image:
+                pan_drag_pos = (mx, my)
+            if ev.type == pygame.KEYDOWN:
+                if ev.key in (pygame.K_EQUALS, pygame.K_PLUS, pygame.K_KP_PLUS):
+                    zoom_at(ZOOM_STEP, new_w // 2, new_h // 2)
+                elif ev.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                    zoom_at(1.0 / ZOOM_STEP, new_w // 2, new_h // 2)
+                elif ev.key in (pygame.K_0, pygame.K_KP0):
+                    set_view(1.0, 0.5, 0.5)
+                elif ev.key == pygame.K_LEFT:
+                    pan_by(new_w * PAN_KEY_STEP, 0)
+                elif ev.key == pygame.K_RIGHT:
+                    pan_by(-new_w * PAN_KEY_STEP, 0)
+                elif ev.key == pygame.K_UP:
+                    pan_by(0, new_h * PAN_KEY_STEP)
+                elif ev.key == pygame.K_DOWN:
+                    pan_by(0, -new_h * PAN_KEY_STEP)
+        if ev.type == pygame.MOUSEBUTTONUP and ev.button == 3:
+            pan_drag_pos = None
+
         if ev.type == pygame.MOUSEBUTTONDOWN and ev.button == 1:
             if state == STATE_TITLE:
-                if inside_rect(start_rect, (mx, my)):
+                # 解析（txt 書き出し + /txt 送信）が終わるまでは Start を押せない
+                if startup_ready.is_set() and inside_rect(start_rect, (mx, my)):
                     state = STATE_MAIN
                     watch_enabled = False
                     send_tempo(0)
@@ -536,6 +2795,8 @@ while running:
                 if inside_rect(exit_rect, (mx, my)):
                     state = STATE_TITLE
                     watch_enabled = False
+                    set_view(1.0, 0.5, 0.5)
+                    pan_drag_pos = None
                     send_tempo(0)
                     send_zero_color()
                     send_delay(1 if delay_enabled else 0)
@@ -563,109 +2824,80 @@ while running:
     send_modes(modes)
     send_delay(1 if delay_enabled else 0)
 
-    desired_tempo = 1 if (watch_enabled and inside_image) else 0
-    send_tempo(desired_tempo)
+    # 右ドラッグ中は画像をカーソルに追従させる
+    if pan_drag_pos is not None:
+        pan_by(mx - pan_drag_pos[0], my - pan_drag_pos[1])
+        pan_drag_pos = (mx, my)
 
-    screen.blit(background, (0, 0))
+    desired_tempo = 1 if (watch_enabled and (inside_image or any_touch_in_image())) else 0
+    send_tempo(desired_tempo)
+    profiler.mark("events")
 
     if state == STATE_TITLE:
-        overlay = pygame.Surface((SCREEN_W, SCREEN_H))
-        overlay.set_alpha(150)
-        overlay.fill((0, 0, 0))
-        screen.blit(overlay, (0, 0))
-
-        title = FONT_TITLE.render("Welcome to the Paul Klee exhibition", True, (255, 255, 255))
-        screen.blit(title, ((SCREEN_W - title.get_width()) // 2, SCREEN_H // 2 - s(60)))
-        draw_button(start_rect, "Start", (255, 255, 255), (0, 0, 0))
-
-        pygame.display.flip()
-        clock.tick(60)
+        finish_touch_frame(now_ms)
+        present_frame(("title", startup_ready.is_set(), int(startup_progress * 100), gallery_label()))
+        if not first_frame_shown:
+            first_frame_shown = True
+            print(f"✅ Time to first frame: {(time.perf_counter() - PROCESS_T0) * 1000:.1f} ms")
+        end_frame(now_ms)
         continue
 
-    frame_surf = pygame.Surface((new_w + FRAME_PAD * 2, new_h + FRAME_PAD * 2), pygame.SRCALPHA)
-    cols = ["#f0d468", "#b68a4e", "#ead26c", "#a77945", "#e2ba48"]
-    offs = [0, s(5), s(10), s(20), s(30)]
-    for c, o in zip(cols, offs):
-        pygame.draw.rect(
-            frame_surf,
-            pygame.Color(c),
-            (o, o, new_w + FRAME_PAD * 2 - 2 * o, new_h + FRAME_PAD * 2 - 2 * o)
-        )
-    screen.blit(frame_surf, (img_x - FRAME_PAD, img_y - FRAME_PAD))
-
-    screen.blit(scaled_image, (img_x, img_y))
-
-    if not watch_enabled:
-        ov = pygame.Surface((SCREEN_W, SCREEN_H))
-        ov.set_alpha(150)
-        ov.fill((0, 0, 0))
-        screen.blit(ov, (0, 0))
-
-    draw_button(exit_rect, "Exit", (255, 255, 255), (0, 0, 0))
-    draw_button(
-        watch_rect,
-        "Close" if watch_enabled else "Watch",
-        (50, 50, 50) if watch_enabled else (255, 255, 255),
-        (255, 255, 255) if watch_enabled else (0, 0, 0)
-    )
-
-    draw_sound_circle(sound1_center, BASE_R, modes == 1, ON_YELLOW, OFF_YELLOW)
-    draw_sound_circle(sound2_center, BASE_R, modes == 2, ON_YELLOW, OFF_YELLOW)
-    draw_sound_circle(sound3_center, BASE_R, modes == 3, ON_YELLOW, OFF_YELLOW)
-
-    draw_sound_label(sound1_center, BASE_R, "Sound1")
-    draw_sound_label(sound2_center, BASE_R, "Sound2")
-    draw_sound_label(sound3_center, BASE_R, "Sound3")
-
-    draw_delay_circle(delay_center, DELAY_R, delay_enabled)
-    draw_delay_label(delay_center, DELAY_R, "Delay")
-
+    poll_stream()
     active_now = (watch_enabled and inside_image)
 
-    if active_now:
-        ix = mx - img_x
-        iy = my - img_y
-
-        if SAMPLE_STEP_PX and SAMPLE_STEP_PX > 1:
-            ix = (ix // SAMPLE_STEP_PX) * SAMPLE_STEP_PX
-            iy = (iy // SAMPLE_STEP_PX) * SAMPLE_STEP_PX
-            ix = max(0, min(new_w - 1, ix))
-            iy = max(0, min(new_h - 1, iy))
-
-        r, g, b, *_ = sample_image.get_at((ix, iy))
-        sampled_rgb = (r, g, b)
-
-        should_send = True
-        if last_sent_rgb is not None:
-            if rgb_delta(sampled_rgb, last_sent_rgb) < RGB_DELTA_THRESHOLD:
-                should_send = False
-
-        entered_now = (not last_inside_active) and active_now
-
-        rate_ok = (now_ms - last_color_send_ms) >= OSC_MIN_INTERVAL_MS
-        if entered_now:
-            rate_ok = True
+    # マウスと指をまとめて、このフレームで色を引く点を1回で引く
+    entered_now = (not last_inside_active) and active_now
+    mouse_moves = [ev.pos for ev in events if ev.type == pygame.MOUSEMOTION]
+    mouse_sends = []
+    if sonify is not None and push_sonify_frame(active_now, entered_now, mouse_moves, (mx, my), now_ms):
+        # 送るのはワーカー。パネルにはワーカーが最後に送った色を出す
+        if active_now:
+            last_sent_rgb, last_sent_hsv = sonify.last_sent(0)
+            current_color = last_sent_rgb
+    else:
+        touch_paths = touch_sampling_paths(now_ms)
+        paths = [path[:2] + path[3:] for _, path in touch_paths]
+        if active_now:
+            mouse_path = pointer_path(
+                last_mouse_pos, last_mouse_ms, mouse_moves, (mx, my), now_ms, last_color_send_ms, entered_now
+            )
+            paths.append(mouse_path[:2] + mouse_path[3:])
+        samples_all = lookup_paths(paths)
+        apply_touch_samples(touch_paths, samples_all[:len(touch_paths)], now_ms)
+        if active_now:
+            mouse_sends = pick_sends(
+                samples_all[-1], mouse_path[2], last_sent_rgb, last_sent_region, last_color_send_ms, entered_now
+            )
 
-        if should_send and rate_ok:
+    if active_now:
+        for sampled_rgb, sampled_hsv, sampled_region, sampled_texture, t in mouse_sends:
             current_color = sampled_rgb
+            r, g, b = sampled_rgb
+            h1, s1, v1 = sampled_hsv
 
-            h, s2, v2 = rgb_to_hsv(r / 255.0, g / 255.0, b / 255.0)
-            h1, s1, v1 = int(h * 360), int(s2 * 100), int(v2 * 100)
-
+            # 通り道の点ごとの送信なので、同じフレームの同じアドレスでもまとめずに全部送る
+            sent = False
             try:
                 if last_sent_rgb != sampled_rgb:
-                    client.send_message("/rgb", [r, g, b])
+                    client.send_message("/rgb", [r, g, b], at=event_clock(t, now_ms), coalesce=False)
                     last_sent_rgb = sampled_rgb
+                    sent = True
                 if last_sent_hsv != (h1, s1, v1):
-                    client.send_message("/hsv", [h1, s1, v1])
+                    client.send_message("/hsv", [h1, s1, v1], at=event_clock(t, now_ms), coalesce=False)
                     last_sent_hsv = (h1, s1, v1)
+                    sent = True
+                if sampled_texture is not None and last_sent_texture != sampled_texture:
+                    client.send_message("/texture", list(sampled_texture), at=event_clock(t, now_ms),
+                                        coalesce=False)
+                    last_sent_texture = sampled_texture
             except Exception:
                 pass
 
-            last_color_send_ms = now_ms
-
-        pygame.draw.line(screen, (255, 255, 255), (mx - s(6), my), (mx + s(6), my), s(2))
-        pygame.draw.line(screen, (255, 255, 255), (mx, my - s(6)), (mx, my + s(6)), s(2))
+            if SEND_ON != "color":
+                last_sent_region = sampled_region
+            last_color_send_ms = t
+            if sent:
+                count_motion_send(t, now_ms)
 
         show_color_panel = True
         rgb_txt = last_sent_rgb if last_sent_rgb is not None else (0, 0, 0)
@@ -677,23 +2909,43 @@ while running:
             send_zero_color()
 
     last_inside_active = active_now
-
-    if show_color_panel:
-        px, py = s(20), s(20)
-        pygame.draw.rect(screen, current_color, (px, py, s(120), s(120)))
-        t1 = FONT_SMALL.render(f"RGB: {rgb_txt[0]}, {rgb_txt[1]}, {rgb_txt[2]}", True, (255, 255, 255))
-        screen.blit(t1, (px, py + s(130)))
-        t2 = FONT_SMALL.render(f"HSV: {hsv_txt[0]}°, {hsv_txt[1]}%, {hsv_txt[2]}%", True, (255, 255, 255))
-        screen.blit(t2, (px, py + s(130) + t1.get_height() + s(6)))
-
-    pygame.display.flip()
-    clock.tick(60)
+    last_mouse_pos = (mx, my)
+    last_mouse_ms = now_ms
+    profiler.mark("sampling")
+
+    present_frame(
+        ("main", watch_enabled, modes, delay_enabled, view_key(), gallery_label()),
+        crosshair_pos=(mx, my) if active_now else None,
+        touches=touch_markers(),
+        panel=(current_color, rgb_txt, hsv_txt) if show_color_panel else None
+    )
+    end_frame(now_ms)
 
 # ============================================================
 # 17) CLEANUP
 # ============================================================
+finish_touch_frame(0)
 send_tempo(0)
 send_zero_color()
 send_delay(0)
+if sonify is not None:
+    sonify.close()
+if source_stream is not None:
+    source_stream.close()
+client.close()
+profiler.close()
+if record_file is not None:
+    record_file.close()
+if HEADLESS:
+    print_replay_stats(time.perf_counter() - loop_t0)
+print_render_stats()
+print_osc_stats()
+print_pyramid_stats()
+print_gallery_stats()
+print_reload_stats()
+print_motion_stats()
+print_stream_stats()
+if not HEADLESS:
+    print_pacing_stats()
 pygame.quit()
 sys.exit()
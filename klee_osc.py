@@ -0,0 +1,326 @@
+# klee_osc.py
+# OSC 送信をメインループから切り離すためのモジュール
+import heapq
+import json
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from pythonosc import udp_client
+from pythonosc.osc_bundle_builder import OscBundleBuilder, IMMEDIATELY
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+
+def build_osc_message(address, value):
+    builder = OscMessageBuilder(address=address)
+    values = value if isinstance(value, (list, tuple)) else [value]
+    for v in values:
+        builder.add_arg(v)
+    return builder.build()
+
+
+def build_osc_bundle(messages, timetag=IMMEDIATELY):
+    """
+    [(address, value), ...] -> OscBundle
+    """
+    builder = OscBundleBuilder(timetag)
+    for address, value in messages:
+        builder.add_content(build_osc_message(address, value))
+    return builder.build()
+
+
+# 予定時刻の少し前からは queue の待ちをやめ、短い sleep で時刻に合わせる
+SCHEDULE_FINE_WAIT_S = 0.002
+
+
+class OscSender:
+    """
+    SimpleUDPClient と同じ send_message() を持つ非同期の送信係
+    - send_message() はそのフレームの保留リストに積むだけ（同じアドレスは後勝ち。
+      coalesce=False のメッセージは置き換えずに全部送る：フレームの間の通り道の色など）
+    - flush() でフレーム分をまとめて送信スレッドのキューへ渡す
+    - 送信スレッドは溜まっている分をさらにまとめ、1つの OSC bundle として送る
+      （merge_backlog=False ならフレームごとにそのまま送る：再生の検証用）
+    - log_path を渡すと、送った内容を1パケット1行の JSON で書き出す
+    - latency（秒）を渡すと予定送信になる：
+      メッセージごとの出来事の時刻（perf_counter）+ latency に、送信スレッドが時刻どおりに送り、
+      bundle にはその時刻を NTP のタイムタグで付ける（フレームの処理時間・tick の揺れが音に乗らない）
+    """
+
+    def __init__(self, ip, port, use_bundles=True, max_queue=64, merge_backlog=True, log_path=None, latency=None):
+        self.client = udp_client.SimpleUDPClient(ip, port)
+        self.use_bundles = use_bundles
+        self.merge_backlog = merge_backlog
+        self.latency = latency
+        self.log_file = open(log_path, "w", encoding="utf-8") if log_path else None
+        # perf_counter -> UNIX 時刻（起動時に1回だけ合わせ、以後は単調な perf_counter だけで進める）
+        self.clock_offset = time.time() - time.perf_counter()
+
+        # キー -> (address, value, 出来事の時刻)。キーは address か、coalesce=False なら通し番号
+        self.pending = OrderedDict()
+        self.pending_seq = 0
+        self.frame_time = None
+        self.pending_lock = threading.Lock()
+        self.max_queue = max_queue
+        self.queue = queue.Queue()
+
+        # 計測用カウンタ
+        self.messages_in = 0
+        self.messages_coalesced = 0
+        self.messages_sent = 0
+        self.packets_sent = 0
+        self.frames_deferred = 0
+        self.send_errors = 0
+        self.max_queue_depth = 0
+        self.latency_samples = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+        # 出来事の時刻から実際に送るまで（両方のモード）と、予定時刻からの遅れ（予定送信）
+        self.delay_samples = 0
+        self.delay_total = 0.0
+        self.delay_total_sq = 0.0
+        self.delay_min = math.inf
+        self.delay_max = 0.0
+        self.scheduled_late = 0
+        self.lateness_samples = 0
+        self.lateness_total = 0.0
+        self.lateness_max = 0.0
+
+        self.thread = threading.Thread(
+            target=self.run if latency is None else self.run_scheduled, name="klee-osc", daemon=True
+        )
+        self.thread.start()
+
+    # ---------------- 呼び出し側（描画スレッド） ----------------
+    def set_frame_time(self, t):
+        """
+        このフレームのメッセージの既定の出来事の時刻（perf_counter）
+        """
+        self.frame_time = t
+
+    def send_message(self, address, value, at=None, coalesce=True):
+        """
+        at … 出来事の時刻（perf_counter）。省略するとフレームの時刻
+        coalesce=False … 同じアドレスの前の値を置き換えない（1フレームに何回来ても全部送る）
+        """
+        if at is None:
+            at = self.frame_time if self.frame_time is not None else time.perf_counter()
+        with self.pending_lock:
+            if coalesce:
+                key = address
+                if key in self.pending:
+                    self.messages_coalesced += 1
+                    # 後から来た値で置き換え、順序も最新の位置へ
+                    del self.pending[key]
+            else:
+                self.pending_seq += 1
+                key = ("seq", self.pending_seq)
+            self.pending[key] = (address, value, at)
+            self.messages_in += 1
+
+    def take_pending(self):
+        """
+        保留リストを取り出して空にする -> [(キー, address, value, 出来事の時刻), ...]（pending_lock の中で呼ぶ）
+        """
+        entries = [(key,) + entry for key, entry in self.pending.items()]
+        self.pending.clear()
+        return entries
+
+    def flush(self, t_ms=None):
+        """
+        このフレームで積まれたメッセージを送信キューへ渡す（ブロックしない）
+        - 送信が詰まってキューが max_queue を超えているときは渡さずに保留のまま残し、
+          次のフレームの値とまとめる（同じアドレスの古い値はそこで捨てられる。coalesce=False の分は残る）
+        - t_ms はログ用のフレーム時刻
+        """
+        with self.pending_lock:
+            if not self.pending:
+                return
+            if self.max_queue is not None and self.queue.qsize() >= self.max_queue:
+                self.frames_deferred += 1
+                return
+            entries = self.take_pending()
+
+        self.queue.put_nowait((time.perf_counter(), t_ms, entries))
+
+        depth = self.queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def close(self, timeout=1.0):
+        """
+        残りを送り切ってから送信スレッドを止める
+        """
+        with self.pending_lock:
+            entries = self.take_pending()
+        if entries:
+            self.queue.put_nowait((time.perf_counter(), None, entries))
+        self.queue.put_nowait(None)
+        self.thread.join(timeout)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def stats(self):
+        samples = max(1, self.latency_samples)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "messages_in": self.messages_in,
+            "messages_coalesced": self.messages_coalesced,
+            "messages_sent": self.messages_sent,
+            "packets_sent": self.packets_sent,
+            "frames_deferred": self.frames_deferred,
+            "send_errors": self.send_errors,
+            "latency_last_ms": self.latency_last * 1000,
+            "latency_avg_ms": self.latency_total * 1000 / samples,
+            "latency_max_ms": self.latency_max * 1000,
+            "event_delay_avg_ms": self.delay_total * 1000 / max(1, self.delay_samples),
+            "event_delay_min_ms": (self.delay_min if self.delay_samples else 0.0) * 1000,
+            "event_delay_max_ms": self.delay_max * 1000,
+            "event_jitter_ms": self.event_jitter() * 1000,
+            "scheduled": self.latency is not None,
+            "scheduled_late": self.scheduled_late,
+            "lateness_avg_ms": self.lateness_total * 1000 / max(1, self.lateness_samples),
+            "lateness_max_ms": self.lateness_max * 1000,
+        }
+
+    def event_jitter(self):
+        """
+        出来事の時刻から送信までの時間の標準偏差（秒）＝ 受け手から見た発音タイミングの揺れ
+        """
+        if self.delay_samples < 2:
+            return 0.0
+        mean = self.delay_total / self.delay_samples
+        return math.sqrt(max(0.0, self.delay_total_sq / self.delay_samples - mean * mean))
+
+    # ---------------- 送信スレッド ----------------
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            t_enqueued, t_ms, entries = item
+            if not self.merge_backlog:
+                self.send_entries(entries, t_enqueued, t_ms)
+                continue
+
+            # 溜まっている分もまとめて取り出し、同じアドレスは最新の値だけ残す（coalesce=False の分は全部）
+            merged = OrderedDict((e[0], e) for e in entries)
+            stop = False
+            while True:
+                try:
+                    nxt = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                t_ms = nxt[1]
+                for e in nxt[2]:
+                    if e[0] in merged:
+                        self.messages_coalesced += 1
+                        del merged[e[0]]
+                    merged[e[0]] = e
+
+            self.send_entries(list(merged.values()), t_enqueued, t_ms)
+            if stop:
+                return
+
+    def run_scheduled(self):
+        """
+        予定送信：出来事の時刻ごとにまとめた bundle を、時刻 + latency に送る
+        """
+        heap = []
+        seq = 0
+        stop = False
+        while heap or not stop:
+            if not stop:
+                wait = None
+                if heap:
+                    wait = heap[0][0] - time.perf_counter() - SCHEDULE_FINE_WAIT_S
+                if wait is None or wait > 0:
+                    try:
+                        item = self.queue.get(timeout=wait)
+                    except queue.Empty:
+                        item = ()
+                    if item is None:
+                        stop = True
+                        continue
+                    if item:
+                        seq = self.schedule_frame(heap, item, seq)
+                        continue
+
+            due, _, t_enqueued, t_ms, messages, times = heap[0]
+            rest = due - time.perf_counter()
+            if rest > 0:
+                time.sleep(rest)
+            heapq.heappop(heap)
+
+            lateness = max(0.0, time.perf_counter() - due)
+            self.lateness_samples += 1
+            self.lateness_total += lateness
+            if lateness > self.lateness_max:
+                self.lateness_max = lateness
+            self.send_frame(messages, t_enqueued, t_ms, times, timetag=due + self.clock_offset)
+
+    def schedule_frame(self, heap, item, seq):
+        """
+        フレーム分のメッセージを出来事の時刻ごとに分けて heap に積む -> 次の seq
+        """
+        t_enqueued, t_ms, entries = item
+        groups = OrderedDict()
+        for _, address, value, at in entries:
+            groups.setdefault(at, []).append((address, value))
+        now = time.perf_counter()
+        for at, messages in groups.items():
+            due = at + self.latency
+            if due < now:
+                # latency が短すぎてもう間に合わない（すぐ送る）
+                self.scheduled_late += 1
+            heapq.heappush(heap, (due, seq, t_enqueued, t_ms, messages, [at] * len(messages)))
+            seq += 1
+        return seq
+
+    def send_entries(self, entries, t_enqueued, t_ms=None):
+        self.send_frame(
+            [(address, value) for _, address, value, _ in entries], t_enqueued, t_ms, [e[3] for e in entries]
+        )
+
+    def send_frame(self, messages, t_enqueued, t_ms=None, times=None, timetag=IMMEDIATELY):
+        if self.log_file is not None:
+            self.log_file.write(json.dumps({"t_ms": t_ms, "messages": messages}) + "\n")
+        try:
+            if self.use_bundles:
+                self.client.send(build_osc_bundle(messages, timetag))
+                self.packets_sent += 1
+            else:
+                for address, value in messages:
+                    self.client.send_message(address, value)
+                    self.packets_sent += 1
+            self.messages_sent += len(messages)
+        except Exception:
+            self.send_errors += 1
+            return
+
+        t_sent = time.perf_counter()
+        for at in times or ():
+            delay = t_sent - at
+            self.delay_samples += 1
+            self.delay_total += delay
+            self.delay_total_sq += delay * delay
+            if delay < self.delay_min:
+                self.delay_min = delay
+            if delay > self.delay_max:
+                self.delay_max = delay
+
+        latency = t_sent - t_enqueued
+        self.latency_last = latency
+        self.latency_samples += 1
+        self.latency_total += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
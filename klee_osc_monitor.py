@@ -0,0 +1,163 @@
+# klee_osc_monitor.py
+# klee_main.py が送る OSC を受けて、届いた時刻の揺れを調べるテスト用の受信係（Max の代わりに同じポートで待つ）
+#
+#   python klee_osc_monitor.py                        … 127.0.0.1:8000 で受信し、5秒ごとに集計を表示
+#   python klee_osc_monitor.py --seconds 30           … 30秒で終了
+#   python klee_osc_monitor.py --address /rgb         … /rgb を含むパケットだけ数える
+#
+# タイムタグ付きの bundle（klee_main.py --osc-latency）は「届いた時刻 − タイムタグ」を集計する
+# （同じ PC 上なら送信側の予定どおりに出ているかがそのまま分かる）。
+# タイムタグなし（即時）のときは、届いた間隔だけを集計する。
+import argparse
+import socket
+import statistics
+import sys
+import time
+
+from pythonosc.osc_bundle import OscBundle
+from pythonosc.osc_message import OscMessage
+from pythonosc.parsing import ntp
+
+BUNDLE_PREFIX = b"#bundle\x00"
+REPORT_INTERVAL_S = 5.0
+
+
+# ============================================================
+# 1) PACKET PARSING
+# ============================================================
+def packet_addresses(dgram):
+    """
+    パケット -> 含まれるアドレスのリスト（bundle の入れ子もたどる）
+    """
+    if dgram.startswith(BUNDLE_PREFIX):
+        out = []
+
+        def walk(bundle):
+            for content in bundle:
+                if isinstance(content, OscBundle):
+                    walk(content)
+                else:
+                    out.append(content.address)
+
+        walk(OscBundle(dgram))
+        return out
+    return [OscMessage(dgram).address]
+
+
+def packet_timetag(dgram):
+    """
+    bundle のタイムタグ（UNIX 時刻 秒）。即時（IMMEDIATELY）や bundle でなければ None
+    """
+    if not dgram.startswith(BUNDLE_PREFIX) or len(dgram) < 16:
+        return None
+    tag = dgram[8:16]
+    if tag == ntp.IMMEDIATELY:
+        return None
+    return ntp.ntp_to_system_time(tag)
+
+
+# ============================================================
+# 2) STATISTICS
+# ============================================================
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def format_ms(values):
+    """
+    ms の列 -> "avg / std / p1 / p99 / max" の文字列
+    """
+    if not values:
+        return "n/a"
+    std = statistics.pstdev(values) if len(values) > 1 else 0.0
+    return (
+        f"avg {statistics.fmean(values):.3f} std {std:.3f}"
+        f" p1 {percentile(values, 0.01):.3f} p99 {percentile(values, 0.99):.3f} max {max(values):.3f} ms"
+    )
+
+
+class ArrivalStats:
+    def __init__(self):
+        self.packets = 0
+        self.messages = 0
+        self.tagged = 0
+        self.offsets_ms = []
+        self.intervals_ms = []
+        self.last_arrival = None
+
+    def add(self, arrival_wall, arrival_mono, tag, n_messages):
+        self.packets += 1
+        self.messages += n_messages
+        if tag is not None:
+            self.tagged += 1
+            self.offsets_ms.append((arrival_wall - tag) * 1000)
+        if self.last_arrival is not None:
+            self.intervals_ms.append((arrival_mono - self.last_arrival) * 1000)
+        self.last_arrival = arrival_mono
+
+    def report(self, title):
+        print(f"--- {title}: {self.packets} packets / {self.messages} msgs ({self.tagged} with timetags)")
+        if self.tagged:
+            print(f"    arrival - timetag : {format_ms(self.offsets_ms)}")
+        print(f"    arrival interval  : {format_ms(self.intervals_ms)}")
+
+
+# ============================================================
+# 3) MAIN
+# ============================================================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Klee Color Visualizer OSC timing monitor")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seconds", type=float, help="この秒数で終了（省略時は Ctrl+C まで）")
+    parser.add_argument("--address", help="このアドレスを含むパケットだけ数える（例: /rgb）")
+    parser.add_argument("--interval", type=float, default=REPORT_INTERVAL_S, help="途中経過を表示する間隔（秒）")
+    args = parser.parse_args(argv)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.bind((args.ip, args.port))
+    except OSError as e:
+        print(f"❌ cannot listen on {args.ip}:{args.port} ({e}); is Max still using the port?")
+        return 1
+    sock.settimeout(0.2)
+    print(f"✅ listening on {args.ip}:{args.port}")
+
+    total = ArrivalStats()
+    window = ArrivalStats()
+    t_start = time.perf_counter()
+    t_report = t_start
+    try:
+        while args.seconds is None or time.perf_counter() - t_start < args.seconds:
+            try:
+                dgram = sock.recv(65536)
+            except socket.timeout:
+                dgram = None
+            if dgram is not None:
+                arrival_wall, arrival_mono = time.time(), time.perf_counter()
+                try:
+                    addresses = packet_addresses(dgram)
+                    tag = packet_timetag(dgram)
+                except Exception:
+                    print("⚠️ unparsable packet:", dgram[:32])
+                    continue
+                if args.address is None or args.address in addresses:
+                    total.add(arrival_wall, arrival_mono, tag, len(addresses))
+                    window.add(arrival_wall, arrival_mono, tag, len(addresses))
+
+            if time.perf_counter() - t_report >= args.interval:
+                window.report(f"last {args.interval:g} s")
+                window = ArrivalStats()
+                t_report = time.perf_counter()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+    total.report("total")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
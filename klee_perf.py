@@ -0,0 +1,135 @@
+# klee_perf.py
+# メインループの区間ごとの所要時間を測るためのモジュール
+import json
+import sys
+import time
+from collections import deque
+
+# メインループの区間（この順に mark される想定）
+FRAME_STAGES = ("events", "sampling", "layers", "widgets", "flip", "osc", "tick")
+
+
+def percentile(sorted_values, q):
+    """
+    ソート済みリストの q パーセンタイル（nearest-rank）
+    """
+    if not sorted_values:
+        return 0.0
+    i = int(round(q / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[max(0, min(len(sorted_values) - 1, i))]
+
+
+def peak_rss_mb():
+    """
+    プロセス全体のピーク RSS (MB)。取れない環境では None
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS は byte
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+# Linux の RAPL（CPU パッケージの消費エネルギー、µJ の積算値）。読めない環境では使わない
+RAPL_ENERGY_PATH = "/sys/class/powercap/intel-rapl:0/energy_uj"
+
+
+def read_energy_j():
+    """
+    CPU パッケージの消費エネルギーの積算値 (J)。取れない環境では None
+    """
+    try:
+        with open(RAPL_ENERGY_PATH, "r") as f:
+            return int(f.read().strip()) / 1e6
+    except (OSError, ValueError):
+        return None
+
+
+class FrameProfiler:
+    """
+    1フレームを区間に分けて計測し、直近 window フレームの分布を持つ
+    - begin_frame() → mark("events") → mark("sampling") … → end_frame()
+    - mark(stage) は「前回の mark からの経過時間」を stage に加算する
+    - 呼ばれなかった区間はそのフレームでは 0 ms として扱う
+    """
+
+    def __init__(self, stages=FRAME_STAGES, window=300, log_path=None):
+        self.stages = tuple(stages)
+        self.history = {name: deque(maxlen=window) for name in self.stages}
+        self.history["frame"] = deque(maxlen=window)
+        self.current = {}
+        self.frame_t0 = None
+        self.last_mark = None
+        self.frames = 0
+        self.log_file = open(log_path, "a", encoding="utf-8") if log_path else None
+
+    def begin_frame(self):
+        now = time.perf_counter()
+        self.frame_t0 = now
+        self.last_mark = now
+        self.current = {}
+
+    def mark(self, stage):
+        if self.last_mark is None:
+            return
+        now = time.perf_counter()
+        self.current[stage] = self.current.get(stage, 0.0) + (now - self.last_mark)
+        self.last_mark = now
+
+    def end_frame(self):
+        if self.frame_t0 is None:
+            return
+        for name in self.stages:
+            self.history[name].append(self.current.get(name, 0.0) * 1000)
+        self.history["frame"].append((time.perf_counter() - self.frame_t0) * 1000)
+        self.frames += 1
+        self.frame_t0 = None
+        self.last_mark = None
+
+    def summary(self):
+        """
+        区間ごとの {p50, p95, p99, max} (ms)
+        """
+        out = {}
+        for name, values in self.history.items():
+            ordered = sorted(values)
+            out[name] = {
+                "p50": percentile(ordered, 50),
+                "p95": percentile(ordered, 95),
+                "p99": percentile(ordered, 99),
+                "max": ordered[-1] if ordered else 0.0,
+            }
+        return out
+
+    def write_log(self, summary, extra=None):
+        if self.log_file is None:
+            return
+        row = {"t": time.time(), "frames": self.frames, "stages": summary}
+        if extra:
+            row.update(extra)
+        self.log_file.write(json.dumps(row) + "\n")
+        self.log_file.flush()
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+
+def format_hud_lines(summary, fps=None):
+    """
+    HUD 用の文字列（1区間1行、p50 / p95 / p99 ms）
+    """
+    lines = []
+    head = "frame"
+    if fps is not None:
+        head += f" ({fps:.0f} fps)"
+    for name in ("frame",) + FRAME_STAGES:
+        st = summary.get(name)
+        if st is None:
+            continue
+        label = head if name == "frame" else name
+        lines.append(f"{label:<16} {st['p50']:6.2f} {st['p95']:6.2f} {st['p99']:6.2f}")
+    return lines
@@ -0,0 +1,580 @@
+# klee_sonify.py
+# 色の読み取り → 送るかどうかの判定 → OSC 送信（音にする側）を、描画とは別のプロセスで動かすためのモジュール
+#
+#   python klee_main.py --sonify-process   … このモジュールのワーカーを別プロセスで起動する
+#
+# - 色の前計算グリッド（RGB / HSV / 音のラベル / 色面の番号 / 質感）は multiprocessing.shared_memory に置く
+# - カーソル（指）の通り道の点は、共有メモリ上のリングバッファ（書き手1・読み手1、ロックなし）で渡す
+# - 作品の切り替え（新しいグリッド）と終了だけは、ワーカーの標準入力に JSON 1行で伝える
+# - 最後に送った色はワーカーが共有メモリの状態表に書き、描画側はそれを読んでパネルに出す
+import json
+import os
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# ============================================================
+# 1) SEND POLICY (メインプロセスの判定と同じもの)
+# ============================================================
+def rgb_delta(a, b):
+    return abs(a[0]-b[0]) + abs(a[1]-b[1]) + abs(a[2]-b[2])
+
+
+def should_send_color(rgb, key, t, last_rgb, last_region, last_send_ms, entered,
+                      send_on, delta_threshold, min_interval_ms):
+    """
+    通り道の1点の色を送るか
+    - color なら前回送った色から delta_threshold 以上、label / region なら色面のキーが変わったとき
+    - 前回の送信から min_interval_ms 以上（entered＝画像に入った直後なら待たない）
+    """
+    if send_on == "color":
+        if last_rgb is not None and rgb_delta(rgb, last_rgb) < delta_threshold:
+            return False
+    elif key == last_region:
+        return False
+    return entered or (t - last_send_ms) >= min_interval_ms
+
+
+def region_key(send_on, label, region):
+    """
+    --send-on ごとの色面のキー（color なら None、label ならラベル、region なら (ラベル, 色面の番号)）
+    """
+    if send_on == "color":
+        return None
+    if send_on == "label":
+        return label
+    return (label, region)
+
+
+def pointer_address(pointer, name):
+    """
+    ポインタ 0 はマウス（/rgb・/hsv）、1 以降はタッチの指（/p/<番号>/rgb・hsv）
+    """
+    return f"/{name}" if pointer == 0 else f"/p/{pointer}/{name}"
+
+
+# ============================================================
+# 2) SHARED MEMORY
+# ============================================================
+# リングの1件：kind が POS なら画像内座標 (x, y) をワーカーがグリッドで引き、
+# COLOR なら描画側で読んだ色（拡大中・半径が既定でないとき）をそのまま使う。RELEASE は 0 0 0 を送る
+RING_KIND_POS = 1
+RING_KIND_COLOR = 2
+RING_KIND_RELEASE = 3
+RING_FLAG_ENTER = 1
+
+# seq は行ごとの通し番号 + 1（0 は書きかけ）。書き手が最後に書き、読み手が写す前後で確かめる
+# align=True で seq を 8 byte 境界に置く（ARM でも1回の書き込みで入る）
+RING_DTYPE = np.dtype([
+    ("seq", "<u8"),
+    ("at", "<f8"),          # 出来事の時刻（perf_counter。Linux / macOS / Windows ともプロセス間で共通）
+    ("t_ms", "<f8"),        # 判定に使う時刻（メインループの get_ticks の ms）
+    ("pointer", "<i4"),
+    ("kind", "<i2"),
+    ("flags", "<i2"),
+    ("gen", "<i4"),         # どのグリッドの座標か（作品の切り替えで増える）
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("rgb", "u1", (3,)),
+    ("hsv", "<u2", (3,)),
+    ("label", "<i4"),
+    ("region", "<i4"),
+    ("texture", "u1", (4,)),  # --texture の質感（COLOR の行だけ描画側で入れる）
+], align=True)
+RING_CAPACITY = 8192
+RING_HEADER_BYTES = 64
+
+MAX_POINTERS = 17   # マウス + 指 16 本
+STATUS_DTYPE = np.dtype("<i4")
+
+
+def create_shared_array(arr):
+    """
+    ndarray -> (SharedMemory, 説明の dict)。中身はコピーする
+    """
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, {"name": shm.name, "shape": list(arr.shape), "dtype": arr.dtype.str}
+
+
+def attach_shared_memory(name):
+    """
+    既存の共有メモリにつなぐ（作った側が片付けるので、こちらの終了時には消さない）
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python 3.12 まで：つないだだけのプロセスの resource_tracker が終了時に消してしまうのを止める
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def attach_shared_array(desc):
+    shm = attach_shared_memory(desc["name"])
+    return shm, np.ndarray(tuple(desc["shape"]), dtype=np.dtype(desc["dtype"]), buffer=shm.buf)
+
+
+class SharedRing:
+    """
+    書き手1・読み手1のリングバッファ（ロックなし）
+    - 書き手は行の seq を 0 にしてから中身を書き、seq に通し番号 + 1 を入れ、最後に先頭 8 byte の通算件数を進める
+    - 読み手は自分の読んだ位置を持ち、写す前後の seq がどちらも読みたい番号の行だけを使う
+      （x86 以外で通算件数が中身より先に見えても、古い行・書きかけの行は seq で分かる）
+    - 追い越されて上書きされた行は捨てて数え、まだ見えていない行は次の read で読む
+    """
+
+    def __init__(self, shm, capacity):
+        self.shm = shm
+        self.capacity = capacity
+        self.header = np.ndarray((1,), dtype="<u8", buffer=shm.buf)
+        self.entries = np.ndarray((capacity,), dtype=RING_DTYPE, buffer=shm.buf, offset=RING_HEADER_BYTES)
+        self.read_pos = 0
+        self.overruns = 0
+        self.max_lag = 0
+
+    @classmethod
+    def create(cls, capacity=RING_CAPACITY):
+        shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_BYTES + capacity * RING_DTYPE.itemsize)
+        ring = cls(shm, capacity)
+        ring.header[0] = 0
+        ring.entries["seq"] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name, capacity=RING_CAPACITY):
+        return cls(attach_shared_memory(name), capacity)
+
+    def push(self, rows):
+        """
+        rows（RING_DTYPE の配列）を書く（rows の seq は書き換える）
+        """
+        n = len(rows)
+        if n == 0:
+            return
+        w = int(self.header[0])
+        if n > self.capacity:
+            # 入りきらない古い側は書かずに数だけ進める（読み手が追い越された分として数える）
+            w += n - self.capacity
+            rows = rows[-self.capacity:]
+            n = self.capacity
+        rows["seq"] = 0
+        i = w % self.capacity
+        first = min(n, self.capacity - i)
+        for dst, src, pos in ((slice(i, i + first), slice(0, first), w),
+                              (slice(0, n - first), slice(first, n), w + first)):
+            if src.stop > src.start:
+                seq = self.entries["seq"]
+                seq[dst] = 0
+                self.entries[dst] = rows[src]
+                seq[dst] = np.arange(pos + 1, pos + 1 + src.stop - src.start, dtype=np.uint64)
+        self.header[0] = w + n
+
+    def read(self):
+        """
+        前回から書かれた分のコピー（RING_DTYPE の配列、古い順）
+        """
+        w = int(self.header[0])
+        lag = w - self.read_pos
+        if lag <= 0:
+            return self.entries[:0].copy()
+        self.max_lag = max(self.max_lag, lag)
+        start = max(self.read_pos, w - self.capacity)
+        self.overruns += start - self.read_pos
+        want = np.arange(start + 1, w + 1, dtype=np.uint64)
+        idx = np.arange(start, w) % self.capacity
+        before = self.entries["seq"][idx]
+        rows = self.entries[idx]
+        after = self.entries["seq"][idx]
+        ok = (before == want) & (after == want)
+        # 上書きされた行は古い側に、まだ見えていない行は新しい側にまとまる
+        if ok.any():
+            lo = int(np.argmax(ok))
+            bad = np.flatnonzero(~ok[lo:])
+            hi = lo + int(bad[0]) if len(bad) else len(rows)
+        else:
+            newer = np.flatnonzero((before > want) | (after > want))
+            lo = hi = int(newer[-1]) + 1 if len(newer) else 0
+        self.overruns += lo
+        self.read_pos = start + hi
+        return rows[lo:hi]
+
+
+# ============================================================
+# 3) MAIN PROCESS SIDE
+# ============================================================
+class SonifyProcess:
+    """
+    ワーカープロセスの起動と、リング・状態表・グリッドの受け渡し（描画側から使う）
+    """
+
+    def __init__(self, ip, port, send_on, delta_threshold, min_interval_ms, latency_ms=None, use_bundles=True):
+        import subprocess
+
+        self.ring = SharedRing.create()
+        self.status_shm = shared_memory.SharedMemory(create=True, size=MAX_POINTERS * 6 * STATUS_DTYPE.itemsize)
+        self.status = np.ndarray((MAX_POINTERS, 6), dtype=STATUS_DTYPE, buffer=self.status_shm.buf)
+        self.status[...] = 0
+        self.grids = []          # [(gen, [SharedMemory, ...]), ...] 直前の世代まで残す
+        self.gen = 0
+        self.lock = threading.Lock()
+
+        cmd = [
+            sys.executable, os.path.abspath(__file__), "worker",
+            "--ring", self.ring.shm.name, "--status", self.status_shm.name,
+            "--ip", ip, "--port", str(port), "--send-on", send_on,
+            "--delta", str(delta_threshold), "--interval", str(min_interval_ms),
+        ]
+        if latency_ms is not None:
+            cmd += ["--latency", str(latency_ms)]
+        if not use_bundles:
+            cmd.append("--no-bundles")
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, text=True)
+
+    def set_grid(self, step, rgb, hsv, labels=None, regions=None, texture=None):
+        """
+        新しいグリッドを共有メモリに置いてワーカーに知らせる -> 世代番号
+        - texture があれば、ワーカーは色を送るたびに /texture も送る
+        """
+        with self.lock:
+            self.gen += 1
+            shms, descs = [], {}
+            for key, arr in (("rgb", rgb), ("hsv", hsv), ("labels", labels), ("regions", regions),
+                             ("texture", texture)):
+                if arr is not None:
+                    shm, desc = create_shared_array(arr)
+                    shms.append(shm)
+                    descs[key] = desc
+            self.send_control({"grid": descs, "gen": self.gen, "step": step})
+            self.grids.append((self.gen, shms))
+            # ワーカーは受け取ってすぐにつなぎ替えるので、2世代前のものから片付ける
+            while len(self.grids) > 2:
+                _, old = self.grids.pop(0)
+                for shm in old:
+                    shm.close()
+                    shm.unlink()
+            return self.gen
+
+    def send_control(self, msg):
+        try:
+            self.proc.stdin.write(json.dumps(msg) + "\n")
+            self.proc.stdin.flush()
+        except (OSError, ValueError):
+            pass
+
+    def push(self, rows):
+        self.ring.push(rows)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def last_sent(self, pointer):
+        """
+        ワーカーが最後に送った ((r, g, b), (h1, s1, v1))（表示用。まれに1フレーム古くてもよい）
+        """
+        v = self.status[pointer].tolist()
+        return tuple(v[:3]), tuple(v[3:])
+
+    def close(self, timeout=2.0):
+        """
+        リングに残っている分を送り切らせてからワーカーを止め、共有メモリを片付ける
+        """
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout)
+        except Exception:
+            self.proc.kill()
+        for _, shms in self.grids:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        self.grids = []
+        # ndarray の参照を外してから閉じる
+        del self.status
+        self.ring.entries = self.ring.header = None
+        for shm in (self.status_shm, self.ring.shm):
+            shm.close()
+            shm.unlink()
+
+
+def make_ring_rows(n):
+    rows = np.zeros(n, dtype=RING_DTYPE)
+    rows["region"] = -1
+    return rows
+
+
+# ============================================================
+# 4) WORKER PROCESS
+# ============================================================
+# リングが空のときの待ち。しばらく何も来なければ長めに待つ
+POLL_ACTIVE_S = 0.0005
+POLL_IDLE_S = 0.01
+IDLE_AFTER_S = 0.5
+# 新しい世代の座標が来たのにグリッドの知らせがまだのとき、待つ上限
+GRID_WAIT_S = 0.2
+
+
+class SonifyWorker:
+    def __init__(self, args):
+        from klee_osc import OscSender
+
+        self.send_on = args["send_on"]
+        self.delta_threshold = args["delta"]
+        self.min_interval_ms = args["interval"]
+        self.ring = SharedRing.attach(args["ring"])
+        self.status_shm = attach_shared_memory(args["status"])
+        self.status = np.ndarray((MAX_POINTERS, 6), dtype=STATUS_DTYPE, buffer=self.status_shm.buf)
+        self.client = OscSender(
+            args["ip"], args["port"], use_bundles=args["bundles"], max_queue=None,
+            latency=args["latency"] / 1000.0 if args["latency"] is not None else None
+        )
+
+        self.grid = None
+        self.grid_shms = []
+        self.gen = 0
+        self.controls = []
+        self.controls_cond = threading.Condition()
+        self.stdin_closed = False
+        # ポインタごとの状態
+        self.pointers = {}
+
+        self.points = 0
+        self.sends = 0
+        self.batches = 0
+        self.process_time = 0.0
+        self.process_max = 0.0
+
+    # ---------------- 標準入力（グリッドの切り替え・終了） ----------------
+    def read_controls(self):
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            with self.controls_cond:
+                self.controls.append(json.loads(line))
+                self.controls_cond.notify_all()
+        with self.controls_cond:
+            self.stdin_closed = True
+            self.controls_cond.notify_all()
+
+    def apply_controls(self, wait_gen=None):
+        """
+        届いている知らせを反映する。wait_gen があれば、その世代のグリッドが来るまで少し待つ
+        """
+        deadline = time.perf_counter() + GRID_WAIT_S
+        with self.controls_cond:
+            while wait_gen is not None and self.gen < wait_gen and not self.stdin_closed:
+                if not any(c.get("gen", 0) >= wait_gen for c in self.controls):
+                    rest = deadline - time.perf_counter()
+                    if rest <= 0:
+                        break
+                    self.controls_cond.wait(rest)
+                    continue
+                break
+            controls, self.controls = self.controls, []
+        # 描画側は2世代前のグリッドから片付けるので、たまっていた分は最新の1つだけつなぐ
+        grids = [c for c in controls if "grid" in c]
+        if grids:
+            self.attach_grid(max(grids, key=lambda c: c["gen"]))
+
+    def attach_grid(self, c):
+        """
+        知らせ c のグリッドにつなぎ替える。もう片付けられていた（古い世代）ときは今のグリッドのまま
+        """
+        grid, shms = {}, []
+        try:
+            for key, desc in c["grid"].items():
+                shm, arr = attach_shared_array(desc)
+                grid[key] = arr
+                shms.append(shm)
+        except FileNotFoundError:
+            for shm in shms:
+                shm.close()
+            print(f"⚠️ Sonify worker: grid {c['gen']} was already released; skipped")
+            return
+        for shm in self.grid_shms:
+            shm.close()
+        grid["step"] = c["step"]
+        self.grid, self.grid_shms = grid, shms
+        self.gen = c["gen"]
+
+    # ---------------- 1回分の処理 ----------------
+    def pointer_state(self, pointer):
+        st = self.pointers.get(pointer)
+        if st is None:
+            st = {"last_rgb": None, "last_hsv": None, "last_texture": None, "last_region": None,
+                  "last_send_ms": 0.0, "entered": False}
+            self.pointers[pointer] = st
+        return st
+
+    def lookup(self, rows):
+        """
+        POS の行にグリッドの色・ラベル・質感を書き込む
+        """
+        pos = rows["kind"] == RING_KIND_POS
+        if not pos.any():
+            return
+        if rows["gen"][pos].max() > self.gen:
+            self.apply_controls(wait_gen=int(rows["gen"][pos].max()))
+        if self.grid is None:
+            rows["kind"][pos] = 0
+            return
+        step = self.grid["step"]
+        gw, gh = self.grid["rgb"].shape[0], self.grid["rgb"].shape[1]
+        cx = (rows["x"][pos] // step).clip(0, gw - 1)
+        cy = (rows["y"][pos] // step).clip(0, gh - 1)
+        rows["rgb"][pos] = self.grid["rgb"][cx, cy]
+        rows["hsv"][pos] = self.grid["hsv"][cx, cy]
+        if "labels" in self.grid:
+            rows["label"][pos] = self.grid["labels"][cx, cy]
+            rows["region"][pos] = self.grid["regions"][cx, cy]
+        if "texture" in self.grid:
+            rows["texture"][pos] = self.grid["texture"][cx, cy]
+
+    def texture_enabled(self):
+        return self.grid is not None and "texture" in self.grid
+
+    def process(self, rows):
+        self.lookup(rows)
+        send_texture = self.texture_enabled()
+        columns = zip(
+            rows["at"].tolist(), rows["t_ms"].tolist(), rows["pointer"].tolist(), rows["kind"].tolist(),
+            rows["flags"].tolist(), map(tuple, rows["rgb"].tolist()), map(tuple, rows["hsv"].tolist()),
+            rows["label"].tolist(), rows["region"].tolist(), map(tuple, rows["texture"].tolist())
+        )
+        for at, t_ms, pointer, kind, flags, rgb, hsv, label, region, texture in columns:
+            if kind == RING_KIND_RELEASE:
+                self.release(pointer, at)
+                continue
+            if kind not in (RING_KIND_POS, RING_KIND_COLOR):
+                continue
+            self.points += 1
+            st = self.pointer_state(pointer)
+            if flags & RING_FLAG_ENTER:
+                # 画像に入った直後：次に送るまでは間隔を待たない（メインプロセスの pick_sends と同じ）
+                st["entered"] = True
+            key = region_key(self.send_on, label, None if region < 0 else region)
+            if not should_send_color(rgb, key, t_ms, st["last_rgb"], st["last_region"], st["last_send_ms"],
+                                     st["entered"], self.send_on, self.delta_threshold, self.min_interval_ms):
+                continue
+            try:
+                # 1回の処理に同じポインタの点が何個あっても、途中の色もまとめずに全部送る
+                if st["last_rgb"] != rgb:
+                    self.client.send_message(pointer_address(pointer, "rgb"), list(rgb), at=at, coalesce=False)
+                    st["last_rgb"] = rgb
+                if st["last_hsv"] != hsv:
+                    self.client.send_message(pointer_address(pointer, "hsv"), list(hsv), at=at, coalesce=False)
+                    st["last_hsv"] = hsv
+                if send_texture and st["last_texture"] != texture:
+                    self.client.send_message(
+                        pointer_address(pointer, "texture"), list(texture), at=at, coalesce=False
+                    )
+                    st["last_texture"] = texture
+            except Exception:
+                pass
+            if self.send_on != "color":
+                st["last_region"] = key
+            st["last_send_ms"] = t_ms
+            st["entered"] = False
+            self.sends += 1
+            if 0 <= pointer < MAX_POINTERS:
+                self.status[pointer] = rgb + hsv
+
+    def release(self, pointer, at):
+        try:
+            self.client.send_message(pointer_address(pointer, "rgb"), [0, 0, 0], at=at)
+            self.client.send_message(pointer_address(pointer, "hsv"), [0, 0, 0], at=at)
+            if self.texture_enabled():
+                self.client.send_message(pointer_address(pointer, "texture"), [0, 0, 0, 0], at=at)
+        except Exception:
+            pass
+        st = self.pointer_state(pointer)
+        st["last_rgb"] = (0, 0, 0)
+        st["last_hsv"] = (0, 0, 0)
+        st["last_texture"] = (0, 0, 0, 0)
+        st["last_region"] = None
+        st["entered"] = False
+        if 0 <= pointer < MAX_POINTERS:
+            self.status[pointer] = 0
+
+    # ---------------- ループ ----------------
+    def run(self):
+        threading.Thread(target=self.read_controls, name="klee-sonify-stdin", daemon=True).start()
+        last_work = time.perf_counter()
+        while True:
+            self.apply_controls()
+            rows = self.ring.read()
+            if len(rows):
+                t0 = time.perf_counter()
+                self.process(rows)
+                self.client.flush()
+                dt = time.perf_counter() - t0
+                self.batches += 1
+                self.process_time += dt
+                self.process_max = max(self.process_max, dt)
+                last_work = t0
+                continue
+            if self.stdin_closed:
+                # 描画側が閉じた：リングを読み切ったら終わる
+                break
+            idle = time.perf_counter() - last_work > IDLE_AFTER_S
+            time.sleep(POLL_IDLE_S if idle else POLL_ACTIVE_S)
+
+        self.client.close()
+        self.print_stats()
+        for shm in self.grid_shms:
+            shm.close()
+        self.status = None
+        self.ring.entries = self.ring.header = None
+        self.status_shm.close()
+        self.ring.shm.close()
+
+    def print_stats(self):
+        st = self.client.stats()
+        avg = self.process_time * 1000 / max(1, self.batches)
+        print(
+            f"✅ Sonify worker: {self.points} points in {self.batches} batches"
+            f" ({avg:.3f} ms avg / {self.process_max * 1000:.3f} ms max), {self.sends} color sends,"
+            f" ring lag max {self.ring.max_lag}, {self.ring.overruns} overrun"
+        )
+        print(
+            f"✅ Sonify OSC: {st['messages_sent']} msgs in {st['packets_sent']} packets,"
+            f" event -> send avg {st['event_delay_avg_ms']:.2f} ms"
+            f" (min {st['event_delay_min_ms']:.2f} / max {st['event_delay_max_ms']:.2f}),"
+            f" jitter {st['event_jitter_ms']:.3f} ms"
+        )
+
+
+def parse_worker_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Klee Color Visualizer sonify worker")
+    parser.add_argument("--ring", required=True)
+    parser.add_argument("--status", required=True)
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--send-on", default="color")
+    parser.add_argument("--delta", type=float, default=14)
+    parser.add_argument("--interval", type=float, default=50)
+    parser.add_argument("--latency", type=float)
+    parser.add_argument("--no-bundles", action="store_true")
+    a = parser.parse_args(argv)
+    return {
+        "ring": a.ring, "status": a.status, "ip": a.ip, "port": a.port, "send_on": a.send_on,
+        "delta": a.delta, "interval": a.interval, "latency": a.latency, "bundles": not a.no_bundles,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "worker":
+        SonifyWorker(parse_worker_args(sys.argv[2:])).run()
+    else:
+        print("usage: python klee_sonify.py worker --ring NAME --status NAME [...]  (klee_main.py --sonify-process が起動します)")
+        sys.exit(1)
@@ -0,0 +1,297 @@
+# klee_stream.py
+# 動画・連番画像を作品の代わりに流すための読み込み（klee_main.py --source）
+#
+#   フォルダ / glob   … 連番画像（ファイル名の数字順。pygame で読む）
+#   .gif / .webp / .png … アニメーション画像（Pillow。1枚だけの画像は1フレームの連番として扱う）
+#   それ以外          … 動画（OpenCV の VideoCapture。opencv-python が無ければ開けない）
+#
+# 裏のスレッドが次の1フレームをデコード・解析しておき（ダブルバッファ）、
+# 描画側は表示時刻になったらそれと差し替えるだけにする
+import glob
+import os
+import re
+import threading
+import time
+
+import numpy as np
+import pygame
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# ============================================================
+# 1) FRAME READERS
+# ============================================================
+SEQUENCE_EXTS = (".png", ".jpg", ".jpeg", ".bmp", ".tga", ".tif", ".tiff", ".webp")
+ANIMATED_EXTS = (".gif", ".webp", ".png", ".apng")
+# 連番画像（フレームレートを持たないもの）の既定
+DEFAULT_SEQUENCE_FPS = 12.0
+
+
+def natural_key(path):
+    """
+    "frame_10.png" が "frame_9.png" の後に来るように、数字を数として比べるキー
+    """
+    name = os.path.basename(path).lower()
+    return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", name)]
+
+
+def list_sequence_frames(path):
+    """
+    フォルダ（中の画像すべて）または glob パターン -> ファイル名の数字順のパスのリスト
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path)]
+    else:
+        paths = glob.glob(path)
+    paths = [p for p in paths if os.path.isfile(p) and p.lower().endswith(SEQUENCE_EXTS)]
+    return sorted(paths, key=natural_key)
+
+
+class ImageSequenceReader:
+    kind = "sequence"
+
+    def __init__(self, paths, fps):
+        self.paths = paths
+        self.fps = fps
+        self.frame_count = len(paths)
+
+    def read(self, index):
+        if index >= self.frame_count:
+            return None
+        return pygame.image.load(self.paths[index])
+
+    def rewind(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AnimatedImageReader:
+    """
+    GIF / WebP / APNG のフレームを Pillow で順に読む（フレームの長さは先頭フレームの duration）
+    """
+    kind = "animation"
+
+    def __init__(self, path, fps=None):
+        self.im = Image.open(path)
+        self.frame_count = getattr(self.im, "n_frames", 1)
+        duration_ms = self.im.info.get("duration") or 0
+        self.fps = fps or (1000.0 / duration_ms if duration_ms > 0 else DEFAULT_SEQUENCE_FPS)
+
+    def read(self, index):
+        if index >= self.frame_count:
+            return None
+        self.im.seek(index)
+        arr = np.asarray(self.im.convert("RGB")).transpose(1, 0, 2)
+        return pygame.surfarray.make_surface(arr)
+
+    def rewind(self):
+        pass
+
+    def close(self):
+        self.im.close()
+
+
+class VideoCaptureReader:
+    """
+    動画ファイルを OpenCV で前から順に読む（飛ばすフレームは grab だけで画素を作らない）
+    """
+    kind = "video"
+
+    def __init__(self, path, fps=None):
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise OSError(f"cannot open video {path}")
+        self.fps = fps or self.cap.get(cv2.CAP_PROP_FPS) or DEFAULT_SEQUENCE_FPS
+        # コンテナによっては不正確なので、終わりは read が失敗したことで判断する
+        self.frame_count = None
+        self.pos = 0
+
+    def read(self, index):
+        while self.pos < index:
+            if not self.cap.grab():
+                return None
+            self.pos += 1
+        ok, bgr = self.cap.read()
+        if not ok:
+            return None
+        self.pos += 1
+        return pygame.surfarray.make_surface(np.ascontiguousarray(bgr[:, :, ::-1].transpose(1, 0, 2)))
+
+    def rewind(self):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.pos = 0
+
+    def close(self):
+        self.cap.release()
+
+
+def open_frame_reader(path, fps=None):
+    """
+    パスの種類に合ったリーダーを開く。開けなければ OSError / RuntimeError
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if os.path.isdir(path) or any(c in path for c in "*?["):
+        paths = list_sequence_frames(path)
+        if not paths:
+            raise OSError(f"no images found for {path}")
+        return ImageSequenceReader(paths, fps or DEFAULT_SEQUENCE_FPS)
+    if not os.path.isfile(path):
+        raise OSError(f"{path} not found")
+    if ext in ANIMATED_EXTS:
+        if Image is None:
+            if ext in SEQUENCE_EXTS:
+                return ImageSequenceReader([path], fps or DEFAULT_SEQUENCE_FPS)
+            raise RuntimeError("Pillow is needed for animated images (pip install pillow)")
+        return AnimatedImageReader(path, fps)
+    if cv2 is None:
+        raise RuntimeError("OpenCV is needed for video files (pip install opencv-python)")
+    return VideoCaptureReader(path, fps)
+
+
+# ============================================================
+# 2) DOUBLE-BUFFERED STREAM
+# ============================================================
+# 次のフレームの表示時刻からこれ以上遅れていたら、フレームを飛ばさずに時計を止めていたことにする
+# （タイトル画面で止めていた・ウィンドウを動かしていた、など）
+RESYNC_AFTER_S = 1.0
+
+
+class FrameStream:
+    """
+    デコード + prepare(frame, index, dt_s) を裏のスレッドで1フレーム先まで進めておく
+    - 描画側は poll() で、表示時刻になったフレーム（prepare の戻り値）を受け取る
+    - 受け取られるまで次のデコードはしない（表示中 + 用意済みの2枚だけを持つ）
+    - 遅れたときは、間のフレームを飛ばして（動画は grab だけ）時刻に追いつく
+    """
+
+    def __init__(self, reader, prepare, loop=True):
+        self.reader = reader
+        self.prepare = prepare
+        self.loop = loop
+        self.fps = float(reader.fps)
+        self.cond = threading.Condition()
+        self.ready = None          # (表示時刻 perf_counter, prepare の戻り値)
+        self.stopped = False
+        self.finished = False
+        self.thread = None
+
+        self.decoded = 0
+        self.shown = 0
+        self.skipped = 0
+        self.resyncs = 0
+        self.loops = 0
+        self.prepare_time = 0.0
+        self.prepare_max = 0.0
+        self.late_max = 0.0
+
+    def start(self, first_index=0, after=None):
+        """
+        first_index の次のフレームから流す。after（threading.Event）があれば、それを待ってから始める
+        """
+        self.thread = threading.Thread(
+            target=self.run, args=(first_index, after), name="klee-stream", daemon=True
+        )
+        self.thread.start()
+
+    def run(self, index, after):
+        if after is not None:
+            after.wait()
+        t_start = time.perf_counter() - index / self.fps
+        while True:
+            with self.cond:
+                while self.ready is not None and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+
+            # 次に出すフレームと、その表示時刻
+            nxt = index + 1
+            lag = time.perf_counter() - (t_start + nxt / self.fps)
+            if lag > RESYNC_AFTER_S:
+                t_start += lag
+                self.resyncs += 1
+            elif lag > 0:
+                nxt += int(lag * self.fps)
+
+            frame = None
+            try:
+                frame = self.reader.read(nxt)
+            except Exception as e:
+                print(f"⚠️ stream frame {nxt} could not be read:", e)
+            if frame is None:
+                count = self.reader.frame_count
+                if count is not None and nxt < count:
+                    # 読めない1枚は飛ばす
+                    self.skipped += 1
+                    index = nxt
+                    continue
+                if not self.loop or nxt == 0:
+                    with self.cond:
+                        self.finished = True
+                    return
+                # 最後まで来たら頭に戻す（時刻はそのまま続ける）
+                self.reader.rewind()
+                t_start += nxt / self.fps
+                index = -1
+                self.loops += 1
+                continue
+
+            self.skipped += nxt - index - 1
+            t0 = time.perf_counter()
+            p = self.prepare(frame, nxt, (nxt - index) / self.fps)
+            dt = time.perf_counter() - t0
+            self.decoded += 1
+            self.prepare_time += dt
+            self.prepare_max = max(self.prepare_max, dt)
+            index = nxt
+            with self.cond:
+                self.ready = (t_start + nxt / self.fps, p)
+
+    def poll(self, now=None):
+        """
+        表示時刻になった用意済みのフレーム（無ければ None）
+        """
+        now = time.perf_counter() if now is None else now
+        with self.cond:
+            if self.ready is None or now < self.ready[0]:
+                return None
+            due, p = self.ready
+            self.ready = None
+            self.cond.notify_all()
+        self.shown += 1
+        if now - due < RESYNC_AFTER_S:
+            # それより遅いのは止めていた（タイトル画面にいた）間の分なので数えない
+            self.late_max = max(self.late_max, now - due)
+        return p
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(2.0)
+        self.reader.close()
+
+    def stats(self):
+        return {
+            "fps": self.fps,
+            "decoded": self.decoded,
+            "shown": self.shown,
+            "skipped": self.skipped,
+            "resyncs": self.resyncs,
+            "loops": self.loops,
+            "prepare_avg_ms": self.prepare_time * 1000 / max(1, self.decoded),
+            "prepare_max_ms": self.prepare_max * 1000,
+            "late_max_ms": self.late_max * 1000,
+        }
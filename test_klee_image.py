@@ -0,0 +1,65 @@
+# test_klee_image.py
+# klee_image の画像ピラミッド（横帯から書き出す作り方）のテスト
+#
+#   python -m pytest -q test_klee_image.py
+import os
+
+import numpy as np
+from PIL import Image
+
+from klee_image import ImagePyramid, build_pyramid_from_file, downsample_2x
+
+
+def reference_levels(rgb, min_size):
+    """
+    画像全体を持って 2x2 で縮めていく、比べるための素直な作り方
+    """
+    levels = [rgb]
+    while True:
+        w, h = levels[-1].shape[:2]
+        if (w <= min_size[0] and h <= min_size[1]) or w < 2 or h < 2:
+            return levels
+        levels.append(downsample_2x(levels[-1]))
+
+
+def read_level(pyr, k):
+    """
+    レベル k のタイルを並べ直した配列（ImagePyramid.tile は表示が要るので .npy を直接読む）
+    """
+    w, h = pyr.levels[k]
+    t = pyr.tile_size
+    out = np.empty((w, h, 3), dtype=np.uint8)
+    for ty in range((h + t - 1) // t):
+        for tx in range((w + t - 1) // t):
+            out[tx * t:(tx + 1) * t, ty * t:(ty + 1) * t] = np.load(os.path.join(pyr.root, f"L{k}_{tx}_{ty}.npy"))
+    return out
+
+
+def write_png(tmp_path, w, h):
+    rgb = np.random.default_rng(0).integers(0, 256, (w, h, 3), dtype=np.uint8)
+    path = str(tmp_path / "src.png")
+    Image.fromarray(rgb.transpose(1, 0, 2)).save(path)
+    return path, rgb
+
+
+def test_level0_keeps_source_resolution(tmp_path):
+    # 帯（256 行）にもタイルにも割り切れない、奇数の大きさ
+    path, rgb = write_png(tmp_path, 613, 531)
+    out_dir = str(tmp_path / "pyr")
+    build_pyramid_from_file(path, out_dir, (40, 40), max_pixels=613 * 531)
+    pyr = ImagePyramid.open(out_dir)
+    expected = reference_levels(rgb, (40, 40))
+    assert [tuple(v) for v in pyr.levels] == [a.shape[:2] for a in expected]
+    assert tuple(pyr.source_size) == (613, 531)
+    for k, a in enumerate(expected):
+        assert np.array_equal(read_level(pyr, k), a)
+
+
+def test_level0_capped_by_max_pixels(tmp_path):
+    path, _ = write_png(tmp_path, 400, 300)
+    out_dir = str(tmp_path / "pyr")
+    build_pyramid_from_file(path, out_dir, (40, 40), max_pixels=100 * 75)
+    pyr = ImagePyramid.open(out_dir)
+    assert tuple(pyr.levels[0]) == (100, 75)
+    # 元の大きさは残るので、描画側は縮めてあることを表示できる
+    assert tuple(pyr.source_size) == (400, 300)
@@ -0,0 +1,191 @@
+# test_klee_sonify.py
+# klee_sonify の SharedRing（書き手1・読み手1のリング）とワーカーのグリッドのつなぎ替えのテスト
+#
+#   python -m pytest -q test_klee_sonify.py
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+
+from klee_sonify import RING_DTYPE, SharedRing, SonifyWorker, create_shared_array
+
+
+def seq_rows(start, n):
+    """
+    通し番号 start.. の行（x と y と t_ms に同じ番号を入れて、行が混ざったら分かるようにする）
+    """
+    rows = np.zeros(n, dtype=RING_DTYPE)
+    seq = np.arange(start, start + n)
+    rows["x"] = seq
+    rows["y"] = -seq
+    rows["t_ms"] = seq
+    return rows
+
+
+def check_rows(rows):
+    """
+    行の中身がそろっていて、通し番号が1ずつ増えていること。最初の番号を返す
+    """
+    seq = rows["x"]
+    assert np.array_equal(rows["y"], -seq)
+    assert np.array_equal(rows["t_ms"], seq)
+    assert np.all(np.diff(seq) == 1)
+    return int(seq[0]) if len(seq) else None
+
+
+def close_ring(ring):
+    ring.entries = ring.header = None
+    ring.shm.close()
+    ring.shm.unlink()
+
+
+def test_read_in_order():
+    ring = SharedRing.create(capacity=64)
+    try:
+        ring.push(seq_rows(0, 5))
+        ring.push(seq_rows(5, 70))   # 一周を越える分は古い側を書かない
+        rows = ring.read()
+        assert check_rows(rows) == 75 - 64 and len(rows) == 64
+        assert len(ring.read()) == 0
+        assert ring.overruns == 75 - 64
+    finally:
+        close_ring(ring)
+
+
+def test_read_drops_slots_of_push_in_progress():
+    ring = SharedRing.create(capacity=64)
+    try:
+        ring.push(seq_rows(0, 64))
+        # 書き手が次の 8 件を書いている途中（seq はまだ 0、通算件数も進めていない）を作る
+        ring.entries["seq"][0:8] = 0
+        ring.entries[0:8] = seq_rows(64, 8)
+        rows = ring.read()
+        assert check_rows(rows) == 8 and len(rows) == 56
+        ring.entries["seq"][0:8] = np.arange(65, 73)
+        ring.header[0] = 72
+        rows = ring.read()
+        assert check_rows(rows) == 64 and len(rows) == 8
+        assert ring.overruns == 8
+    finally:
+        close_ring(ring)
+
+
+def test_read_waits_for_rows_not_yet_visible():
+    ring = SharedRing.create(capacity=64)
+    try:
+        ring.push(seq_rows(0, 10))
+        # 通算件数だけ先に見えて、中身はまだ届いていない（x86 以外で起こりうる順番）
+        ring.header[0] = 14
+        rows = ring.read()
+        assert check_rows(rows) == 0 and len(rows) == 10
+        assert ring.read_pos == 10 and len(ring.read()) == 0
+        ring.entries[10:14] = seq_rows(10, 4)
+        ring.entries["seq"][10:14] = np.arange(11, 15)
+        rows = ring.read()
+        assert check_rows(rows) == 10 and len(rows) == 4
+        assert ring.overruns == 0
+    finally:
+        close_ring(ring)
+
+
+def push_worker(name, capacity, total):
+    ring = SharedRing.attach(name, capacity)
+    rng = np.random.default_rng(0)
+    n = 0
+    while n < total:
+        k = int(rng.integers(1, capacity // 4))
+        k = min(k, total - n)
+        ring.push(seq_rows(n, k))
+        n += k
+    ring.entries = ring.header = None
+    ring.shm.close()
+
+
+def test_push_past_capacity_while_reading():
+    capacity, total = 256, 400_000
+    ring = SharedRing.create(capacity=capacity)
+    proc = mp.get_context("spawn").Process(target=push_worker, args=(ring.shm.name, capacity, total))
+    try:
+        proc.start()
+        received = 0
+        next_seq = 0
+        reads = 0
+        while True:
+            done = not proc.is_alive()
+            rows = ring.read()
+            if len(rows):
+                first = check_rows(rows)
+                # 捨てた分があっても、順番は戻らない
+                assert first >= next_seq
+                next_seq = first + len(rows)
+                received += len(rows)
+            reads += 1
+            if reads % 64 == 0:
+                time.sleep(0.001)   # ときどき遅れて、追い越される場合も通す
+            if done and ring.read_pos == int(ring.header[0]):
+                break
+        proc.join()
+        assert proc.exitcode == 0
+        assert next_seq == total
+        assert received + ring.overruns == total
+        assert ring.overruns > 0
+    finally:
+        if proc.is_alive():
+            proc.kill()
+        close_ring(ring)
+
+
+def make_grid_control(gen, value):
+    shm, desc = create_shared_array(np.full((4, 3, 3), value, dtype=np.uint8))
+    return shm, {"grid": {"rgb": desc}, "gen": gen, "step": 4}
+
+
+def bare_worker():
+    """
+    グリッドの知らせを受け取るところだけの SonifyWorker（プロセス・OSC・リングなし）
+    """
+    worker = SonifyWorker.__new__(SonifyWorker)
+    worker.grid, worker.grid_shms, worker.gen = None, [], 0
+    worker.controls, worker.controls_cond, worker.stdin_closed = [], threading.Condition(), False
+    return worker
+
+
+def test_worker_attaches_only_newest_grid():
+    worker = bare_worker()
+    made = [make_grid_control(gen, gen * 10) for gen in (1, 2, 3)]
+    try:
+        # 描画側が3つ目を出した時点で1つ目は片付け済み
+        made[0][0].unlink()
+        worker.controls = [c for _, c in made]
+        worker.apply_controls()
+        assert worker.gen == 3
+        assert int(worker.grid["rgb"][0, 0, 0]) == 30
+    finally:
+        for shm in worker.grid_shms:
+            shm.close()
+        for shm, _ in made[1:]:
+            shm.close()
+            shm.unlink()
+        made[0][0].close()
+
+
+def test_worker_skips_released_grid():
+    worker = bare_worker()
+    current, c1 = make_grid_control(1, 10)
+    stale, c2 = make_grid_control(2, 20)
+    try:
+        worker.controls = [c1]
+        worker.apply_controls()
+        stale.unlink()
+        worker.controls = [c2]
+        worker.apply_controls()
+        # つなげなかった世代は飛ばし、今のグリッドのまま
+        assert worker.gen == 1
+        assert int(worker.grid["rgb"][0, 0, 0]) == 10
+    finally:
+        for shm in worker.grid_shms:
+            shm.close()
+        current.close()
+        current.unlink()
+        stale.close()